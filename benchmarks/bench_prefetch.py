@@ -0,0 +1,97 @@
+"""
+Prefetch pipeline vs. the sequential download -> install path.
+
+Serves a few fake .deb artifacts from a local HTTP server throttled to
+simulate a slow link, and "installs" them with a sleep that stands in for apt
+(serialized, like the dpkg lock). Run with:
+
+    python -m benchmarks.bench_prefetch [--artifacts 5] [--size-kb 512] [--kbps 2048] [--install 0.5]
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dqs.core import cache, downloads
+from dqs.core.cache import ArtifactCache
+from dqs.core.downloads import Prefetcher, fetch
+
+
+def slow_server(size: int, kbps: int) -> ThreadingHTTPServer:
+    payload = os.urandom(size)
+    chunk = 16 * 1024
+    delay = chunk / (kbps * 1024)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            for start in range(0, size, chunk):
+                self.wfile.write(payload[start:start + chunk])
+                time.sleep(delay)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def install(seconds: float, lock: threading.Lock) -> None:
+    with lock:
+        time.sleep(seconds)
+
+
+def sequential(urls: list[str], install_time: float) -> float:
+    lock = threading.Lock()
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, url in enumerate(urls):
+            path = os.path.join(tmp, f"{i}.deb")
+            fetch(url, path)
+            install(install_time, lock)
+    return time.perf_counter() - start
+
+
+def pipelined(urls: list[str], install_time: float, workers: int) -> float:
+    lock = threading.Lock()
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp:
+        prefetcher = Prefetcher(cache=ArtifactCache(tmp), max_workers=workers)
+        prefetcher.start(urls)
+        for _ in prefetcher.completed():
+            install(install_time, lock)
+        prefetcher.shutdown()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--artifacts", type=int, default=5)
+    parser.add_argument("--size-kb", type=int, default=512)
+    parser.add_argument("--kbps", type=int, default=2048, help="Simulated link speed per connection")
+    parser.add_argument("--install", type=float, default=0.5, help="Simulated apt time per package (s)")
+    parser.add_argument("--workers", type=int, default=3)
+    args = parser.parse_args()
+
+    # Keep the output to the numbers
+    downloads.log = downloads.ok = cache.log = lambda message: None
+
+    server = slow_server(args.size_kb * 1024, args.kbps)
+    host, port = server.server_address
+    urls = [f"http://{host}:{port}/pkg{i}.deb" for i in range(args.artifacts)]
+
+    seq = sequential(urls, args.install)
+    pipe = pipelined(urls, args.install, args.workers)
+    server.shutdown()
+
+    print(f"sequential: {seq:6.2f}s")
+    print(f"prefetch:   {pipe:6.2f}s  ({(1 - pipe / seq) * 100:.0f}% saved)")
+
+
+if __name__ == "__main__":
+    main()
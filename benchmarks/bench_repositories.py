@@ -0,0 +1,74 @@
+"""
+apt metadata refreshes per run with the repository phase.
+
+Applies every repository of the catalog against a scratch root directory with
+a simulated runner (no sudo, no network) and counts `apt update` calls for:
+a fresh host, an unchanged rerun, and a rerun after a new repository shows up.
+The legacy flow ran one refresh in update_system plus one per repository task.
+Run with:
+
+    python -m benchmarks.bench_repositories
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from dqs.core import repositories
+from dqs.core.catalog import Repository, load_catalog
+from dqs.core.repositories import LISTS_DIR, RepositoryPhase
+
+
+def simulated_runner(root: str):
+    def runner(argv: list[str]) -> bool:
+        if argv == repositories.refresh_command():
+            lists = os.path.join(root, LISTS_DIR.lstrip("/"))
+            os.makedirs(lists, exist_ok=True)
+            # apt update takes a while, and mtimes have a coarse resolution
+            time.sleep(0.05)
+            os.utime(lists)
+            return True
+        # Only the effects matter here: files put in place by install / gpg
+        if argv[1] == "install" and "-d" in argv:
+            os.makedirs(argv[-1], exist_ok=True)
+        elif argv[1] in ("install", "gpg"):
+            target = argv[argv.index("-o") + 1] if argv[1] == "gpg" else argv[-1]
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(argv[-1] if argv[1] == "gpg" else argv[-2], target)
+        return True
+    return runner
+
+
+def fake_fetch(url: str, dest: str) -> bool:
+    with open(dest, "w") as f:
+        f.write(url)
+    return True
+
+
+def run_once(catalog, root: str, extra: dict = None) -> int:
+    phase = RepositoryPhase.from_catalog(catalog, runner=simulated_runner(root), root=root)
+    phase.repositories.update(extra or {})
+    phase.run()
+    return phase.refreshes
+
+
+def main() -> None:
+    repositories.fetch = fake_fetch
+    repositories.log = repositories.ok = lambda message: None
+    catalog = load_catalog()
+    legacy = 1 + len([req for req in catalog.special_requirements.values() if req.repository])
+
+    with tempfile.TemporaryDirectory() as root:
+        fresh = run_once(catalog, root)
+        rerun = run_once(catalog, root)
+        extra = {"example": Repository(list_file="/etc/apt/sources.list.d/example.list", line="deb https://example.org stable main")}
+        changed = run_once(catalog, root, extra)
+
+    print(f"legacy flow:              {legacy} refreshes per run")
+    print(f"fresh host:               {fresh}")
+    print(f"rerun, nothing changed:   {rerun}")
+    print(f"rerun, one new repo:      {changed}")
+
+
+if __name__ == "__main__":
+    main()
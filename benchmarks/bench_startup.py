@@ -0,0 +1,59 @@
+"""
+Import-time budget for the headless CLI.
+
+Imports dqs.main in fresh interpreters with `-X importtime`, takes the median
+cumulative time and fails (exit code 1) when it goes over the budget or when
+the import drags in textual. Run with:
+
+    python -m benchmarks.bench_startup [--budget-ms 150] [--runs 5]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+MODULE = "dqs.main"
+# Modules the headless path must never import
+FORBIDDEN = ("textual", "textual_dev")
+
+
+def import_times(module: str) -> dict[str, int]:
+    """Cumulative import time in microseconds of every module imported by module."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=150.0)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    samples = []
+    for _ in range(args.runs):
+        times = import_times(MODULE)
+        samples.append(times[MODULE] / 1000)
+        leaked = [name for name in times if name.split(".")[0] in FORBIDDEN]
+        if leaked:
+            print(f"FAIL: importing {MODULE} also imports {', '.join(sorted(leaked))}")
+            sys.exit(1)
+
+    median = statistics.median(samples)
+    print(f"{MODULE}: median {median:.1f}ms over {args.runs} runs (budget {args.budget_ms:.0f}ms)")
+    if median > args.budget_ms:
+        print("FAIL: over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,522 @@
+"""
+Hermetic benchmark suite: run_command, shell-free commands, batching,
+scheduling, resuming from the journal, adaptive concurrency on simulated
+hosts, locking, lock waits, the artifact cache, flatpak/brew pre-staging,
+repositories and batches of a targeted install, image layers, segmented
+downloads, the event bus, state probing and the package search index, all
+against simulated package managers and a local HTTP server
+(benchmarks/harness.py). Exits with code 1 when any measurement goes over
+its budget. Run with:
+
+    python -m benchmarks.bench_suite [--only NAME ...] [--json]
+"""
+import argparse
+import contextlib
+import copy
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from benchmarks.harness import DEFAULT_LATENCY, ArtifactServer, Budgets, FakeConfig, FakeSystem, SimulatedHost, timed
+from dqs.core import events, search, segments
+from dqs.core.cache import ArtifactCache
+from dqs.core.catalog import catalog_files, compile_catalog
+from dqs.core.commands import compile_command
+from dqs.core.concurrency import ConcurrencyController, HostSample
+from dqs.core.context import InstallationContext
+from dqs.core.image import dockerfile, plan_layers
+from dqs.core.journal import Journal
+from dqs.core.resolver import execute as execute_plan, resolve
+from dqs.core.scheduler import DPKG_LOCK, Scheduler, resource_lock
+from dqs.core.state import SystemState
+from dqs.utils.terminal_utils import execute, run_command
+
+APT_PACKAGES = [f"pkg{i:02d}" for i in range(20)]
+
+
+def pkg_data(names: list[str]) -> list[dict]:
+    return [{"id": name, "name": name} for name in names]
+
+
+def bench_command_overhead(budgets: Budgets) -> None:
+    runs = 30
+    seconds = timed(lambda: [run_command("true") for _ in range(runs)])
+    budgets.check("run_command overhead (ms/call)", seconds / runs * 1000, maximum=25)
+
+
+def bench_shell_free(budgets: Budgets) -> None:
+    # A large plan: 300 install lines, compiled once into argv steps
+    plan = [f"sudo apt install -y pkg{i} && flatpak install -y flathub org.example.App{i}" for i in range(300)]
+    compile_command.cache_clear()
+    compiled = timed(lambda: [compile_command(line) for line in plan])
+    budgets.check("command compile cost (us/line)", compiled / len(plan) * 1e6, maximum=100)
+
+    # By path, a bare `true` is a builtin of dash and /bin/sh would be all there is to run
+    true = shutil.which("true")
+    runs = 100
+    with_shell = timed(lambda: [subprocess.run(true, shell=True) for _ in range(runs)], repeat=5)
+    without = timed(lambda: [subprocess.run([true], close_fds=True) for _ in range(runs)], repeat=5)
+    budgets.check("process start speedup without a shell (x)", with_shell / without, minimum=1.3)
+
+    # Through run_command's runner: every argv command must take the posix_spawn path
+    spawned = [0]
+    original = subprocess.Popen._posix_spawn
+
+    def counting(self, *args, **kwargs):
+        spawned[0] += 1
+        return original(self, *args, **kwargs)
+
+    runs = 60
+    subprocess.Popen._posix_spawn = counting
+    try:
+        with_shell = timed(lambda: [execute(true, echo=False) for _ in range(runs)], repeat=5)
+        spawned[0] = 0
+        without = timed(lambda: [execute([true], echo=False) for _ in range(runs)], repeat=5)
+    finally:
+        subprocess.Popen._posix_spawn = original
+    budgets.check("argv commands started with posix_spawn", spawned[0] / (5 * runs), minimum=1)
+    budgets.check("overhead saved per command without a shell (ms)", (with_shell - without) / runs * 1000, minimum=0.1)
+
+
+def bench_batching(budgets: Budgets) -> None:
+    with FakeSystem():
+        context = InstallationContext()
+        method = context.get_method("pkg_manager")
+        one_by_one = timed(lambda: [method.install(pkg) for pkg in pkg_data(APT_PACKAGES)])
+    with FakeSystem():
+        context = InstallationContext()
+        batched = timed(lambda: context.install_packages(pkg_data(APT_PACKAGES), "pkg_manager"))
+    budgets.check("apt batching speedup (x)", one_by_one / batched, minimum=3)
+
+    # One broken package: bisection should isolate it in O(log n) transactions
+    with FakeSystem(FakeConfig(fail_packages=["pkg13"])) as system:
+        context = InstallationContext()
+        context.install_packages(pkg_data(APT_PACKAGES), "pkg_manager")
+        transactions = len(system.calls("apt"))
+        installed = len(system.dpkg_installed())
+    budgets.check("apt transactions, 1 broken of 20", transactions, maximum=2 * math.ceil(math.log2(len(APT_PACKAGES))) + 1)
+    budgets.check("packages installed, 1 broken of 20", installed, minimum=len(APT_PACKAGES) - 1)
+
+
+def bench_scheduler(budgets: Budgets) -> None:
+    def graph(workers: int) -> Scheduler:
+        scheduler = Scheduler(max_workers=workers)
+        for i in range(6):
+            scheduler.add(f"apt{i}", lambda i=i: run_command(f"sudo apt install -y sched{i}"), resources=[DPKG_LOCK])
+        for i in range(4):
+            scheduler.add(f"flatpak{i}", lambda i=i: run_command(f"flatpak install -y flathub app{i}"))
+            scheduler.add(f"brew{i}", lambda i=i: run_command(f"brew install formula{i}"))
+        return scheduler
+
+    with FakeSystem():
+        serial = timed(lambda: graph(1).run())
+    with FakeSystem():
+        parallel = timed(lambda: graph(4).run())
+    budgets.check("scheduler speedup, 4 workers (x)", serial / parallel, minimum=1.5)
+
+
+def bench_resume(budgets: Budgets) -> None:
+    # A run interrupted after the brew PATH task: on resume that task must
+    # run again, or the formulas left to install can't find brew
+    def graph(journal: Journal, env: dict) -> Scheduler:
+        scheduler = Scheduler(max_workers=2, journal=journal)
+        scheduler.add("install_homebrew", lambda: True, key="brew")
+        scheduler.add("add_homebrew_to_path", lambda: env.update(path=True) is None, ["install_homebrew"], key="path", rerun=True)
+        for i in range(3):
+            scheduler.add(f"brew_install_{i}", lambda: env.get("path", False), ["add_homebrew_to_path"], key=f"formula{i}")
+        return scheduler
+
+    with tempfile.TemporaryDirectory() as tmp:
+        journal = Journal(os.path.join(tmp, "journal.jsonl"))
+        for name, key in (("install_homebrew", "brew"), ("add_homebrew_to_path", "path"), ("brew_install_0", "formula0")):
+            journal.record(name, key, True)
+        journal.record("brew_install_1", "formula1", False)
+        results = graph(Journal(journal.path), {}).run()
+    budgets.check("tasks failed after resuming", len(results["failed"]), maximum=0)
+    budgets.check("done tasks after an env task skipped", len(results["resumed"]), minimum=2)
+
+
+def simulate(host: SimulatedHost, seconds: int = 600, spike: Optional[tuple[int, float]] = None) -> list[int]:
+    """Limit of a controller with tasks always waiting, second by second of virtual time."""
+    controller = ConcurrencyController(maximum=32, sampler=host.sample, clock=lambda: host.now)
+    # A long backlog: there is always a task an increase would start
+    controller.waiting = 1
+    limits = []
+    for second in range(seconds):
+        if spike and second == spike[0]:
+            host.background = spike[1]
+        host.advance(controller.limit)
+        limits.append(controller.adjust(host.sample(), host.now))
+    return limits
+
+
+def bench_concurrency(budgets: Budgets) -> None:
+    # A laptop whose desktop already keeps 3 of its 4 cpus busy
+    laptop = SimulatedHost(cpus=4, background=3)
+    simulate(laptop)
+    fixed = SimulatedHost(cpus=4, background=3)
+    for _ in range(600):
+        fixed.advance(8)
+    budgets.check("busy laptop load per cpu, adaptive", laptop.load / laptop.cpus, maximum=1.1)
+    budgets.check("busy laptop load per cpu, 8 fixed workers", fixed.load / fixed.cpus, minimum=2)
+
+    server = simulate(SimulatedHost(cpus=32, cpu_per_task=0.5))
+    budgets.check("build server tasks at once, steady state", min(server[300:]), minimum=16)
+
+    # Downloads only: 5 connections fill the link, more just share it
+    link = SimulatedHost(cpus=32, cpu_per_task=0.05, link=10e6, per_connection=2e6)
+    limits = simulate(link)
+    budgets.check("tasks at once on a saturated link", max(limits[300:]), maximum=6)
+    budgets.check("link use on a saturated link", link.throughput / link.link, minimum=0.9)
+
+    # The user starts a build halfway: the controller backs off to a single task
+    limits = simulate(SimulatedHost(cpus=8), spike=(300, 8))
+    budgets.check("seconds to back off after a load spike", limits[300:].index(1), maximum=30)
+
+    # Through the real scheduler: the ramp up goes through slot()
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def task() -> bool:
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        return True
+
+    controller = ConcurrencyController(maximum=8, initial=2, interval=0.01, sampler=lambda: HostSample(load=0.1))
+    scheduler = Scheduler(controller=controller)
+    for i in range(60):
+        scheduler.add(f"task{i}", task)
+    scheduler.run()
+    budgets.check("scheduler ramp up on an idle host (tasks)", peak[0], minimum=7)
+    budgets.check("scheduler tasks over the maximum of 8", peak[0] - 8, maximum=0)
+
+
+def bench_lock_contention(budgets: Budgets) -> None:
+    def race(locked: bool) -> int:
+        results = []
+
+        def install(i: int) -> None:
+            with resource_lock(DPKG_LOCK) if locked else contextlib.nullcontext():
+                results.append(run_command(f"sudo apt install -y race{i}"))
+
+        threads = [threading.Thread(target=install, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results.count(False)
+
+    # apt without a lock timeout gives up right away on a busy lock
+    with FakeSystem(FakeConfig(lock="fail")):
+        unlocked = race(locked=False)
+    with FakeSystem(FakeConfig(lock="fail")):
+        locked = race(locked=True)
+    print(f"      lock failures without the dpkg resource lock: {unlocked}/4", file=sys.stderr)
+    budgets.check("lock failures with the dpkg resource lock", locked, maximum=0)
+
+
+def bench_lock_wait(budgets: Budgets) -> None:
+    # Another process (unattended-upgrades) holds the dpkg lock for a second:
+    # dqs waits for it instead of failing the install
+    with FakeSystem(FakeConfig(lock="fail")) as system:
+        context = InstallationContext()
+        with system.hold_dpkg_lock(1.0):
+            installed = context.install_package({"id": "waiter", "name": "waiter"}, "pkg_manager")
+        waited = context.results["lock_waits"].get("waiter", 0.0)
+    budgets.check("installs failed behind a busy dpkg lock", 0 if installed else 1, maximum=0)
+    budgets.check("dpkg lock wait recorded (s)", waited, minimum=0.5)
+
+
+def bench_cache(budgets: Budgets) -> None:
+    artifacts = {f"app{i}.deb": 256 * 1024 for i in range(4)}
+    with ArtifactServer(artifacts, kbps=2048) as server, tempfile.TemporaryDirectory() as tmp:
+        cache = ArtifactCache(tmp)
+        urls = [server.url(name) for name in artifacts]
+        cold = timed(lambda: [cache.fetch(url, ".deb") for url in urls])
+        warm = timed(lambda: [cache.fetch(url, ".deb") for url in urls])
+        revalidated = server.not_modified
+    budgets.check("cache warm/cold time ratio", warm / cold, maximum=0.3)
+    budgets.check("cache revalidations answered 304", revalidated, minimum=len(artifacts))
+
+
+def bench_prestage(budgets: Budgets) -> None:
+    # flatpak apps and brew formulas queued behind a dozen apt packages
+    # installed as one long transaction on a single worker (a loaded host),
+    # their downloads much slower than their deploys
+    packages = {}
+
+    def add(pkg_id: str, method: str, requires: tuple = (), **spec) -> None:
+        packages[pkg_id] = {"methods": [method], "default_method": method,
+                            "install": {method: {"requires": list(requires), **spec}}}
+
+    add("flatpak", "apt")
+    for i in range(12):
+        add(f"tool{i}", "apt", ("flatpak",))
+    for i in range(3):
+        add(f"app{i}", "flatpak", ("flatpak",), package=f"org.example.App{i}")
+    for i in range(3):
+        add(f"formula{i}", "homebrew", ("flatpak",))
+    catalog = compile_catalog([("bench", {"packages": packages})])
+    plan = resolve(catalog, list(packages))
+    config = FakeConfig(latency=dict(DEFAULT_LATENCY, **{"apt-install-each": 0.1, "flatpak-download-each": 0.4,
+                                                         "brew-download-each": 0.3}))
+
+    def run(prestage: bool) -> InstallationContext:
+        context = InstallationContext()
+        execute_plan(plan, catalog, context, max_workers=1, prestage=prestage)
+        return context
+
+    with FakeSystem(config):
+        plain = timed(lambda: run(False))
+    contexts = []
+    with FakeSystem(config):
+        staged = timed(lambda: contexts.append(run(True)))
+    budgets.check("install speedup with pre-staging (x)", plain / staged, minimum=1.15)
+    budgets.check("download time hidden behind apt (s)", contexts[0].prestager.hidden(), minimum=0.5)
+
+
+def bench_plan_repositories(budgets: Budgets) -> None:
+    # Two packages from two extra repositories and a few plain ones, through
+    # resolver.execute: one apt refresh for both repositories, one apt
+    # transaction per group of packages with the same requirements
+    from benchmarks.bench_repositories import fake_fetch, simulated_runner
+    from dqs.core import repositories as repositories_module
+    from dqs.core.repositories import RepositoryPhase
+
+    packages = {}
+    special = {}
+    for name in ("docker", "spotify"):
+        special[f"{name}_repo"] = {"type": "repository_setup", "repository": {
+            "list_file": f"/etc/apt/sources.list.d/{name}.list", "line": f"deb https://{name}.example stable main",
+            "key_url": f"https://{name}.example/key", "keyring": f"/etc/apt/keyrings/{name}.asc"}}
+        packages[name] = {"methods": ["apt"], "default_method": "apt", "install": {"apt": {"requires": [f"{name}_repo"]}}}
+    for i in range(6):
+        packages[f"tool{i}"] = {"methods": ["apt"], "default_method": "apt", "install": {"apt": {"requires": []}}}
+    catalog = compile_catalog([("bench", {"packages": packages, "special_requirements": special})])
+    plan = resolve(catalog, list(packages))
+
+    saved = repositories_module.fetch
+    repositories_module.fetch = fake_fetch
+    try:
+        with tempfile.TemporaryDirectory() as root, FakeSystem() as system:
+            phase = RepositoryPhase.from_catalog(catalog, [step.id for step in plan if step.kind == "requirement"],
+                                                 runner=simulated_runner(root), root=root)
+            results = execute_plan(plan, catalog, InstallationContext(), prestage=False, repositories=phase)
+            transactions = len([call for call in system.calls("apt") if call["argv"][-1] != "update" and "install" in call["argv"]])
+    finally:
+        repositories_module.fetch = saved
+    budgets.check("apt refreshes, plan with 2 repositories", phase.refreshes, maximum=1)
+    budgets.check("failed steps, plan with 2 repositories", len(results["failed"]), maximum=0)
+    # The plain packages together, each repository package on its own
+    budgets.check("apt transactions, 8 packages in 3 groups", transactions, maximum=3)
+
+
+def bench_layers(budgets: Budgets) -> None:
+    # Pins each download of the shipped catalog with a sha256 in turn, then
+    # changes the digest as a release bump would: every layer before the one
+    # that changed is a cache hit
+    sources = []
+    for path in catalog_files(added=None):
+        with open(path) as f:
+            sources.append((os.path.basename(path), json.load(f)))
+
+    def layers(sources: list) -> list[str]:
+        catalog = compile_catalog(copy.deepcopy(sources))
+        return [layer.steps for layer in plan_layers(catalog, list(catalog.packages))]
+
+    def packages(layers: list) -> int:
+        return sum(len(layer.packages) for layer in layers)
+
+    def pin(sources: list, source: int, pkg_id: str, digest: str) -> list:
+        pinned = copy.deepcopy(sources)
+        pkg = pinned[source][1]["packages"][pkg_id]
+        pkg["install"][pkg["default_method"]]["sha256"] = digest
+        return pinned
+
+    downloads = [(source, pkg_id) for source, (_, data) in enumerate(sources) for pkg_id, pkg in data.get("packages", {}).items()
+                 if pkg["install"][pkg["default_method"]].get("url")]
+    reused = []
+    for source, pkg_id in downloads:
+        catalog = compile_catalog(pin(sources, source, pkg_id, "0" * 64))
+        baseline = plan_layers(catalog, list(catalog.packages))
+        rebuilt = layers(pin(sources, source, pkg_id, "1" * 64))
+        hits = 0
+        while hits < len(baseline) and baseline[hits].steps == rebuilt[hits]:
+            hits += 1
+        reused.append(packages(baseline[:hits]) / packages(baseline))
+    budgets.check("packages in cached layers after a version bump", min(reused), minimum=0.8)
+    budgets.check("Dockerfile layers, whole catalog", len(dockerfile(baseline, "all").split("\nRUN ")) - 1, maximum=12)
+
+
+def bench_segments(budgets: Budgets) -> None:
+    # Production segments are 8MB, smaller ones show the same effect on a few MB
+    saved = segments.SEGMENT_THRESHOLD, segments.SEGMENT_SIZE
+    size = 8 * 1024 * 1024
+    try:
+        with ArtifactServer({"big.deb": size}, kbps=8192) as server, tempfile.TemporaryDirectory() as tmp:
+            digest = hashlib.sha256(server.payloads["big.deb"]).hexdigest()
+            url = server.url("big.deb")
+            segments.SEGMENT_THRESHOLD, segments.SEGMENT_SIZE = size + 1, 1024 * 1024
+            single = timed(lambda: ArtifactCache(os.path.join(tmp, "single")).fetch(url, ".deb", sha256=digest))
+            segments.SEGMENT_THRESHOLD = 2 * 1024 * 1024
+            parallel = timed(lambda: ArtifactCache(os.path.join(tmp, "parallel")).fetch(url, ".deb", sha256=digest))
+            rejected = ArtifactCache(os.path.join(tmp, "tampered")).fetch(url, ".deb", sha256="0" * 64) is None
+
+            # Interrupted halfway, the second attempt only fetches the missing segments
+            cache = ArtifactCache(os.path.join(tmp, "resume"))
+            server.fail_ranges_from = size // 2
+            interrupted = cache.fetch(url, ".deb", sha256=digest) is None
+            server.fail_ranges_from = None
+            sent = server.bytes_sent
+            resumed = cache.fetch(url, ".deb", sha256=digest) is not None
+            refetched = (server.bytes_sent - sent) / size
+    finally:
+        segments.SEGMENT_THRESHOLD, segments.SEGMENT_SIZE = saved
+    budgets.check("segmented download speedup, 4 connections (x)", single / parallel, minimum=2)
+    budgets.check("downloads with a wrong sha256 accepted", 0 if rejected else 1, maximum=0)
+    budgets.check("interrupted download resumed", 1 if interrupted and resumed else 0, minimum=1)
+    budgets.check("share of the artifact fetched again on resume", refetched, maximum=0.65)
+
+
+def bench_events(budgets: Budgets) -> None:
+    # A subscriber far slower than the workers must not slow the publishers down
+    def slow(event: events.Event) -> None:
+        time.sleep(0.001)
+
+    publishes = 20000
+    events.subscribe(slow)
+    try:
+        seconds = timed(lambda: [events.publish("task.output", line="x") for _ in range(publishes)])
+    finally:
+        events._queue.clear()
+        events.unsubscribe(slow)
+
+    # The tracker the dashboard reads follows a whole scheduler run
+    tracker = events.Tracker()
+    events.subscribe(tracker)
+    try:
+        with FakeSystem():
+            scheduler = Scheduler(max_workers=4)
+            for i in range(8):
+                scheduler.add(f"task{i}", lambda i=i: run_command(f"sudo apt install -y ev{i}"), resources=[DPKG_LOCK])
+            scheduler.run()
+    finally:
+        events.unsubscribe(tracker)
+    state = tracker.snapshot()
+    budgets.check("event publish cost, slow subscriber (us)", seconds / publishes * 1e6, maximum=10)
+    budgets.check("tasks seen finished by the tracker", state["done"], minimum=8)
+
+
+def bench_probing(budgets: Budgets) -> None:
+    with FakeSystem(installed=APT_PACKAGES):
+        per_package = timed(lambda: [subprocess.run(["dpkg-query", "-W", name], capture_output=True) for name in APT_PACKAGES])
+        snapshot = timed(lambda: SystemState("debian"))
+    budgets.check("state snapshot vs per-package probes (x)", per_package / snapshot, minimum=2)
+
+
+def _packages_list(path: str, count: int, seed: int) -> None:
+    """Writes a Packages list shaped like Debian's: a dozen fields per stanza, one line description."""
+    rng = random.Random(seed)
+    words = ("lib python3 data dev doc utils tools gnome kde qt gtk perl ruby node rust go server client"
+             " daemon plugin fonts theme audio video image network").split()
+    summary = ("library for handling files networks images audio video documents configuration editor"
+               " terminal compiler debugger monitor system desktop").split()
+    with open(path, "w") as f:
+        for i in range(count):
+            name = "-".join(rng.sample(words, rng.randint(1, 3))) + str(i)
+            f.write(f"Package: {name}\nArchitecture: amd64\nVersion: {rng.randint(0, 9)}.{rng.randint(0, 30)}-1\n"
+                    f"Maintainer: Debian <debian@lists.debian.org>\nInstalled-Size: {rng.randint(10, 9999)}\n"
+                    f"Depends: libc6 (>= 2.34)\nSection: misc\nPriority: optional\n"
+                    f"Filename: pool/main/{name}_1.0_amd64.deb\nSize: 12345\nSHA256: {'b' * 64}\n"
+                    f"Description: {' '.join(rng.sample(summary, 6))}\nDescription-md5: {'c' * 32}\n\n")
+
+
+def bench_search(budgets: Budgets) -> None:
+    # A main list the size of Debian's and a small second one: building,
+    # updating with nothing changed, updating after one list changed, queries
+    queries = ["lib", "python3-gtk", "gnome plugin", "editor terminal", "audio5", "zzz"]
+    saved = search.APT_LISTS, search.FLATPAK_APPSTREAM, search.HOMEBREW_API
+    with tempfile.TemporaryDirectory() as tmp:
+        lists = os.path.join(tmp, "lists")
+        os.makedirs(lists)
+        search.APT_LISTS, search.FLATPAK_APPSTREAM, search.HOMEBREW_API = lists, [], os.path.join(tmp, "none")
+        try:
+            _packages_list(os.path.join(lists, "deb.debian.org_debian_dists_stable_main_binary-amd64_Packages"), 60000, 1)
+            backports = os.path.join(lists, "deb.debian.org_debian_dists_stable-backports_main_binary-amd64_Packages")
+            _packages_list(backports, 2000, 2)
+            index = search.PackageIndex(os.path.join(tmp, "index"))
+            build = timed(index.update)
+            unchanged = timed(index.update)
+            index.search("lib")
+            latency = max(timed(lambda: index.search(query), repeat=5) for query in queries)
+            _packages_list(backports, 2100, 3)
+            index.update()
+            rebuilt = index.rebuilt == [backports]
+            found = index.search("python3-gtk")
+            index.close()
+        finally:
+            search.APT_LISTS, search.FLATPAK_APPSTREAM, search.HOMEBREW_API = saved
+    budgets.check("index build, 62k packages (s)", build, maximum=10)
+    budgets.check("index update, nothing changed (ms)", unchanged * 1000, maximum=5)
+    budgets.check("only the changed list rebuilt", int(rebuilt), minimum=1)
+    budgets.check("slowest query (ms)", latency * 1000, maximum=20)
+    budgets.check("results for a name prefix", len(found), minimum=1)
+
+
+BENCHMARKS = {
+    "command_overhead": bench_command_overhead,
+    "shell_free": bench_shell_free,
+    "batching": bench_batching,
+    "scheduler": bench_scheduler,
+    "resume": bench_resume,
+    "concurrency": bench_concurrency,
+    "lock_contention": bench_lock_contention,
+    "lock_wait": bench_lock_wait,
+    "cache": bench_cache,
+    "prestage": bench_prestage,
+    "plan_repositories": bench_plan_repositories,
+    "layers": bench_layers,
+    "segments": bench_segments,
+    "events": bench_events,
+    "probing": bench_probing,
+    "search": bench_search,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--json", action="store_true", help="Print the measurements as JSON")
+    args = parser.parse_args()
+
+    budgets = Budgets()
+    for name in args.only or BENCHMARKS:
+        print(f"... {name}", file=sys.stderr)
+        # dqs logs every command it runs, keep the output to the numbers
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            BENCHMARKS[name](budgets)
+
+    if args.json:
+        print(json.dumps([{"name": name, "value": value, "op": op, "budget": limit, "passed": passed}
+                          for name, value, op, limit, passed in budgets.rows], indent=2))
+    else:
+        print(budgets.report())
+    if budgets.failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+Simulated package managers for the benchmark harness (benchmarks/harness.py).
+
+This one script stands in for apt, apt-get, dpkg, dpkg-query, flatpak, brew,
+curl and sudo: the harness symlinks every name to it and it dispatches on the
+name it was called by. Its state lives under $DQS_FAKE_ROOT:
+- config.json                 -> latencies, failure rate, lock mode, seed
+- var/lib/dpkg/status         -> dpkg database (same format as the real one)
+- flatpak.txt / brew.txt      -> installed apps / formulas, one per line
+- flatpak-staged.txt ...      -> payloads already downloaded (flatpak install
+                                 --no-deploy, brew fetch), installing them
+                                 later skips the download latency
+- var/lib/dpkg/lock-frontend  -> fcntl lock taken by every dpkg transaction,
+                                 like the real one
+- calls.jsonl                 -> one line per invocation: tool, argv, start,
+                                 end, seconds waited for the lock, exit code
+Stdlib only, and started with python -S so each call stays cheap.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+
+ROOT = os.environ.get("DQS_FAKE_ROOT", "")
+LOCK_ERROR = "E: Could not get lock /var/lib/dpkg/lock-frontend. It is held by process 1 (apt)"
+
+
+def load_config() -> dict:
+    with open(os.path.join(ROOT, "config.json")) as f:
+        return json.load(f)
+
+
+CONFIG = load_config() if ROOT else {"latency": {}}
+STATE = {"waited": 0.0}
+
+
+def sleep(key: str, count: int = 1) -> None:
+    latency = CONFIG["latency"]
+    time.sleep(latency.get(key, 0.0) + latency.get(f"{key}-each", 0.0) * count)
+
+
+def fails(name: str) -> bool:
+    """Deterministic per package and seed, so runs are reproducible."""
+    if name in CONFIG.get("fail_packages", []):
+        return True
+    rate = CONFIG.get("failure_rate", 0.0)
+    if not rate:
+        return False
+    digest = hashlib.sha1(f"{CONFIG.get('seed', 0)}:{name}".encode()).digest()
+    return int.from_bytes(digest[:4], "big") / 2**32 < rate
+
+
+class dpkg_lock:
+    """lock="wait" or -o DPkg::Lock::Timeout=N block on a busy lock, lock="fail" exits 100."""
+    def __init__(self, timeout: float = 0.0):
+        self.timeout = timeout
+
+    def __enter__(self):
+        self.file = open(os.path.join(ROOT, "var", "lib", "dpkg", "lock-frontend"), "a")
+        start = time.monotonic()
+        while True:
+            try:
+                fcntl.lockf(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if CONFIG.get("lock") == "fail" and time.monotonic() - start >= self.timeout:
+                    print(LOCK_ERROR, file=sys.stderr)
+                    raise SystemExit(100)
+                time.sleep(0.02)
+        STATE["waited"] += time.monotonic() - start
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.lockf(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+class tool_lock:
+    """One operation at a time per tool, like flatpak's installation lock and brew's prefix lock."""
+    def __init__(self, tool: str):
+        self.tool = tool
+
+    def __enter__(self):
+        self.file = open(os.path.join(ROOT, f"{self.tool}.lock"), "a")
+        fcntl.lockf(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.lockf(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+# ==================================================================
+# BACKEND STATE
+# ==================================================================
+def dpkg_status_path() -> str:
+    return os.path.join(ROOT, "var", "lib", "dpkg", "status")
+
+
+def dpkg_installed() -> list[str]:
+    names = []
+    try:
+        with open(dpkg_status_path()) as f:
+            names = [line[9:].strip() for line in f if line.startswith("Package: ")]
+    except OSError:
+        pass
+    return names
+
+
+def dpkg_add(names: list[str]) -> None:
+    known = set(dpkg_installed())
+    with open(dpkg_status_path(), "a") as f:
+        for name in names:
+            if name not in known:
+                f.write(f"Package: {name}\nStatus: install ok installed\nVersion: 1.0\n\n")
+                known.add(name)
+
+
+def list_file(backend: str) -> str:
+    return os.path.join(ROOT, f"{backend}.txt")
+
+
+def list_installed(backend: str) -> list[str]:
+    try:
+        with open(list_file(backend)) as f:
+            return [line.strip() for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def list_add(backend: str, names: list[str]) -> None:
+    known = set(list_installed(backend))
+    with open(list_file(backend), "a") as f:
+        for name in names:
+            if name not in known:
+                f.write(name + "\n")
+
+
+def download(backend: str, names: list[str]) -> None:
+    # Only what isn't staged yet costs download time
+    missing = [name for name in names if name not in set(list_installed(f"{backend}-staged"))]
+    if missing:
+        sleep(f"{backend}-download", len(missing))
+        list_add(f"{backend}-staged", missing)
+
+
+# ==================================================================
+# TOOLS
+# ==================================================================
+def positional(args: list[str]) -> list[str]:
+    # -o takes a value (-o DPkg::Lock::Timeout=60)
+    return [arg for i, arg in enumerate(args) if not arg.startswith("-") and (i == 0 or args[i - 1] != "-o")]
+
+
+def apt_options(args: list[str]) -> dict[str, str]:
+    return dict(args[i + 1].split("=", 1) for i, arg in enumerate(args[:-1]) if arg == "-o" and "=" in args[i + 1])
+
+
+def apt(args: list[str]) -> int:
+    words = positional(args)
+    action = words[0] if words else ""
+    lock_timeout = float(apt_options(args).get("DPkg::Lock::Timeout", 0))
+    if action in ("update", "upgrade", "full-upgrade", "dist-upgrade"):
+        with dpkg_lock(lock_timeout):
+            sleep(f"apt-{action}")
+        return 0
+    if action == "download":
+        for name in words[1:]:
+            open(f"{name}_1.0_amd64.deb", "w").close()
+        return 0
+    if action != "install":
+        return 0
+
+    names = [os.path.basename(word).split("_")[0].removesuffix(".deb") if word.endswith(".deb") else word for word in words[1:]]
+    with dpkg_lock(lock_timeout):
+        sleep("apt-install", len(names))
+        broken = [name for name in names if fails(name)]
+        if broken:
+            print(f"E: Unable to locate package {broken[0]}", file=sys.stderr)
+            return 100
+        dpkg_add(names)
+    return 0
+
+
+def dpkg(args: list[str]) -> int:
+    if "--print-architecture" in args:
+        print("amd64")
+        return 0
+    if "-i" in args or "--install" in args:
+        return apt(["install", *positional(args)])
+    return 0
+
+
+def dpkg_query(args: list[str]) -> int:
+    sleep("dpkg-query")
+    fmt = "${Package}\t${Version}\n"
+    if "-f" in args:
+        fmt = args[args.index("-f") + 1]
+    elif any(arg.startswith("--showformat=") for arg in args):
+        fmt = next(arg for arg in args if arg.startswith("--showformat="))[len("--showformat="):]
+    fmt = fmt.replace("\\n", "\n")
+    wanted = [arg for arg in positional(args) if arg != fmt]
+    installed = dpkg_installed()
+    missing = [name for name in wanted if name not in installed]
+    for name in (wanted or installed):
+        if name in installed:
+            sys.stdout.write(fmt.replace("${Package}", name).replace("${Version}", "1.0")
+                             .replace("${db:Status-Abbrev}", "ii ").replace("${Status}", "install ok installed"))
+    for name in missing:
+        print(f"dpkg-query: no packages found matching {name}", file=sys.stderr)
+    return 1 if missing else 0
+
+
+def flatpak(args: list[str]) -> int:
+    words = positional(args)
+    action = words[0] if words else ""
+    if action == "list":
+        sleep("flatpak-list")
+        print("\n".join(list_installed("flatpak")))
+    elif action == "install":
+        # flatpak install [-y] [--no-deploy] <remote> <refs...>
+        refs = words[2:] if len(words) > 2 else words[1:]
+        if any(fails(ref) for ref in refs):
+            print("error: Nothing matches", file=sys.stderr)
+            return 1
+        with tool_lock("flatpak"):
+            download("flatpak", refs)
+            if "--no-deploy" not in args:
+                sleep("flatpak-install", len(refs))
+                list_add("flatpak", refs)
+    return 0
+
+
+def brew(args: list[str]) -> int:
+    words = positional(args)
+    action = words[0] if words else ""
+    if action == "list":
+        sleep("brew-list")
+        for name in list_installed("brew"):
+            print(f"{name} 1.0")
+    elif action in ("install", "fetch"):
+        formulas = words[1:]
+        if any(fails(name) for name in formulas):
+            print("Error: No available formula", file=sys.stderr)
+            return 1
+        with tool_lock("brew"):
+            download("brew", formulas)
+            if action == "install":
+                sleep("brew-install", len(formulas))
+                list_add("brew", formulas)
+    return 0
+
+
+def curl(args: list[str]) -> int:
+    import urllib.request
+
+    sleep("curl")
+    output, url, i = None, None, 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ("-o", "--output"):
+            output, i = args[i + 1], i + 1
+        elif arg in ("-H", "-A", "--header", "--user-agent"):
+            i += 1
+        elif arg == "-O":
+            output = ""
+        elif not arg.startswith("-"):
+            url = arg
+        i += 1
+    if not url:
+        return 2
+    if output == "":
+        output = os.path.basename(url.split("?")[0]) or "index.html"
+    try:
+        with urllib.request.urlopen(url) as response:
+            data = response.read()
+    except OSError as e:
+        print(f"curl: (22) {e}", file=sys.stderr)
+        return 22
+    if output:
+        with open(output, "wb") as f:
+            f.write(data)
+    else:
+        sys.stdout.buffer.write(data)
+    return 0
+
+
+def sudo(args: list[str]) -> int:
+    while args and args[0].startswith("-"):
+        args = args[1:]
+    if not args:
+        return 0
+    os.execvp(args[0], args)
+
+
+TOOLS = {
+    "apt": apt,
+    "apt-get": apt,
+    "dpkg": dpkg,
+    "dpkg-query": dpkg_query,
+    "flatpak": flatpak,
+    "brew": brew,
+    "curl": curl,
+    "sudo": sudo,
+}
+
+
+def main() -> int:
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    start = time.time()
+    code = 1
+    try:
+        code = TOOLS[tool](args)
+    except SystemExit as e:
+        code = e.code
+    finally:
+        if ROOT and tool != "sudo":
+            call = {"tool": tool, "argv": args, "start": start, "end": time.time(), "waited": STATE["waited"], "code": code}
+            with open(os.path.join(ROOT, "calls.jsonl"), "a") as f:
+                f.write(json.dumps(call) + "\n")
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,316 @@
+"""
+Hermetic benchmark harness.
+
+FakeSystem puts simulated apt, apt-get, dpkg, dpkg-query, flatpak, brew, curl
+and sudo (benchmarks/fake_tools.py) first on PATH, with configurable latency,
+failure rate and dpkg lock behaviour, and points dqs at their dpkg database.
+ArtifactServer serves artifacts over local HTTP at a throttled speed, with
+ETag revalidation. SimulatedHost stands in for /proc and the network link
+under a virtual clock, for the concurrency controller. Together they let benchmarks exercise the real code paths
+(run_command, the installation methods, the scheduler, the cache, the state
+probes) on any Linux machine, without root or network.
+
+    with FakeSystem(FakeConfig(latency={"apt-install": 0.2}), installed=["curl"]) as system:
+        ...
+        system.calls("apt")
+
+Budgets turns measurements into pass/fail regression checks.
+"""
+import hashlib
+import json
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from dqs.core import retry, state
+from dqs.core.concurrency import HostSample
+
+FAKE_TOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_tools.py")
+TOOLS = ("apt", "apt-get", "dpkg", "dpkg-query", "flatpak", "brew", "curl", "sudo")
+
+# Seconds, "<key>" once per call plus "<key>-each" per package of the call
+DEFAULT_LATENCY = {
+    "apt-update": 0.3,
+    "apt-upgrade": 0.3,
+    "apt-install": 0.15,
+    "apt-install-each": 0.03,
+    "dpkg-query": 0.0,
+    "flatpak-list": 0.05,
+    "flatpak-install": 0.1,
+    "flatpak-install-each": 0.05,
+    "flatpak-download-each": 0.15,
+    "brew-list": 0.05,
+    "brew-install": 0.1,
+    "brew-install-each": 0.05,
+    "brew-download-each": 0.1,
+    "curl": 0.0,
+}
+
+
+@dataclass
+class FakeConfig:
+    latency: dict[str, float] = field(default_factory=lambda: dict(DEFAULT_LATENCY))
+    # Share of packages that fail to install, picked deterministically from seed
+    failure_rate: float = 0.0
+    fail_packages: list[str] = field(default_factory=list)
+    # "wait": a busy dpkg lock blocks, like apt's DPkg::Lock::Timeout.
+    # "fail": exits 100 right away, like apt without it
+    lock: str = "wait"
+    seed: int = 0
+
+
+class FakeSystem:
+    """Simulated package managers on PATH for the duration of the with block."""
+
+    def __init__(self, config: Optional[FakeConfig] = None, installed: Iterable[str] = (),
+                 flatpaks: Iterable[str] = (), formulas: Iterable[str] = ()):
+        self.config = config or FakeConfig()
+        self.installed = list(installed)
+        self.flatpaks = list(flatpaks)
+        self.formulas = list(formulas)
+        self.root = ""
+        self._saved: dict[str, Any] = {}
+
+    def __enter__(self) -> "FakeSystem":
+        self.root = tempfile.mkdtemp(prefix="dqs-fake-")
+        bin_dir = os.path.join(self.root, "bin")
+        os.makedirs(bin_dir)
+        os.makedirs(os.path.join(self.root, "var", "lib", "dpkg"))
+
+        script = os.path.join(self.root, "fake_tools")
+        with open(FAKE_TOOLS) as src, open(script, "w") as dst:
+            dst.write(f"#!{sys.executable} -S\n")
+            dst.write(src.read())
+        os.chmod(script, 0o755)
+        for tool in TOOLS:
+            os.symlink(script, os.path.join(bin_dir, tool))
+
+        self.configure(self.config)
+        with open(os.path.join(self.root, "var", "lib", "dpkg", "status"), "w") as f:
+            for name in self.installed:
+                f.write(f"Package: {name}\nStatus: install ok installed\nVersion: 1.0\n\n")
+        for backend, names in (("flatpak", self.flatpaks), ("brew", self.formulas)):
+            with open(os.path.join(self.root, f"{backend}.txt"), "w") as f:
+                f.writelines(f"{name}\n" for name in names)
+
+        self._saved = {
+            "PATH": os.environ.get("PATH", ""),
+            "DQS_FAKE_ROOT": os.environ.get("DQS_FAKE_ROOT"),
+            "DPKG_STATUS": state.DPKG_STATUS,
+            "DPKG_LOCK_FILES": retry.DPKG_LOCK_FILES,
+        }
+        os.environ["PATH"] = f"{bin_dir}{os.pathsep}{self._saved['PATH']}"
+        os.environ["DQS_FAKE_ROOT"] = self.root
+        state.DPKG_STATUS = os.path.join(self.root, "var", "lib", "dpkg", "status")
+        retry.DPKG_LOCK_FILES = [os.path.join(self.root, "var", "lib", "dpkg", "lock-frontend")]
+        open(retry.DPKG_LOCK_FILES[0], "a").close()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        os.environ["PATH"] = self._saved["PATH"]
+        if self._saved["DQS_FAKE_ROOT"] is None:
+            os.environ.pop("DQS_FAKE_ROOT", None)
+        else:
+            os.environ["DQS_FAKE_ROOT"] = self._saved["DQS_FAKE_ROOT"]
+        state.DPKG_STATUS = self._saved["DPKG_STATUS"]
+        retry.DPKG_LOCK_FILES = self._saved["DPKG_LOCK_FILES"]
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def configure(self, config: FakeConfig) -> None:
+        """Changes the simulation on the fly (the tools read it on every call)."""
+        self.config = config
+        with open(os.path.join(self.root, "config.json"), "w") as f:
+            json.dump(asdict(config), f)
+
+    def calls(self, tool: Optional[str] = None) -> list[dict[str, Any]]:
+        """Every invocation of the fake tools so far (of one tool if given)."""
+        try:
+            with open(os.path.join(self.root, "calls.jsonl")) as f:
+                calls = [json.loads(line) for line in f]
+        except OSError:
+            return []
+        return [call for call in calls if tool is None or call["tool"] == tool]
+
+    def reset_calls(self) -> None:
+        path = os.path.join(self.root, "calls.jsonl")
+        if os.path.exists(path):
+            os.remove(path)
+
+    def dpkg_installed(self) -> set[str]:
+        return state.parse_dpkg_status()
+
+    @contextmanager
+    def hold_dpkg_lock(self, seconds: float) -> Iterator[None]:
+        """Holds the dpkg lock from another process for a while, like unattended-upgrades."""
+        lock = os.path.join(self.root, "var", "lib", "dpkg", "lock-frontend")
+        holder = subprocess.Popen([sys.executable, "-c",
+                                   "import fcntl, sys, time; f = open(sys.argv[1], 'a'); fcntl.lockf(f, fcntl.LOCK_EX);"
+                                   " print(flush=True); time.sleep(float(sys.argv[2]))", lock, str(seconds)],
+                                  stdout=subprocess.PIPE)
+        holder.stdout.readline()
+        try:
+            yield
+        finally:
+            holder.wait()
+
+
+# ==================================================================
+# ARTIFACT SERVER
+# ==================================================================
+class ArtifactServer:
+    """
+    Local HTTP server for artifacts, throttled to kbps per connection, with
+    ETag and byte range (Range, If-Range) support. Range requests starting at
+    or after fail_ranges_from get a 404, to interrupt segmented downloads.
+    """
+
+    def __init__(self, artifacts: dict[str, int], kbps: int = 4096, chunk: int = 16 * 1024):
+        self.payloads = {name: os.urandom(size) for name, size in artifacts.items()}
+        self.etags = {name: hashlib.sha1(payload).hexdigest() for name, payload in self.payloads.items()}
+        self.requests = 0
+        self.range_requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.fail_ranges_from: Optional[int] = None
+        delay = chunk / (kbps * 1024)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                name = self.path.lstrip("/").split("?")[0]
+                if name not in server.payloads:
+                    self.send_error(404)
+                    return
+                etag = f'"{server.etags[name]}"'
+                if self.headers.get("If-None-Match") == etag:
+                    server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                payload = server.payloads[name]
+                ranged = self.headers.get("Range", "").startswith("bytes=") and self.headers.get("If-Range", etag) == etag
+                if ranged:
+                    server.range_requests += 1
+                    first, last = self.headers["Range"][6:].split("-")
+                    start, end = int(first), min(int(last or len(payload) - 1), len(payload) - 1)
+                    if server.fail_ranges_from is not None and start >= server.fail_ranges_from:
+                        self.send_error(404)
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(payload)}")
+                    payload = payload[start:end + 1]
+                else:
+                    self.send_response(200)
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Length", str(len(payload)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                try:
+                    for start in range(0, len(payload), chunk):
+                        self.wfile.write(payload[start:start + chunk])
+                        server.bytes_sent += len(payload[start:start + chunk])
+                        time.sleep(delay)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client only wanted the headers (segmented downloads)
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+
+    def __enter__(self) -> "ArtifactServer":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def url(self, name: str) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/{name}"
+
+
+# ==================================================================
+# SIMULATED HOST
+# ==================================================================
+class SimulatedHost:
+    """
+    Load, cpu pressure and download throughput of a machine running a number
+    of tasks, advanced in virtual seconds. The load average and the pressure
+    are smoothed like the kernel does (1 minute and 10 seconds), so they lag
+    behind the tasks just like the real ones.
+    """
+
+    def __init__(self, cpus: int, background: float = 0.0, cpu_per_task: float = 1.0,
+                 link: float = math.inf, per_connection: float = math.inf):
+        self.cpus = cpus
+        self.background = background
+        self.cpu_per_task = cpu_per_task
+        self.link = link
+        self.per_connection = per_connection
+        self.now = 0.0
+        self.load = background
+        self.pressure = 0.0
+        self.throughput = 0.0
+
+    def advance(self, running: int, seconds: float = 1.0) -> None:
+        demand = self.background + running * self.cpu_per_task
+        stalled = 100 * max(0.0, 1 - self.cpus / demand) if demand else 0.0
+        self.load += (demand - self.load) * (1 - math.exp(-seconds / 60))
+        self.pressure += (stalled - self.pressure) * (1 - math.exp(-seconds / 10))
+        self.throughput = min(self.link, running * self.per_connection) if running else 0.0
+        self.now += seconds
+
+    def sample(self) -> HostSample:
+        return HostSample(load=self.load / self.cpus, cpu_pressure=self.pressure, io_pressure=0.0,
+                          throughput=0.0 if math.isinf(self.throughput) else self.throughput)
+
+
+# ==================================================================
+# MEASUREMENTS
+# ==================================================================
+def timed(func: Callable[[], Any], repeat: int = 1) -> float:
+    """Median wall clock seconds of func over repeat runs."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+class Budgets:
+    """Collects measurements and checks them against regression thresholds."""
+
+    def __init__(self):
+        self.rows: list[tuple[str, float, str, float, bool]] = []
+
+    def check(self, name: str, value: float, maximum: Optional[float] = None, minimum: Optional[float] = None) -> None:
+        if maximum is not None:
+            self.rows.append((name, value, "<=", maximum, value <= maximum))
+        elif minimum is not None:
+            self.rows.append((name, value, ">=", minimum, value >= minimum))
+
+    @property
+    def failed(self) -> list[str]:
+        return [name for name, _, _, _, passed in self.rows if not passed]
+
+    def report(self) -> str:
+        lines = []
+        for name, value, op, limit, passed in self.rows:
+            lines.append(f"{'ok  ' if passed else 'FAIL'}  {name:<44}{value:10.3f}  (budget {op} {limit:g})")
+        return "\n".join(lines)
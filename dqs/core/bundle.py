@@ -0,0 +1,224 @@
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+import zipfile
+from typing import Any, Iterable, Optional
+
+from dqs.core.cache import ArtifactCache
+from dqs.core.catalog import Catalog, load_catalog
+from dqs.core.downloads import fetch
+from dqs.core.installation_methods import extract_tarball, link_executables
+from dqs.core.retry import apt_lock_args, wait_for_dpkg_lock
+from dqs.core.scheduler import DPKG_LOCK, resource_lock
+from dqs.utils import paths
+from dqs.utils.terminal_utils import log, ok, error, run_command
+
+# ==================================================================
+'''
+OFFLINE BUNDLES:
+A bundle is a zip archive with a manifest.json plus every artifact the plan
+needs, stored uncompressed (the artifacts already are) so members can be read
+straight from the archive through the zip central directory:
+- apt/<name>.deb            -> apt packages and their dependency closure
+- deb/<id>.deb              -> direct .deb downloads
+- flatpak/...               -> `flatpak create-usb` repo + flathub.flatpakrepo
+- brew/...                  -> HOMEBREW_CACHE with the bottles of the formulas
+- tarball/<id>/<file>       -> tarballs, extracted straight from the archive
+                               like TarballMethod does from the network
+Script installs (Homebrew itself, rclone) need the network and are listed as
+online_only in the manifest.
+'''
+# ==================================================================
+BUNDLE_FORMAT = 1
+MANIFEST = "manifest.json"
+FLATHUB_REPO = "https://dl.flathub.org/repo/flathub.flatpakrepo"
+
+APT_CLOSURE = ("apt-cache", "depends", "--recurse", "--no-recommends", "--no-suggests", "--no-conflicts",
+               "--no-breaks", "--no-replaces", "--no-enhances")
+
+
+def _lines(argv: list[str], env: Optional[dict[str, str]] = None) -> list[str]:
+    try:
+        result = subprocess.run(argv, capture_output=True, text=True, env=env, close_fds=True)
+    except OSError:
+        return []
+    return result.stdout.splitlines() if result.returncode == 0 else []
+
+
+def _add_tree(archive: zipfile.ZipFile, directory: str, prefix: str) -> None:
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            archive.write(path, f"{prefix}/{os.path.relpath(path, directory)}")
+
+
+# ==================================================================
+# EXPORT
+# ==================================================================
+def export_bundle(profile: str, output: str, catalog: Optional[Catalog] = None) -> bool:
+    """Resolves the profile and writes every artifact it needs into one archive."""
+    catalog = catalog or load_catalog()
+    pkg_ids = catalog.plan(catalog.resolve_targets(profile))
+    cache = ArtifactCache()
+    manifest: dict[str, Any] = {
+        "format": BUNDLE_FORMAT,
+        "profile": profile,
+        "created": time.time(),
+        "packages": [],
+        "online_only": [],
+    }
+    apt_names: list[str] = []
+    flatpak_refs: list[str] = []
+    formulas: list[str] = []
+    success = True
+
+    part = f"{output}.part"
+    with tempfile.TemporaryDirectory(prefix="dqs-bundle-") as tmp, zipfile.ZipFile(part, "w", zipfile.ZIP_STORED) as archive:
+        for pkg_id in pkg_ids:
+            pkg = catalog.packages[pkg_id]
+            spec = pkg.spec()
+            entry = {"id": pkg_id, "method": pkg.default_method, "members": []}
+
+            if pkg.default_method == "apt":
+                apt_names.append(spec.package or pkg_id)
+            elif pkg.default_method in ("deb", "tarball"):
+                suffix = ".deb" if pkg.default_method == "deb" else ""
+                path = cache.fetch(spec.url, suffix, spec.mirrors, spec.sha256)
+                if not path:
+                    success = False
+                    continue
+                if pkg.default_method == "deb":
+                    member = f"deb/{pkg_id}.deb"
+                    # The dependencies of the .deb go into the apt closure
+                    for dependency in ",".join(_lines(["dpkg-deb", "-f", path, "Depends"])).split(","):
+                        name = dependency.split("|")[0].split("(")[0].split(":")[0].strip()
+                        if name:
+                            apt_names.append(name)
+                else:
+                    member = f"tarball/{pkg_id}/{os.path.basename(spec.url.split('?')[0])}"
+                archive.write(path, member)
+                entry["members"].append(member)
+            elif pkg.default_method == "flatpak":
+                flatpak_refs.extend(spec.packages or [spec.package or pkg_id])
+            elif pkg.default_method == "homebrew":
+                formulas.append(spec.package or pkg_id)
+            else:
+                manifest["online_only"].append(pkg_id)
+                continue
+            manifest["packages"].append(entry)
+
+        if apt_names:
+            log(f"Resolving the apt closure of {len(apt_names)} packages...")
+            closure = sorted({line.strip() for line in _lines([*APT_CLOSURE, *apt_names])
+                              if line and not line.startswith((" ", "<"))})
+            apt_dir = os.path.join(tmp, "apt")
+            os.makedirs(apt_dir)
+            if not run_command(["apt-get", "download", *closure], cwd=apt_dir):
+                # A single undownloadable (virtual...) name makes apt-get give up on the batch
+                for name in closure:
+                    run_command(["apt-get", "download", name], cwd=apt_dir)
+            _add_tree(archive, apt_dir, "apt")
+            manifest["apt"] = sorted(f"apt/{name}" for name in os.listdir(apt_dir))
+
+        if flatpak_refs:
+            flatpak_dir = os.path.join(tmp, "flatpak")
+            os.makedirs(flatpak_dir)
+            if run_command(["flatpak", "create-usb", "--allow-partial", flatpak_dir, *flatpak_refs]) \
+                    and fetch(FLATHUB_REPO, os.path.join(flatpak_dir, "flathub.flatpakrepo")):
+                _add_tree(archive, flatpak_dir, "flatpak")
+                manifest["flatpak"] = flatpak_refs
+            else:
+                success = False
+
+        if formulas:
+            brew_dir = os.path.join(tmp, "brew")
+            env = dict(os.environ, HOMEBREW_CACHE=brew_dir, HOMEBREW_NO_AUTO_UPDATE="1")
+            if run_command(["brew", "fetch", "--deps", *formulas], env=env):
+                _add_tree(archive, brew_dir, "brew")
+                manifest["homebrew"] = formulas
+            else:
+                success = False
+
+        archive.writestr(MANIFEST, json.dumps(manifest, indent=2))
+
+    os.replace(part, output)
+    ok(f"Bundle written to: {output}")
+    if manifest["online_only"]:
+        log(f"Needs network at install time: {', '.join(manifest['online_only'])}")
+    return success
+
+
+# ==================================================================
+# INSTALL
+# ==================================================================
+def _extract(archive: zipfile.ZipFile, members: Iterable[str], dest: str) -> list[str]:
+    paths = []
+    for member in members:
+        paths.append(archive.extract(member, dest))
+    return paths
+
+
+def install_bundle(path: str) -> dict[str, list[str]]:
+    """Provisions the machine from a bundle, without network."""
+    results = {"completed": [], "failed": [], "skipped": []}
+    with zipfile.ZipFile(path) as archive:
+        manifest = json.loads(archive.read(MANIFEST))
+        if manifest.get("format") != BUNDLE_FORMAT:
+            error(f"Unsupported bundle format: {manifest.get('format')}")
+            return results
+        by_method: dict[str, list[dict[str, Any]]] = {}
+        for entry in manifest["packages"]:
+            by_method.setdefault(entry["method"], []).append(entry)
+
+        def record(entries: list[dict[str, Any]], success: bool) -> None:
+            results["completed" if success else "failed"].extend(entry["id"] for entry in entries)
+
+        # Every .deb goes into one apt transaction, only the .debs are extracted
+        system = by_method.get("apt", []) + by_method.get("deb", [])
+        if system:
+            with tempfile.TemporaryDirectory(prefix="dqs-bundle-") as tmp:
+                members = manifest.get("apt", []) + [m for entry in by_method.get("deb", []) for m in entry["members"]]
+                debs = _extract(archive, members, tmp)
+                with resource_lock(DPKG_LOCK):
+                    record(system, wait_for_dpkg_lock() and run_command(["sudo", "apt-get", *apt_lock_args(), "install", "-y", "--no-download", *debs]))
+
+        if by_method.get("flatpak"):
+            with tempfile.TemporaryDirectory(prefix="dqs-bundle-") as tmp:
+                _extract(archive, [m for m in archive.namelist() if m.startswith("flatpak/")], tmp)
+                repo = os.path.join(tmp, "flatpak")
+                record(by_method["flatpak"], run_command(
+                    ["sudo", "flatpak", "remote-add", "--if-not-exists", "flathub", os.path.join(repo, "flathub.flatpakrepo")]
+                ) and run_command(
+                    ["flatpak", "install", "-y", "--noninteractive", f"--sideload-repo={os.path.join(repo, '.ostree', 'repo')}",
+                     "flathub", *manifest.get("flatpak", [])]
+                ))
+
+        if by_method.get("homebrew"):
+            if not shutil.which("brew"):
+                error("Homebrew is not installed, its formulas need it (and it needs the network).")
+                record(by_method["homebrew"], False)
+            else:
+                with tempfile.TemporaryDirectory(prefix="dqs-bundle-") as tmp:
+                    _extract(archive, [m for m in archive.namelist() if m.startswith("brew/")], tmp)
+                    env = dict(os.environ, HOMEBREW_CACHE=os.path.join(tmp, "brew"), HOMEBREW_NO_AUTO_UPDATE="1")
+                    record(by_method["homebrew"], run_command(["brew", "install", *manifest.get("homebrew", [])], env=env))
+
+        # Tarballs are streamed from the archive member straight into the prefix
+        for entry in by_method.get("tarball", []):
+            dest = os.path.join(paths.OPT_DIR, entry["id"])
+            try:
+                for member in entry["members"]:
+                    with archive.open(member) as stream:
+                        extract_tarball(stream, dest)
+                link_executables(dest)
+                record([entry], True)
+            except (OSError, tarfile.TarError) as e:
+                error(f"Could not extract {entry['id']}: {e}")
+                record([entry], False)
+
+    results["skipped"].extend(manifest.get("online_only", []))
+    return results
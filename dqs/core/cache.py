@@ -0,0 +1,222 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Iterable, Iterator, Optional
+
+from dqs.core import events, retry, segments, timings
+from dqs.utils.paths import CACHE_DIR
+from dqs.utils.terminal_utils import log, error
+
+# ==================================================================
+'''
+CACHE LAYOUT (~/.cache/dqs/artifacts):
+- blobs/<sha256><suffix>  -> content addressed artifacts
+- index/<sha1(url)>.json  -> url, blob, etag, last_modified, size
+- locks/<sha1(url)>.lock  -> one download per url at a time, across processes
+- partial/<sha1(source)>  -> large download in progress, fetched in segments
+                             and resumed from them (dqs.core.segments)
+- evict.lock              -> one eviction at a time
+Everything is written to a temporary file first and moved in place with
+os.replace, so readers never see a half written blob or index entry.
+Blobs are named by their sha256, so checking an artifact against the
+sha256 of the catalog costs nothing on a cache hit.
+'''
+# ==================================================================
+DEFAULT_MAX_MB = 4096
+# Blobs used this recently are never evicted, another run may be about to install them
+EVICTION_GRACE = 3600
+CHUNK_SIZE = 1024 * 256
+# Seconds without receiving anything before a download is considered stalled
+DOWNLOAD_TIMEOUT = 30
+
+
+def default_max_bytes() -> int:
+    """Size limit of the cache, DQS_CACHE_MAX_MB or DEFAULT_MAX_MB when it isn't a number."""
+    value = os.environ.get("DQS_CACHE_MAX_MB")
+    if value is not None:
+        try:
+            return int(value) * 1024 * 1024
+        except ValueError:
+            error(f"DQS_CACHE_MAX_MB is not a number of MB: {value!r}, using {DEFAULT_MAX_MB}")
+    return DEFAULT_MAX_MB * 1024 * 1024
+
+
+@contextmanager
+def file_lock(path: str, shared: bool = False) -> Iterator[None]:
+    """Holds an flock on path while the block runs."""
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ChecksumError(OSError):
+    """Raised when a download doesn't match the sha256 it was expected to have."""
+
+
+class ArtifactCache:
+    """Persistent download cache, revalidated with ETag/Last-Modified and LRU evicted."""
+
+    def __init__(self, root: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.root = root or os.path.join(CACHE_DIR, "artifacts")
+        self.max_bytes = default_max_bytes() if max_bytes is None else max_bytes
+        for sub in ("blobs", "index", "locks", "tmp", "partial"):
+            os.makedirs(os.path.join(self.root, sub), exist_ok=True)
+
+    def fetch(self, url: str, suffix: str = "", mirrors: Iterable[str] = (), sha256: Optional[str] = None) -> Optional[str]:
+        """
+        Returns the path of the cached artifact of url, downloading it if it
+        changed. Transient errors are retried with backoff, then each mirror
+        is tried in turn. The cache entry is always keyed by url. With
+        sha256, an artifact with any other content is never returned.
+        """
+        # urllib is slow to import and only needed once something is downloaded
+        import http.client
+        import urllib.error
+
+        key = hashlib.sha1(url.encode()).hexdigest()
+        start = time.monotonic()
+        downloaded = 0
+        with file_lock(os.path.join(self.root, "locks", f"{key}.lock")):
+            entry = self._read_entry(key)
+            cached = self._blob_path(entry["blob"]) if entry else None
+            if cached and (not os.path.exists(cached) or (sha256 and not entry["blob"].startswith(sha256))):
+                entry, cached = None, None
+
+            # Validators belong to the primary url, mirrors are always fetched in full
+            headers = {"User-Agent": "dqs"}
+            if entry and entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry and entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+            sources = list(dict.fromkeys([url, *mirrors]))
+            failure = None
+            for index, source in enumerate(sources):
+                if index:
+                    retry.failover(url, source)
+                try:
+                    entry = retry.call(lambda: self._download(url, source, headers if not index else {"User-Agent": "dqs"}, suffix, sha256),
+                                       f"Download of {source}")
+                    downloaded = entry["size"]
+                    self._write_entry(key, entry)
+                    failure = None
+                    break
+                except urllib.error.HTTPError as e:
+                    if e.code == 304 and cached:
+                        log(f"Cache hit: {url}")
+                        failure = None
+                        break
+                    failure = e
+                except (OSError, http.client.HTTPException) as e:
+                    failure = e
+
+            if failure:
+                if not cached:
+                    error(f"Download failed: {url}: {failure}")
+                    return None
+                # Offline, the cached copy is better than nothing
+                log(f"Could not revalidate {url} ({failure}), using the cached copy")
+
+            path = self._blob_path(entry["blob"])
+            os.utime(path)
+
+        timings.record_download(url, downloaded, time.monotonic() - start, cached=not downloaded)
+        events.publish("download.finished", url=url, bytes=downloaded, seconds=round(time.monotonic() - start, 3), cached=not downloaded)
+        self.evict()
+        return path
+
+    def _download(self, url: str, source: str, headers: dict[str, str], suffix: str, sha256: Optional[str]) -> dict[str, Any]:
+        import urllib.request
+
+        with urllib.request.urlopen(urllib.request.Request(source, headers=headers), timeout=DOWNLOAD_TIMEOUT) as response:
+            events.publish("download.started", url=url)
+            size = segments.segmented_size(response)
+            if size:
+                # Large artifact: parallel ranges (of the redirected url) instead of this one stream
+                partial = os.path.join(self.root, "partial", hashlib.sha1(source.encode()).hexdigest())
+                response.close()
+                digest = segments.download(response.url, size, segments.validator(response), partial,
+                                           {"User-Agent": "dqs"}, DOWNLOAD_TIMEOUT, label=url)
+                try:
+                    blob = self._commit(partial, digest, suffix, sha256)
+                finally:
+                    segments.discard(partial)
+            else:
+                blob = self._store(response, url, suffix, sha256)
+            return {
+                "url": url,
+                "source": source,
+                "blob": blob,
+                "etag": response.headers.get("ETag") if source == url else None,
+                "last_modified": response.headers.get("Last-Modified") if source == url else None,
+                "size": os.path.getsize(self._blob_path(blob)),
+            }
+
+    def evict(self) -> None:
+        """Removes the least recently used blobs until the cache fits in max_bytes."""
+        with file_lock(os.path.join(self.root, "evict.lock")):
+            blobs_dir = os.path.join(self.root, "blobs")
+            blobs = []
+            for name in os.listdir(blobs_dir):
+                stat = os.stat(os.path.join(blobs_dir, name))
+                blobs.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for _, size, _ in blobs)
+            now = time.time()
+            for mtime, size, name in sorted(blobs):
+                if total <= self.max_bytes:
+                    break
+                if now - mtime < EVICTION_GRACE:
+                    continue
+                os.remove(os.path.join(blobs_dir, name))
+                total -= size
+
+    def _store(self, response: Any, url: str, suffix: str, sha256: Optional[str]) -> str:
+        digest = hashlib.sha256()
+        total = response.headers.get("Content-Length")
+        received = 0
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while chunk := response.read(CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    received += len(chunk)
+                    events.progress(url, "download.progress", url=url, bytes=received, total=int(total) if total else None)
+            return self._commit(tmp, digest.hexdigest(), suffix, sha256)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _commit(self, path: str, digest: str, suffix: str, sha256: Optional[str]) -> str:
+        """Moves a finished download into blobs/, unless it doesn't match sha256."""
+        if sha256 and digest != sha256:
+            os.remove(path)
+            raise ChecksumError(f"sha256 mismatch: expected {sha256}, got {digest}")
+        blob = f"{digest}{suffix}"
+        os.replace(path, self._blob_path(blob))
+        return blob
+
+    def _blob_path(self, blob: str) -> str:
+        return os.path.join(self.root, "blobs", blob)
+
+    def _read_entry(self, key: str) -> Optional[dict[str, Any]]:
+        try:
+            with open(os.path.join(self.root, "index", f"{key}.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_entry(self, key: str, entry: dict[str, Any]) -> None:
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, os.path.join(self.root, "index", f"{key}.json"))
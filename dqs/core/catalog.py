@@ -0,0 +1,357 @@
+import glob
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Optional
+
+from dqs.utils.paths import CACHE_DIR, CONFIG_DIR
+
+# ==================================================================
+'''
+CATALOG:
+Every *.json file in dqs/data is part of the catalog, and so is ADDED_FILE
+(~/.config/dqs/added.json, written by `dqs add`) when it exists. Each one
+has a "packages" and optional "special_requirements", "profiles" and
+"extend_profiles" sections (ids appended to a profile of any file). The
+catalog is compiled once into slotted records plus lookup indexes, and the compiled form
+is pickled under ~/.cache/dqs keyed by the hash of the source files, so
+startup skips JSON parsing and validation until the catalog changes.
+'''
+# ==================================================================
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+# Packages added with `dqs add`, found by dqs.core.search. Outside the
+# package, which may not be writable (a site-packages install)
+ADDED_FILE = os.path.join(CONFIG_DIR, "added.json")
+# Bump when the compiled records change shape, invalidates every cached catalog
+CATALOG_FORMAT = 6
+
+
+class CatalogError(ValueError):
+    """Raised when the catalog files are not valid."""
+
+
+@dataclass(slots=True, frozen=True)
+class InstallSpec:
+    method: str
+    command: Optional[str] = None
+    url: Optional[str] = None
+    package: Optional[str] = None
+    # Several backend packages installed as one catalog entry (flatpak apps...)
+    packages: tuple[str, ...] = ()
+    requires: tuple[str, ...] = ()
+    # Alternative urls with the same artifact, tried in order when url fails
+    mirrors: tuple[str, ...] = ()
+    # Hex sha256 of the artifact at url, downloads with other content are rejected
+    sha256: Optional[str] = None
+    # File an installer script leaves behind, the only sign it already ran
+    creates: Optional[str] = None
+
+
+@dataclass(slots=True, frozen=True)
+class Package:
+    id: str
+    name: str
+    description: str
+    category: str
+    methods: tuple[str, ...]
+    default_method: str
+    install: dict[str, InstallSpec] = field(default_factory=dict)
+
+    def spec(self, method: Optional[str] = None) -> InstallSpec:
+        """Install spec of the given method (the default one if None)."""
+        return self.install[method or self.default_method]
+
+    def to_pkg_data(self, method: Optional[str] = None) -> dict[str, Any]:
+        """Flattened dict the installation methods work with."""
+        spec = self.spec(method)
+        pkg_data = {"id": self.id, "name": self.name, "category": self.category}
+        for key in ("command", "url", "package", "sha256", "creates"):
+            value = getattr(spec, key)
+            if value is not None:
+                pkg_data[key] = value
+        if spec.packages:
+            pkg_data["packages"] = list(spec.packages)
+        if spec.mirrors:
+            pkg_data["mirrors"] = list(spec.mirrors)
+        return pkg_data
+
+
+@dataclass(slots=True, frozen=True)
+class Repository:
+    # apt source added by a repository_setup requirement. Either a key + list
+    # file, or an extrepo name. {arch} and {codename} in line are filled in
+    # from the running system.
+    list_file: Optional[str] = None
+    line: Optional[str] = None
+    key_url: Optional[str] = None
+    keyring: Optional[str] = None
+    dearmor: bool = False
+    extrepo: Optional[str] = None
+
+
+@dataclass(slots=True, frozen=True)
+class SpecialRequirement:
+    id: str
+    type: str
+    setup_task: Optional[str] = None
+    binary_path: Optional[str] = None
+    repository: Optional[Repository] = None
+
+
+@dataclass(slots=True)
+class Catalog:
+    source_hash: str
+    packages: dict[str, Package]
+    special_requirements: dict[str, SpecialRequirement]
+    by_category: dict[str, tuple[str, ...]]
+    by_method: dict[str, tuple[str, ...]]
+    # requirement id (package or special requirement) -> ids that require it
+    reverse_deps: dict[str, tuple[str, ...]]
+    profiles: dict[str, tuple[str, ...]] = field(default_factory=dict)
+
+    def get(self, pkg_id: str) -> Optional[Package]:
+        return self.packages.get(pkg_id)
+
+    def dependents(self, requirement: str) -> tuple[str, ...]:
+        """Ids of the packages that require the given package or special requirement."""
+        return self.reverse_deps.get(requirement, ())
+
+    def plan(self, targets: Iterable[str]) -> list[str]:
+        """Targets plus every package they require, requirements first (see dqs.core.resolver)."""
+        from dqs.core.resolver import resolve
+
+        return resolve(self, targets).package_ids()
+
+    def resolve_targets(self, spec: str) -> list[str]:
+        """Package ids of a profile name, 'all', or a comma separated list of ids."""
+        if spec == "all":
+            return list(self.packages)
+        if spec in self.profiles:
+            return list(self.profiles[spec])
+        ids = [pkg_id.strip() for pkg_id in spec.split(",") if pkg_id.strip()]
+        unknown = [pkg_id for pkg_id in ids if pkg_id not in self.packages]
+        if unknown or not ids:
+            raise CatalogError(f"Unknown profile or packages: {', '.join(unknown) or spec!r}")
+        return ids
+
+
+# ==================================================================
+# COMPILER
+# ==================================================================
+def _require(data: dict[str, Any], key: str, where: str) -> Any:
+    if key not in data:
+        raise CatalogError(f"{where}: missing '{key}'")
+    return data[key]
+
+
+def _sha256(value: Optional[str], where: str) -> Optional[str]:
+    if value is None:
+        return None
+    if not isinstance(value, str) or len(value) != 64 or any(c not in "0123456789abcdefABCDEF" for c in value):
+        raise CatalogError(f"{where}: 'sha256' must be 64 hex digits")
+    return value.lower()
+
+
+def _compile_package(pkg_id: str, data: dict[str, Any], source: str) -> Package:
+    where = f"{source}: package '{pkg_id}'"
+    if data.get("id", pkg_id) != pkg_id:
+        raise CatalogError(f"{where}: id '{data['id']}' doesn't match its key")
+
+    methods = tuple(_require(data, "methods", where))
+    default_method = _require(data, "default_method", where)
+    if default_method not in methods:
+        raise CatalogError(f"{where}: default_method '{default_method}' is not one of {list(methods)}")
+
+    install = {}
+    raw_install = _require(data, "install", where)
+    for method in methods:
+        spec = _require(raw_install, method, f"{where}: install")
+        install[method] = InstallSpec(
+            method=method,
+            command=spec.get("command"),
+            url=spec.get("url"),
+            package=spec.get("package"),
+            packages=tuple(spec.get("packages", ())),
+            requires=tuple(spec.get("requires", ())),
+            mirrors=tuple(spec.get("mirrors", ())),
+            sha256=_sha256(spec.get("sha256"), f"{where}: install.{method}"),
+            creates=spec.get("creates"),
+        )
+
+    return Package(
+        id=pkg_id,
+        name=data.get("name", pkg_id),
+        description=data.get("description", ""),
+        category=data.get("category", "uncategorized"),
+        methods=methods,
+        default_method=default_method,
+        install=install,
+    )
+
+
+def compile_catalog(sources: Iterable[tuple[str, dict[str, Any]]], source_hash: str = "") -> Catalog:
+    """Builds the catalog records and indexes from (source name, parsed json) pairs."""
+    packages: dict[str, Package] = {}
+    special: dict[str, SpecialRequirement] = {}
+    profiles: dict[str, tuple[str, ...]] = {}
+    extensions: list[tuple[str, list[str]]] = []
+
+    for source, data in sources:
+        for profile, ids in data.get("profiles", {}).items():
+            if profile in profiles:
+                raise CatalogError(f"{source}: profile '{profile}' is already defined")
+            profiles[profile] = tuple(ids)
+        extensions.extend(data.get("extend_profiles", {}).items())
+        for pkg_id, pkg in data.get("packages", {}).items():
+            if pkg_id in packages:
+                raise CatalogError(f"{source}: package '{pkg_id}' is already defined")
+            packages[pkg_id] = _compile_package(pkg_id, pkg, source)
+        for req_id, req in data.get("special_requirements", {}).items():
+            if req_id in special:
+                raise CatalogError(f"{source}: special requirement '{req_id}' is already defined")
+            where = f"{source}: special requirement '{req_id}'"
+            repository = req.get("repository")
+            if repository is not None:
+                if not repository.get("extrepo") and not (repository.get("list_file") and repository.get("line")):
+                    raise CatalogError(f"{where}: a repository needs 'extrepo' or 'list_file' and 'line'")
+                repository = Repository(**{key: repository[key] for key in Repository.__slots__ if key in repository})
+            special[req_id] = SpecialRequirement(
+                id=req_id,
+                type=_require(req, "type", where),
+                setup_task=req.get("setup_task"),
+                binary_path=req.get("binary_path"),
+                repository=repository,
+            )
+
+    by_category: dict[str, list[str]] = {}
+    by_method: dict[str, list[str]] = {}
+    reverse: dict[str, list[str]] = {}
+    for pkg in packages.values():
+        by_category.setdefault(pkg.category, []).append(pkg.id)
+        for method, spec in pkg.install.items():
+            by_method.setdefault(method, []).append(pkg.id)
+            for req in spec.requires:
+                if req not in packages and req not in special:
+                    raise CatalogError(f"package '{pkg.id}': unknown requirement '{req}' for method '{method}'")
+                if pkg.id not in reverse.setdefault(req, []):
+                    reverse[req].append(pkg.id)
+
+    for profile, ids in extensions:
+        profiles[profile] = profiles.get(profile, ()) + tuple(pkg_id for pkg_id in ids if pkg_id not in profiles.get(profile, ()))
+    for profile, ids in profiles.items():
+        unknown = [pkg_id for pkg_id in ids if pkg_id not in packages]
+        if unknown:
+            raise CatalogError(f"profile '{profile}': unknown packages {unknown}")
+
+    def freeze(index: dict[str, list[str]]) -> dict[str, tuple[str, ...]]:
+        return {key: tuple(values) for key, values in index.items()}
+
+    return Catalog(
+        source_hash=source_hash,
+        packages=packages,
+        special_requirements=special,
+        by_category=freeze(by_category),
+        by_method=freeze(by_method),
+        reverse_deps=freeze(reverse),
+        profiles=profiles,
+    )
+
+
+# ==================================================================
+# LOADER
+# ==================================================================
+def catalog_files(data_dir: str = DATA_DIR, added: Optional[str] = ADDED_FILE) -> list[str]:
+    """The shipped catalog files, then the file of added packages if there is one."""
+    files = sorted(glob.glob(os.path.join(data_dir, "*.json")))
+    if added and os.path.exists(added) and added not in files:
+        files.append(added)
+    return files
+
+
+def load_catalog(paths: Optional[list[str]] = None, cache_dir: Optional[str] = CACHE_DIR) -> Catalog:
+    """
+    Loads the catalog from the given files (catalog_files() by default),
+    reusing the compiled form cached for the same content when there is one.
+    Pass cache_dir=None to always compile from the JSON files.
+    """
+    paths = paths if paths is not None else catalog_files()
+    contents = []
+    digest = hashlib.sha256(f"dqs-catalog-{CATALOG_FORMAT}".encode())
+    for path in paths:
+        with open(path, "rb") as f:
+            content = f.read()
+        contents.append((path, content))
+        digest.update(os.path.basename(path).encode() + b"\0" + content)
+    source_hash = digest.hexdigest()
+
+    cache_path = os.path.join(cache_dir, f"catalog-{source_hash[:16]}.pickle") if cache_dir else None
+    if cache_path:
+        try:
+            with open(cache_path, "rb") as f:
+                catalog = pickle.load(f)
+            if isinstance(catalog, Catalog) and catalog.source_hash == source_hash:
+                return catalog
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, TypeError):
+            pass
+
+    sources = []
+    for path, content in contents:
+        try:
+            sources.append((os.path.basename(path), json.loads(content)))
+        except ValueError as e:
+            raise CatalogError(f"{path}: invalid JSON: {e}") from e
+    catalog = compile_catalog(sources, source_hash)
+
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(catalog, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache_path)
+            # Catalogs compiled from older sources are never loaded again
+            for stale in glob.glob(os.path.join(cache_dir, "catalog-*.pickle")):
+                if stale != cache_path:
+                    os.remove(stale)
+        except OSError:
+            # A read only cache is not a reason to fail
+            pass
+
+    return catalog
+
+
+def add_package(pkg_id: str, data: Optional[dict[str, Any]] = None, profile: Optional[str] = None,
+                path: Optional[str] = None) -> None:
+    """
+    Writes the package (when data is given) and its place in the profile into
+    the file of added packages. The whole catalog is compiled with the change
+    first, so nothing invalid is ever written.
+    """
+    path = path or ADDED_FILE
+    try:
+        with open(path) as f:
+            added = json.load(f)
+    except FileNotFoundError:
+        added = {}
+    if data is not None:
+        added.setdefault("packages", {})[pkg_id] = data
+    if profile:
+        ids = added.setdefault("extend_profiles", {}).setdefault(profile, [])
+        if pkg_id not in ids:
+            ids.append(pkg_id)
+
+    sources = []
+    for source in catalog_files(added=None):
+        with open(source) as f:
+            sources.append((os.path.basename(source), json.load(f)))
+    compile_catalog(sources + [(os.path.basename(path), added)])
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+    with os.fdopen(fd, "w") as f:
+        json.dump(added, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    os.replace(tmp, path)
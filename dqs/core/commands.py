@@ -0,0 +1,128 @@
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+from dqs.utils.terminal_utils import run_command
+
+# ==================================================================
+'''
+SHELL-FREE COMMANDS:
+Install commands are compiled once into argv steps and exec'd without
+/bin/sh: one process less per step, and an argument is passed as one argv
+entry whatever it contains. What compiles is the small subset of sh the
+catalog uses:
+- words, with '...', "..." and \\ quoting (no expansions inside "...")
+- NAME=value assignments in front of a step, added to its environment
+- steps joined with &&, a line ending in \\ continues on the next one
+Anything else (pipes, redirections, $, globs, ~, ;, ||, subshells) raises
+ShellRequired: those are scripts, and only entries marked as scripts run
+through the shell.
+'''
+# ==================================================================
+# Outside quotes these only mean something to a shell
+_SHELL_CHARS = set("|;<>()$`*?[]{}\n")
+
+
+class ShellRequired(ValueError):
+    """Raised for a command that only a shell can run."""
+
+
+@dataclass(slots=True, frozen=True)
+class Step:
+    argv: tuple[str, ...]
+    # NAME=value assignments in front of the command
+    env: tuple[tuple[str, str], ...] = ()
+
+
+def _split(command: str) -> list[str]:
+    """Splits into words, with && kept as its own word, following sh quoting."""
+    words: list[str] = []
+    word: Optional[list[str]] = None
+    i, size = 0, len(command)
+    while i < size:
+        char = command[i]
+        if char in " \t":
+            if word is not None:
+                words.append("".join(word))
+                word = None
+        elif char == "&":
+            if command[i:i + 2] != "&&":
+                raise ShellRequired(f"'&' needs a shell: {command}")
+            if word is not None:
+                words.append("".join(word))
+                word = None
+            words.append("&&")
+            i += 1
+        elif char == "\\":
+            if i + 1 == size:
+                raise ShellRequired(f"Trailing backslash: {command}")
+            if command[i + 1] != "\n":
+                word = (word or []) + [command[i + 1]]
+            i += 1
+        elif char == "'":
+            end = command.find("'", i + 1)
+            if end == -1:
+                raise ShellRequired(f"Unterminated quote: {command}")
+            word = (word or []) + [command[i + 1:end]]
+            i = end
+        elif char == '"':
+            end = command.find('"', i + 1)
+            if end == -1:
+                raise ShellRequired(f"Unterminated quote: {command}")
+            quoted = command[i + 1:end]
+            if any(c in quoted for c in "$`\\"):
+                raise ShellRequired(f"Expansion inside double quotes needs a shell: {command}")
+            word = (word or []) + [quoted]
+            i = end
+        elif char in _SHELL_CHARS or (char in "~#" and word is None):
+            raise ShellRequired(f"'{char}' needs a shell: {command}")
+        else:
+            word = (word or []) + [char]
+        i += 1
+    if word is not None:
+        words.append("".join(word))
+    return words
+
+
+def _is_assignment(word: str) -> bool:
+    name, equals, _ = word.partition("=")
+    return bool(equals) and name.replace("_", "a").isalnum() and not name[0].isdigit()
+
+
+@lru_cache(maxsize=None)
+def compile_command(command: str) -> tuple[Step, ...]:
+    """Compiles a command line into the argv steps it runs, cached per command."""
+    steps: list[Step] = []
+    for group in _groups(_split(command), command):
+        env = []
+        while group and _is_assignment(group[0]):
+            name, _, value = group.pop(0).partition("=")
+            env.append((name, value))
+        if not group:
+            raise ShellRequired(f"Empty step: {command}")
+        steps.append(Step(tuple(group), tuple(env)))
+    return tuple(steps)
+
+
+def _groups(words: list[str], command: str) -> list[list[str]]:
+    groups: list[list[str]] = [[]]
+    for word in words:
+        if word == "&&":
+            groups.append([])
+        else:
+            groups[-1].append(word)
+    if any(not group for group in groups):
+        raise ShellRequired(f"Empty step: {command}")
+    return groups
+
+
+def run_steps(steps: tuple[Step, ...], timeout: Optional[float] = None, env: Optional[dict[str, str]] = None) -> bool:
+    """Runs the steps in order without a shell, stopping at the first one that fails (like &&)."""
+    for step in steps:
+        step_env = env
+        if step.env:
+            step_env = dict(env if env is not None else os.environ, **dict(step.env))
+        if not run_command(step.argv, timeout=timeout, env=step_env):
+            return False
+    return True
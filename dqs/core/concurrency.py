@@ -0,0 +1,268 @@
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional
+
+from dqs.core import events
+from dqs.utils.terminal_utils import log
+
+# ==================================================================
+'''
+ADAPTIVE CONCURRENCY:
+The scheduler sizes its pool for the most tasks the controller may allow,
+and every task takes a slot from the controller right before running (after
+its exclusive locks, so a task waiting on dpkg holds no slot). Every
+SAMPLE_INTERVAL the controller samples the host and moves the limit to hold
+its targets, additive increase and multiplicative decrease:
+- load per cpu (/proc/loadavg) or cpu/io pressure (/proc/pressure, some
+  avg10) over target  -> limit * DECREASE, at most once per COOLDOWN as both
+                           signals lag behind what just started
+- everything under HEADROOM of its target, tasks waiting -> limit + 1
+- download throughput didn't grow with the last increase -> the link is
+  saturated: that increase is undone and the limit held until the
+  throughput drops
+lower_priority() makes dqs and every command it starts from then on nice,
+and last of the best-effort class on io, so the desktop stays responsive.
+'''
+# ==================================================================
+SAMPLE_INTERVAL = 1.0
+# 1 min load average per cpu
+TARGET_LOAD = 1.0
+# % of the last 10s some task was stalled on cpu / io
+TARGET_PRESSURE = 20.0
+HEADROOM = 0.8
+DECREASE = 0.75
+COOLDOWN = 5.0
+# An increase must bring this much more throughput, or the link is full
+SATURATION_GAIN = 0.1
+THROUGHPUT_WINDOW = 5.0
+
+NICENESS = 10
+PROC_DIR = "/proc"
+
+
+@dataclass(slots=True)
+class HostSample:
+    # None where the kernel doesn't expose the signal (no PSI before 4.20...)
+    load: Optional[float] = None
+    cpu_pressure: Optional[float] = None
+    io_pressure: Optional[float] = None
+    # Bytes per second downloaded over THROUGHPUT_WINDOW
+    throughput: float = 0.0
+
+
+def read_load(proc: str = PROC_DIR) -> Optional[float]:
+    """1 minute load average divided by the number of cpus."""
+    try:
+        with open(os.path.join(proc, "loadavg")) as f:
+            return float(f.read().split()[0]) / (os.cpu_count() or 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_pressure(resource: str, proc: str = PROC_DIR) -> Optional[float]:
+    """avg10 of the "some" line of /proc/pressure/<resource>."""
+    try:
+        with open(os.path.join(proc, "pressure", resource)) as f:
+            for line in f:
+                if line.startswith("some "):
+                    fields = dict(field.split("=", 1) for field in line.split()[1:])
+                    return float(fields["avg10"])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+class ThroughputMeter:
+    """Event bus subscriber adding up the bytes downloaded, for the controller."""
+    def __init__(self, window: float = THROUGHPUT_WINDOW):
+        self.window = window
+        self._seen: dict[str, int] = {}
+        self._chunks: deque = deque()
+        self._lock = threading.Lock()
+
+    def __call__(self, event: events.Event) -> None:
+        if event.kind not in ("download.progress", "download.finished"):
+            return
+        url = event.data.get("url")
+        size = event.data.get("bytes") or 0
+        with self._lock:
+            # Progress events carry the bytes received so far for the url
+            delta = size - self._seen.get(url, 0)
+            if event.kind == "download.finished":
+                self._seen.pop(url, None)
+                if event.data.get("cached"):
+                    return
+            else:
+                self._seen[url] = size
+            if delta > 0:
+                self._chunks.append((event.time, delta))
+
+    def add(self, size: int, now: Optional[float] = None) -> None:
+        with self._lock:
+            self._chunks.append((time.time() if now is None else now, size))
+
+    def rate(self, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        with self._lock:
+            while self._chunks and self._chunks[0][0] < now - self.window:
+                self._chunks.popleft()
+            return sum(size for _, size in self._chunks) / self.window
+
+
+class HostSampler:
+    """Reads the load, the pressure and the throughput of the meter."""
+    def __init__(self, meter: Optional[ThroughputMeter] = None, proc: str = PROC_DIR):
+        self.meter = meter or ThroughputMeter()
+        self.proc = proc
+
+    def __call__(self) -> HostSample:
+        return HostSample(read_load(self.proc), read_pressure("cpu", self.proc), read_pressure("io", self.proc), self.meter.rate())
+
+
+# ==================================================================
+# CONTROLLER
+# ==================================================================
+class ConcurrencyController:
+    """
+    Limits how many tasks run at once, between minimum and maximum, from
+    samples of the host. sampler and clock can be replaced to simulate a host.
+    """
+    def __init__(self, minimum: int = 1, maximum: Optional[int] = None, initial: Optional[int] = None,
+                 target_load: float = TARGET_LOAD, target_pressure: float = TARGET_PRESSURE,
+                 interval: float = SAMPLE_INTERVAL, sampler: Optional[Callable[[], HostSample]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum or min(32, 2 * (os.cpu_count() or 1)))
+        self.limit = min(self.maximum, max(self.minimum, initial or 4))
+        self.target_load = target_load
+        self.target_pressure = target_pressure
+        self.interval = interval
+        self.sampler = sampler or HostSampler()
+        self.clock = clock
+        self.active = 0
+        self.waiting = 0
+        # (time, limit, reason) of every change, for the report and the benchmarks
+        self.history: list[tuple[float, int, str]] = []
+        self._sampled = float("-inf")
+        self._decreased = float("-inf")
+        # (limit before, throughput before) of the last increase, checked by the next sample
+        self._probe: Optional[tuple[int, float]] = None
+        self._saturated: Optional[float] = None
+        self._condition = threading.Condition()
+
+    def __enter__(self) -> "ConcurrencyController":
+        if isinstance(self.sampler, HostSampler):
+            events.subscribe(self.sampler.meter)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if isinstance(self.sampler, HostSampler):
+            events.unsubscribe(self.sampler.meter)
+        if self.history:
+            log(f"Concurrency: {self.limit} tasks at the end, between {min(limit for _, limit, _ in self.history)}"
+                f" and {max(limit for _, limit, _ in self.history)} ({len(self.history)} changes)")
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Holds one of the slots, waiting while the limit is reached."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self) -> None:
+        with self._condition:
+            self._maybe_sample()
+            blocked = False
+            try:
+                while self.active >= self.limit:
+                    if not blocked:
+                        # Tasks waiting for a slot are what an increase would start
+                        self.waiting += 1
+                        blocked = True
+                    # Woken by a release, or to sample again while everyone waits
+                    self._condition.wait(self.interval)
+                    self._maybe_sample()
+                self.active += 1
+            finally:
+                if blocked:
+                    self.waiting -= 1
+
+    def release(self) -> None:
+        with self._condition:
+            self.active -= 1
+            self._maybe_sample()
+            self._condition.notify_all()
+
+    def _maybe_sample(self) -> None:
+        now = self.clock()
+        if now - self._sampled < self.interval:
+            return
+        self._sampled = now
+        self.adjust(self.sampler(), now)
+
+    def adjust(self, sample: HostSample, now: Optional[float] = None) -> int:
+        """Moves the limit for one sample of the host, returns it."""
+        now = self.clock() if now is None else now
+        over = self._over(sample, 1.0)
+
+        if self._probe and not over:
+            before, throughput = self._probe
+            self._probe = None
+            if throughput > 0 and sample.throughput < throughput * (1 + SATURATION_GAIN):
+                self._saturated = throughput
+                return self._set(before, "link saturated")
+        if self._saturated is not None and sample.throughput < self._saturated * HEADROOM:
+            self._saturated = None
+
+        if over:
+            self._probe = None
+            if now - self._decreased >= COOLDOWN:
+                self._decreased = now
+                return self._set(int(self.limit * DECREASE), f"over target ({over})")
+        elif self.waiting and self._saturated is None and not self._over(sample, HEADROOM):
+            if self.limit < self.maximum:
+                self._probe = (self.limit, sample.throughput)
+                return self._set(self.limit + 1, "under target")
+        return self.limit
+
+    def _over(self, sample: HostSample, share: float) -> Optional[str]:
+        if sample.load is not None and sample.load > self.target_load * share:
+            return f"load {sample.load:.2f}"
+        for name, value in (("cpu", sample.cpu_pressure), ("io", sample.io_pressure)):
+            if value is not None and value > self.target_pressure * share:
+                return f"{name} pressure {value:.0f}%"
+        return None
+
+    def _set(self, limit: int, reason: str) -> int:
+        limit = min(self.maximum, max(self.minimum, limit))
+        if limit != self.limit:
+            self.limit = limit
+            self.history.append((self.clock(), limit, reason))
+            events.publish("concurrency.changed", limit=limit, reason=reason)
+            with self._condition:
+                self._condition.notify_all()
+        return self.limit
+
+
+def lower_priority(niceness: int = NICENESS) -> None:
+    """
+    Lowers the cpu and io priority of dqs and of every command it starts
+    afterwards. Linux keeps both per thread and threads inherit them, so this
+    must run in the main thread before any pool is created.
+    """
+    current = os.getpriority(os.PRIO_PROCESS, 0)
+    if current < niceness:
+        os.setpriority(os.PRIO_PROCESS, 0, niceness)
+    try:
+        # Best effort class, lowest priority: idle could starve apt on a busy disk
+        subprocess.run(["ionice", "-c", "2", "-n", "7", "-p", str(threading.get_native_id())],
+                       capture_output=True, close_fds=True)
+    except OSError:
+        pass
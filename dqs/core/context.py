@@ -1,19 +1,35 @@
 # ==================================================================
 '''
 - TODO set yum package manager distros
-- TODO do something about get_distro_based if the distro doesn't match anything
 '''
 # ==================================================================
-import os, platform
-from typing import Any
-from dqs.utils.terminal_utils import log, error, run_command, ok
-from dqs.core.installation_methods import PKGManager, DebMethod, FlatpakMethod, HomebrewMethod
+import importlib, os, platform, shutil
+from typing import TYPE_CHECKING, Any, Optional
+from dqs.utils.terminal_utils import log, error, ok
+from dqs.core import retry, timings
+from dqs.core.state import SystemState
+
+if TYPE_CHECKING:
+    from dqs.core.installation_methods import InstallationMethod
 
 
 DEBIAN_BASED = ["debian", "ubuntu", "linuxmint", "pop", "elementary", "kali", "mx", "zorin"]
 FEDORA_BASED = ["fedora", "centos", "rhel"]
 ARCH_BASED = ["arch", "manjaro", "endeavouros"]
-# TODO !!!
+
+# Supported installation methods, imported and built on first use
+METHOD_CLASSES = {
+    "pkg_manager": "dqs.core.installation_methods:PKGManager",
+    "deb": "dqs.core.installation_methods:DebMethod",
+    "flatpak": "dqs.core.installation_methods:FlatpakMethod",
+    "homebrew": "dqs.core.installation_methods:HomebrewMethod",
+    "tarball": "dqs.core.installation_methods:TarballMethod",
+    "script": "dqs.core.installation_methods:ScriptMethod",
+}
+
+
+class UnsupportedDistroError(RuntimeError):
+    """Raised when the running distro doesn't belong to any supported family."""
 
 # ==================================================================
 # INSTALLATION CONTEXT
@@ -25,18 +41,37 @@ class InstallationContext:
     def __init__(self):
         self.distro = self.get_linux_distribution()
         self.distro_based = self.get_distro_based()
-        self.env = os.environ.copy()
-        self.results = {"completed": [], "failed": []}
-        
-        # Supported installation methods
-        self.methods = {
-            "pkg_manager": PKGManager(self),
-            "deb": DebMethod(self),
-            "flatpak": FlatpakMethod(self),
-            "homebrew": HomebrewMethod(self)
-        }
-        
+        self._env = None
+        # retries (+ mirror failovers) and seconds waited for the dpkg lock, per package id
+        self.results = {"completed": [], "failed": [], "skipped": [], "retries": {}, "lock_waits": {}}
+        # package id -> time it last failed, so retries fail fast (dqs.core.resolver)
+        self.failures: dict[str, float] = {}
+        self._state = None
+        # Optional dqs.core.downloads.Prefetcher feeding the artifacts of the plan
+        self.prefetcher = None
+        # Optional dqs.core.downloads.Prestager downloading flatpak/brew payloads ahead
+        self.prestager = None
+        self.methods: dict[str, "InstallationMethod"] = {}
+    
+    @property
+    def env(self) -> dict[str, str]:
+        """Environment for the commands, copied from os.environ the first time it's needed."""
+        if self._env is None:
+            self._env = os.environ.copy()
+        return self._env
+    
+    def get_method(self, method_name: str) -> Optional["InstallationMethod"]:
+        """Returns the installation method, building it on first use."""
+        if method_name not in self.methods:
+            target = METHOD_CLASSES.get(method_name)
+            if not target:
+                return None
+            module_name, class_name = target.split(":")
+            method_class = getattr(importlib.import_module(module_name), class_name)
+            self.methods[method_name] = method_class(self)
+        return self.methods[method_name]
     
+
     def get_linux_distribution(self) -> str :
         """
         Returns the name of the Linux distribution in lowercase.
@@ -50,47 +85,120 @@ class InstallationContext:
             return "debian"
         elif distro in FEDORA_BASED:
             return "fedora"
-        elif self.distro in ARCH_BASED:
+        elif distro in ARCH_BASED:
             return "arch"
         else:
-            raise # TODO !!!
+            raise UnsupportedDistroError(f"Unsupported distro: '{distro}'")
 
     
+    @property
+    def state(self) -> SystemState:
+        """Snapshot of the installed packages, collected once on first use."""
+        if self._state is None:
+            self._state = SystemState(self.distro_based, self.env)
+        return self._state
+    
+    def is_satisfied(self, pkg_data: dict[str, Any], method_name: str) -> bool:
+        """Checks if the package is already installed through the given method."""
+        method = self.get_method(method_name)
+        return bool(method) and method.is_installed(pkg_data, method_name)
+    
     def add_to_path(self, new_path: str) -> None:
         """Adds a new path to the system PATH environment variable."""
         current_path = self.env.get("PATH", "")
         if new_path not in current_path:
             self.env["PATH"] = f"{new_path}{os.pathsep}{current_path}"
     
+    def prepare_method(self, method_name: str):
+        """Returns the installation method ready to be used, or None if it can't be used."""
+        method = self.get_method(method_name)
+        if not method:
+            error(f"Method: '{method_name}', not found.")
+            return None
+
+        # Runs the setup only the first time, concurrent callers share it
+        if not method.ensure_ready():
+            return None
+        
+        return method
+    
     def install_package(self, pkg_data: dict[str, any], method_name: str) -> bool:
         """Installs a package using the specified installation method."""
-        method = self.methods.get(method_name)
+        pkg_id = pkg_data.get("id", "unknown")
+        if self.is_satisfied(pkg_data, method_name):
+            ok(f"Package: '{pkg_id}' is already installed, skipping.")
+            self.results["skipped"].append(pkg_id)
+            return True
+        
+        with timings.phase("setup"):
+            method = self.prepare_method(method_name)
         if not method:
-            error(f"Method: '{method_name}', not found.")
             return False
-
-        # Check if setup is required
-        if method.requires_setup():
-            log(f"Setting up method: '{method_name}'...")
-            if not method.setup():
-                error(f"Setup for method: '{method_name}' failed.")
-                return False
         
         # Install the package
         log(f"Installing package: '{pkg_data.get('name')}' using method: '{method_name}'...")
         
-        pkg_id = pkg_data.get("id", "unknown")
-        
-        success = method.install(pkg_data)
+        with timings.phase("install"), retry.tracking() as counters:
+            success = method.install(pkg_data)
+        self._record_waits([pkg_id], counters)
         
         if success:
             self.results["completed"].append(pkg_id)
+            with timings.phase("post_install"):
+                for ref in method.package_refs(pkg_data):
+                    self.state.mark_installed(ref, method_name)
         else:
             self.results["failed"].append(pkg_id)
             return False
         
         return success
     
+    def install_packages(self, pkgs: list[dict[str, Any]], method_name: str) -> bool:
+        """Installs several packages with one method, batching them when the method allows it."""
+        pending, skipped = [], []
+        for pkg_data in pkgs:
+            if self.is_satisfied(pkg_data, method_name):
+                skipped.append(pkg_data.get("id", "unknown"))
+            else:
+                pending.append(pkg_data)
+        if skipped:
+            ok(f"Already installed, skipping: {', '.join(skipped)}")
+            self.results["skipped"].extend(skipped)
+        
+        pkgs = pending
+        if not pkgs:
+            return True
+        
+        pkg_ids = [pkg_data.get("id", "unknown") for pkg_data in pkgs]
+        with timings.phase("setup"):
+            method = self.prepare_method(method_name)
+        if not method:
+            self.results["failed"].extend(pkg_ids)
+            return False
+        
+        log(f"Installing {len(pkgs)} packages using method: '{method_name}': {', '.join(pkg_ids)}")
+        
+        with timings.phase("install"), retry.tracking() as counters:
+            batch_results = method.install_many(pkgs)
+        # One transaction: every package of the batch waited the same
+        self._record_waits(pkg_ids, counters)
+        self.results["completed"].extend(batch_results["completed"])
+        with timings.phase("post_install"):
+            for pkg_data in pkgs:
+                if pkg_data.get("id", "unknown") in batch_results["completed"]:
+                    for ref in method.package_refs(pkg_data):
+                        self.state.mark_installed(ref, method_name)
+        self.results["failed"].extend(batch_results["failed"])
+        
+        return not batch_results["failed"]
+    
+    def _record_waits(self, pkg_ids: list[str], counters: retry.Counters) -> None:
+        for pkg_id in pkg_ids:
+            if counters.retries or counters.failovers:
+                self.results["retries"][pkg_id] = counters.retries + counters.failovers
+            if counters.lock_waits:
+                self.results["lock_waits"][pkg_id] = round(counters.lock_wait_seconds, 1)
+    
     def is_command_available(self, command: str) -> bool:
         """Checks if a command is available in the system PATH."""
-        return run_command(f"command -v {command}")
\ No newline at end of file
+        return shutil.which(command, path=self.env.get("PATH")) is not None
\ No newline at end of file
@@ -0,0 +1,182 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Callable, Iterable, Iterator, Optional, Sequence
+
+from dqs.core import events, retry
+from dqs.core.cache import DOWNLOAD_TIMEOUT, ArtifactCache
+from dqs.utils.terminal_utils import execute, log, ok, error
+
+CHUNK_SIZE = 1024 * 256
+USER_AGENT = "dqs"
+
+# ==================================================================
+# PLAIN DOWNLOADS
+# ==================================================================
+def fetch(url: str, dest: str, mirrors: Iterable[str] = ()) -> bool:
+    """
+    Downloads url into dest, retrying transient errors and then trying the
+    mirrors. The file only shows up in dest once it's complete.
+    """
+    import http.client
+    import urllib.request
+
+    def download(source: str) -> None:
+        request = urllib.request.Request(source, headers={"User-Agent": USER_AGENT})
+        with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response, open(part, "wb") as f:
+            shutil.copyfileobj(response, f, CHUNK_SIZE)
+
+    part = f"{dest}.part"
+    failure = None
+    for index, source in enumerate(dict.fromkeys([url, *mirrors])):
+        if index:
+            retry.failover(url, source)
+        try:
+            retry.call(lambda: download(source), f"Download of {source}")
+            os.replace(part, dest)
+            return True
+        except (OSError, http.client.HTTPException) as e:
+            failure = e
+    error(f"Download failed: {url}: {failure}")
+    if os.path.exists(part):
+        os.remove(part)
+    return False
+
+
+def artifact_name(url: str) -> str:
+    """File name used to store the artifact of url."""
+    name = os.path.basename(url.split("?", 1)[0]) or "artifact"
+    return f"{hashlib.sha1(url.encode()).hexdigest()[:12]}-{name}"
+
+
+# ==================================================================
+# PREFETCH PIPELINE
+# ==================================================================
+class Prefetcher:
+    """
+    Starts downloading every artifact of the plan right away, with bounded
+    concurrency, so installers find them ready (or already on the way) when
+    their turn comes instead of keeping the network idle while apt works.
+    Artifacts land in the persistent ArtifactCache, so reruns only revalidate.
+    """
+    def __init__(self, cache: Optional[ArtifactCache] = None, max_workers: int = 3):
+        self.cache = cache or ArtifactCache()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._futures: dict[str, Future] = {}
+
+    def start(self, urls: Iterable[str], suffix: str = "", mirrors: Optional[dict[str, Iterable[str]]] = None,
+              checksums: Optional[dict[str, str]] = None) -> None:
+        """Queues the given urls for download (duplicates are fetched once), with their mirrors and sha256 if any."""
+        mirrors = mirrors or {}
+        checksums = checksums or {}
+        for url in urls:
+            if url and url not in self._futures:
+                self._futures[url] = self._pool.submit(self._download, url, suffix, tuple(mirrors.get(url, ())), checksums.get(url))
+
+    def get(self, url: str, timeout: Optional[float] = None, suffix: str = "", mirrors: Iterable[str] = (),
+            sha256: Optional[str] = None) -> Optional[str]:
+        """Waits for the artifact of url and returns its path, None if the download failed."""
+        if url not in self._futures:
+            self.start([url], suffix, {url: mirrors}, {url: sha256} if sha256 else None)
+        return self._futures[url].result(timeout=timeout)
+
+    def completed(self) -> Iterator[tuple[str, Optional[str]]]:
+        """Yields (url, path) pairs in the order the downloads finish."""
+        urls = {future: url for url, future in self._futures.items()}
+        for future in as_completed(urls):
+            yield urls[future], future.result()
+
+    def shutdown(self) -> None:
+        """Stops the pending downloads."""
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def _download(self, url: str, suffix: str, mirrors: tuple[str, ...], sha256: Optional[str]) -> Optional[str]:
+        log(f"Prefetching: {url}")
+        path = self.cache.fetch(url, suffix, mirrors, sha256)
+        if path:
+            ok(f"Prefetched: {url}")
+        return path
+
+
+# ==================================================================
+# PRE-STAGING
+# ==================================================================
+class Prestager:
+    """
+    Runs the download half of flatpak/brew installs (flatpak install
+    --no-deploy, brew fetch) in the background as soon as the method is set
+    up, one job per method, while apt keeps the dpkg lock busy. The install
+    that comes later waits for its method's job and then only deploys from
+    the local cache. A failed job is harmless, the install downloads what is
+    missing as usual.
+    """
+    def __init__(self):
+        self._jobs: dict[str, Future] = {}
+        self._pool = ThreadPoolExecutor(thread_name_prefix="prestage")
+        self._lock = threading.Lock()
+        # name -> [start, end, first time an install had to wait for it] (monotonic)
+        self.stats: dict[str, list[Optional[float]]] = {}
+
+    def start(self, name: str, argv: Sequence[str], env: Optional[dict[str, str]] = None,
+              ready: Optional[Callable[[], bool]] = None) -> None:
+        """
+        Starts the job of name (a method) unless it was already started.
+        ready, if given, runs first in the job (the method setup), a False
+        skips the download.
+        """
+        with self._lock:
+            if name not in self._jobs:
+                self.stats[name] = [time.monotonic(), None, None]
+                self._jobs[name] = self._pool.submit(self._run, name, list(argv), env, ready)
+
+    def wait(self, name: str) -> None:
+        """Blocks until the job of name, if any, is done."""
+        job = self._jobs.get(name)
+        if job is None:
+            return
+        if not job.done():
+            with self._lock:
+                stats = self.stats[name]
+                stats[2] = stats[2] or time.monotonic()
+        job.result()
+
+    def seconds(self) -> float:
+        """Seconds the jobs took, added up."""
+        with self._lock:
+            return sum(end - start for start, end, _ in self.stats.values() if end)
+
+    def hidden(self) -> float:
+        """
+        Seconds of pre-staging that overlapped other work: everything before
+        the first install of the method had to wait for its job. Installs
+        waiting at once for the same job count once.
+        """
+        with self._lock:
+            return sum(min(waited or end, end) - start for start, end, waited in self.stats.values() if end)
+
+    def shutdown(self) -> None:
+        """Waits for the jobs still running."""
+        self._pool.shutdown(wait=True)
+
+    def _run(self, name: str, argv: list[str], env: Optional[dict[str, str]], ready: Optional[Callable[[], bool]]) -> bool:
+        start = time.monotonic()
+        if ready and not ready():
+            with self._lock:
+                self.stats[name][1] = time.monotonic()
+            return False
+        log(f"Pre-staging {name} downloads: {' '.join(argv)}")
+        # Quiet, its output would interleave with the installs running meanwhile
+        result = execute(argv, env=env, echo=False)
+        end = time.monotonic()
+        seconds = end - start
+        with self._lock:
+            self.stats[name][1] = end
+        events.publish("prestage.finished", method=name, seconds=round(seconds, 3), success=result.success)
+        if result.success:
+            ok(f"Pre-staged {name} downloads ({seconds:.1f}s)")
+        else:
+            log(f"Pre-staging {name} failed (code {result.returncode}), its installs will download it themselves")
+        return result.success
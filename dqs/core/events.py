@@ -0,0 +1,261 @@
+import json
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import IO, Any, Callable, Iterator, Optional
+
+from dqs.utils import terminal_utils
+
+# ==================================================================
+'''
+EVENT BUS:
+publish() appends the event to a deque and returns. That is one atomic
+append: no lock, no I/O and no subscriber code runs in the publishing thread,
+so workers and the subprocess readers never wait on an observer. A
+dispatcher thread drains the queue every DISPATCH_INTERVAL and hands the
+events to the subscribers, a slow subscriber only delays the others.
+Nothing is queued while nobody is subscribed.
+Events (plus "task", the task of the publishing thread, when there is one):
+- run.started       total, workers          run.finished   completed, failed
+- task.queued       task                    task.started   task
+- task.finished     task, status (completed, failed, resumed, cancelled), seconds
+- task.output       task, line     (rate limited, latest line of its commands)
+- message           level (log, ok, error), text
+- command.finished  command, returncode, seconds
+- download.started  url            download.progress  url, bytes, total (rate limited)
+- download.finished url, bytes, seconds, cached
+- download.retry    what, error, delay
+- lock.waiting      path           lock.acquired  seconds, timed_out
+- prestage.finished method, seconds, success
+- concurrency.changed limit, reason
+'''
+# ==================================================================
+DISPATCH_INTERVAL = 0.05
+# Seconds between two rate limited events with the same key
+PROGRESS_INTERVAL = 0.25
+
+
+@dataclass(slots=True)
+class Event:
+    kind: str
+    time: float
+    data: dict[str, Any] = field(default_factory=dict)
+
+
+_queue: deque = deque()
+_subscribers: list[Callable[[Event], None]] = []
+_local = threading.local()
+_last_progress: dict[str, float] = {}
+_dispatch_lock = threading.Lock()
+_dispatcher: Optional[threading.Thread] = None
+
+
+def publish(kind: str, **data: Any) -> None:
+    """Queues an event for the subscribers, never blocks."""
+    if not _subscribers:
+        return
+    task = getattr(_local, "task", None)
+    if task is not None:
+        data.setdefault("task", task)
+    # Nothing is rate limited anymore for a task or download that ended
+    if kind == "task.finished":
+        _last_progress.pop(f"output:{data.get('task')}", None)
+    elif kind == "download.finished":
+        _last_progress.pop(data.get("url"), None)
+    _queue.append(Event(kind, time.time(), data))
+
+
+def progress(key: str, kind: str, **data: Any) -> None:
+    """publish(), at most once per PROGRESS_INTERVAL for the same key."""
+    if not _subscribers:
+        return
+    now = time.monotonic()
+    # Racy on purpose, an extra progress event is harmless
+    if now - _last_progress.get(key, 0.0) >= PROGRESS_INTERVAL:
+        _last_progress[key] = now
+        publish(kind, **data)
+
+
+@contextmanager
+def running(task: str) -> Iterator[None]:
+    """Attributes the events published by this thread inside the block to task."""
+    previous, _local.task = getattr(_local, "task", None), task
+    try:
+        yield
+    finally:
+        _local.task = previous
+
+
+def subscribe(callback: Callable[[Event], None]) -> None:
+    """Calls callback with every event from now on, from the dispatcher thread."""
+    global _dispatcher
+    with _dispatch_lock:
+        if _on_message not in terminal_utils.MESSAGE_LISTENERS:
+            terminal_utils.MESSAGE_LISTENERS.append(_on_message)
+            terminal_utils.COMMAND_LISTENERS.append(_on_command)
+        _subscribers.append(callback)
+        if _dispatcher is None:
+            _dispatcher = threading.Thread(target=_dispatch_loop, name="events", daemon=True)
+            _dispatcher.start()
+
+
+def unsubscribe(callback: Callable[[Event], None]) -> None:
+    """Delivers what is still queued and stops calling callback."""
+    flush()
+    with _dispatch_lock:
+        if callback in _subscribers:
+            _subscribers.remove(callback)
+
+
+def flush() -> None:
+    """Delivers every queued event now, in the calling thread."""
+    with _dispatch_lock:
+        while _queue:
+            event = _queue.popleft()
+            for callback in list(_subscribers):
+                try:
+                    callback(event)
+                except Exception:
+                    # An observer must never take the run down
+                    pass
+
+
+def _dispatch_loop() -> None:
+    while True:
+        time.sleep(DISPATCH_INTERVAL)
+        if _queue:
+            flush()
+
+
+def _on_message(level: str, text: str) -> None:
+    if level == "output":
+        task = getattr(_local, "task", None)
+        progress(f"output:{task}", "task.output", line=text)
+    else:
+        publish("message", level=level, text=text)
+
+
+def _on_command(result: terminal_utils.CommandResult) -> None:
+    publish("command.finished", command=result.command, returncode=result.returncode, seconds=round(result.duration, 3))
+
+
+# ==================================================================
+# SUBSCRIBERS
+# ==================================================================
+class JsonLog:
+    """Compact JSON log of the run, one line per event. Rate limited events are left out."""
+    SKIPPED = {"task.output", "download.progress"}
+
+    def __init__(self, path: str):
+        self._file: IO[str] = sys.stdout if path == "-" else open(path, "a")
+
+    def __call__(self, event: Event) -> None:
+        if event.kind in self.SKIPPED:
+            return
+        self._file.write(json.dumps({"t": round(event.time, 3), "e": event.kind, **event.data}, separators=(",", ":"), ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+@dataclass
+class DownloadProgress:
+    url: str
+    start: float
+    bytes: int = 0
+    total: Optional[int] = None
+
+    def throughput(self, now: float) -> float:
+        """Bytes per second since the download started."""
+        return self.bytes / max(now - self.start, 1e-6)
+
+    def eta(self, now: float) -> Optional[float]:
+        rate = self.throughput(now)
+        if not self.total or not rate:
+            return None
+        return max(self.total - self.bytes, 0) / rate
+
+
+class Tracker:
+    """Live state of the run built from the events, read by the dashboard from another thread."""
+
+    def __init__(self, max_messages: int = 500):
+        self.start = time.time()
+        self.total = 0
+        self.workers = 0
+        self.queued: set[str] = set()
+        # task -> [start, latest output line]
+        self.running: dict[str, list[Any]] = {}
+        self.finished: dict[str, str] = {}
+        self.downloads: dict[str, DownloadProgress] = {}
+        self.lock_waiting: dict[str, float] = {}
+        # (sequence number, level, text)
+        self.messages: deque = deque(maxlen=max_messages)
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Event) -> None:
+        data = event.data
+        with self._lock:
+            if event.kind == "run.started":
+                self.start = event.time
+                self.total += data.get("total", 0)
+                self.workers = data.get("workers", self.workers)
+            elif event.kind == "task.queued":
+                self.queued.add(data["task"])
+            elif event.kind == "task.started":
+                self.queued.discard(data["task"])
+                self.running[data["task"]] = [event.time, ""]
+            elif event.kind == "task.output":
+                if data.get("task") in self.running:
+                    self.running[data["task"]][1] = data["line"]
+            elif event.kind == "task.finished":
+                self.queued.discard(data["task"])
+                self.running.pop(data["task"], None)
+                self.finished[data["task"]] = data["status"]
+            elif event.kind == "download.started":
+                self.downloads[data["url"]] = DownloadProgress(data["url"], event.time)
+            elif event.kind == "download.progress":
+                download = self.downloads.setdefault(data["url"], DownloadProgress(data["url"], event.time))
+                download.bytes, download.total = data["bytes"], data.get("total")
+            elif event.kind == "download.finished":
+                self.downloads.pop(data["url"], None)
+            elif event.kind == "lock.waiting":
+                self.lock_waiting[data.get("task") or data["path"]] = event.time
+            elif event.kind == "lock.acquired":
+                self.lock_waiting.pop(data.get("task") or data.get("path", ""), None)
+            elif event.kind == "message":
+                self._sequence += 1
+                self.messages.append((self._sequence, data["level"], data["text"]))
+
+    def eta(self, now: Optional[float] = None) -> Optional[float]:
+        """Seconds left at the rate tasks have been finishing so far."""
+        now = now or time.time()
+        done = len(self.finished)
+        remaining = self.total - done
+        if not done or remaining <= 0:
+            return None
+        return remaining / (done / max(now - self.start, 1e-6))
+
+    def snapshot(self, since: int = 0) -> dict[str, Any]:
+        """Consistent copy of the state, with the messages after sequence number since."""
+        now = time.time()
+        with self._lock:
+            statuses = list(self.finished.values())
+            return {
+                "elapsed": now - self.start,
+                "total": self.total,
+                "done": len(statuses),
+                "failed": statuses.count("failed") + statuses.count("cancelled"),
+                "queued": len(self.queued),
+                "running": [(task, now - start, line) for task, (start, line) in sorted(self.running.items(), key=lambda item: item[1][0])],
+                "downloads": [(d.url, d.bytes, d.total, d.throughput(now), d.eta(now)) for d in self.downloads.values()],
+                "lock_waiting": [(who, now - since_time) for who, since_time in self.lock_waiting.items()],
+                "eta": self.eta(now),
+                "messages": [message for message in self.messages if message[0] > since],
+            }
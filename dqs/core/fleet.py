@@ -0,0 +1,221 @@
+import shlex
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from dqs.core.catalog import Catalog
+from dqs.core.repositories import repository_command
+from dqs.utils.terminal_utils import CommandResult, execute, log, ok, error
+
+# ==================================================================
+'''
+FLEET MODE:
+The plan is resolved once on this machine into an ordered list of shell
+steps (repositories, one apt refresh, then every package), and each host of
+the inventory runs it through a Transport, with a bounded number of hosts in
+flight. Inventory files have one host per line:
+- user@host[:port]   -> SSH
+- local              -> this machine, through a plain subprocess
+- chroot:/path       -> a chroot on this machine
+Lines starting with # are ignored.
+'''
+# ==================================================================
+REFRESH_STEP = "apt-refresh"
+TOOLS_STEP = "repository-tools"
+# Adding a repository needs curl and gpg, which a fresh host may not have yet
+TOOLS_COMMAND = ("command -v curl > /dev/null && command -v gpg > /dev/null"
+                 " || (sudo apt-get update && sudo apt-get install -y curl gpg ca-certificates)")
+
+
+# ==================================================================
+# TRANSPORTS
+# ==================================================================
+class Transport(ABC):
+    """Runs shell commands on one host."""
+    def __init__(self, name: str):
+        self.name = name
+
+    @abstractmethod
+    def run(self, command: str, timeout: Optional[float] = None) -> CommandResult:
+        pass
+
+
+class SSHTransport(Transport):
+    SSH_OPTIONS = ["-o", "BatchMode=yes", "-o", "ConnectTimeout=15"]
+
+    def __init__(self, target: str):
+        super().__init__(target)
+        self.port = None
+        if ":" in target:
+            target, port = target.rsplit(":", 1)
+            self.port = port
+        self.target = target
+
+    def run(self, command: str, timeout: Optional[float] = None) -> CommandResult:
+        argv = ["ssh", *self.SSH_OPTIONS]
+        if self.port:
+            argv += ["-p", self.port]
+        argv += [self.target, command]
+        return execute(argv, timeout=timeout, echo=False)
+
+
+class LocalTransport(Transport):
+    """This machine, or a chroot on it when root is given (handy for tests)."""
+    def __init__(self, root: Optional[str] = None):
+        super().__init__(f"chroot:{root}" if root else "local")
+        self.root = root
+
+    def run(self, command: str, timeout: Optional[float] = None) -> CommandResult:
+        if self.root:
+            return execute(["sudo", "chroot", self.root, "/bin/sh", "-c", command], timeout=timeout, echo=False)
+        return execute(command, timeout=timeout, echo=False)
+
+
+def transport_for(spec: str) -> Transport:
+    if spec == "local":
+        return LocalTransport()
+    if spec.startswith("chroot:"):
+        return LocalTransport(spec[len("chroot:"):])
+    return SSHTransport(spec)
+
+
+def read_inventory(path: str) -> list[Transport]:
+    transports = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                transports.append(transport_for(line))
+    return transports
+
+
+# ==================================================================
+# PLAN
+# ==================================================================
+@dataclass
+class Step:
+    id: str
+    command: str
+    requires: list[str] = field(default_factory=list)
+    # Backend package name, used to skip it when the host already has it
+    apt_package: Optional[str] = None
+
+
+def build_steps(catalog: Catalog, targets: list[str]) -> list[Step]:
+    """Ordered shell steps to provision a Debian host with the given packages."""
+    pkg_ids = catalog.plan(targets)
+    steps: list[Step] = []
+
+    repos = []
+    for pkg_id in pkg_ids:
+        for req in catalog.packages[pkg_id].spec().requires:
+            special = catalog.special_requirements.get(req)
+            if special and special.repository and req not in repos:
+                repos.append(req)
+    if repos:
+        steps.append(Step(TOOLS_STEP, TOOLS_COMMAND))
+    for repo_id in repos:
+        steps.append(Step(repo_id, repository_command(catalog.special_requirements[repo_id].repository), [TOOLS_STEP]))
+    steps.append(Step(REFRESH_STEP, "sudo apt-get update", list(repos)))
+
+    for pkg_id in pkg_ids:
+        pkg = catalog.packages[pkg_id]
+        spec = pkg.spec()
+        if not spec.command:
+            continue
+        command = spec.command
+        for req in spec.requires:
+            special = catalog.special_requirements.get(req)
+            if special and special.binary_path:
+                command = f'export PATH="{special.binary_path}:$PATH"; {command}'
+        requires = [req for req in spec.requires if req in catalog.packages or req in repos] + [REFRESH_STEP]
+        apt_package = (spec.package or pkg_id) if pkg.default_method == "apt" else None
+        steps.append(Step(pkg_id, command, requires, apt_package))
+    return steps
+
+
+# ==================================================================
+# RUNNER
+# ==================================================================
+class FleetRunner:
+    """Runs the same plan on many hosts concurrently."""
+    def __init__(self, transports: list[Transport], max_hosts: int = 8, timeout: Optional[float] = None):
+        names = [transport.name for transport in transports]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"Duplicated hosts in the inventory: {', '.join(duplicates)}")
+        self.transports = transports
+        self.max_hosts = max_hosts
+        self.timeout = timeout
+        # Same shape as InstallationContext.results, plus the per host breakdown
+        self.results: dict[str, Any] = {"completed": [], "failed": [], "skipped": [], "hosts": {}}
+        self._lock = threading.Lock()
+
+    def run(self, steps: list[Step]) -> dict[str, Any]:
+        with ThreadPoolExecutor(max_workers=self.max_hosts, thread_name_prefix="fleet") as pool:
+            list(pool.map(lambda transport: self._run_host(transport, steps), self.transports))
+
+        hosts = self.results["hosts"].values()
+        package_steps = [step.id for step in steps if step.id not in (REFRESH_STEP, TOOLS_STEP)]
+        for step_id in package_steps:
+            if any(step_id in host["failed"] for host in hosts):
+                self.results["failed"].append(step_id)
+            elif all(step_id in host["skipped"] for host in hosts):
+                self.results["skipped"].append(step_id)
+            else:
+                self.results["completed"].append(step_id)
+        return self.results
+
+    def by_package(self) -> dict[str, dict[str, list[str]]]:
+        """step id -> {"completed": [hosts], "failed": [hosts], "skipped": [hosts]}"""
+        packages: dict[str, dict[str, list[str]]] = {}
+        for host, results in self.results["hosts"].items():
+            for outcome in ("completed", "failed", "skipped"):
+                for step_id in results[outcome]:
+                    packages.setdefault(step_id, {"completed": [], "failed": [], "skipped": []})[outcome].append(host)
+        return packages
+
+    def _installed(self, transport: Transport, steps: list[Step]) -> set[str]:
+        # One round trip per host instead of one probe per package, printed on
+        # a single line so it fits in the kept output tail
+        names = [step.apt_package for step in steps if step.apt_package]
+        if not names:
+            return set()
+        query = (f"dpkg-query -W -f='${{db:Status-Abbrev}} ${{Package}}\\n' {' '.join(map(shlex.quote, names))} 2>/dev/null"
+                 " | awk '/^ii/ {printf \"%s \", $2}'; echo")
+        result = transport.run(query, timeout=self.timeout)
+        return {name for line in result.tail for name in line.split()}
+
+    def _run_host(self, transport: Transport, steps: list[Step]) -> None:
+        host = transport.name
+        results = {"completed": [], "failed": [], "skipped": [], "errors": {}}
+        with self._lock:
+            self.results["hosts"][host] = results
+
+        log(f"[{host}] Starting {len(steps)} steps")
+        installed = self._installed(transport, steps)
+        done: set[str] = set()
+        for step in steps:
+            if any(req not in done for req in step.requires):
+                results["failed"].append(step.id)
+                continue
+            if step.apt_package and step.apt_package in installed:
+                results["skipped"].append(step.id)
+                done.add(step.id)
+                continue
+
+            result = transport.run(step.command, timeout=self.timeout)
+            if result.success:
+                results["completed"].append(step.id)
+                done.add(step.id)
+            else:
+                results["failed"].append(step.id)
+                results["errors"][step.id] = list(result.tail)[-5:]
+                error(f"[{host}] {step.id} failed (exit code {result.returncode})")
+
+        if results["failed"]:
+            error(f"[{host}] Finished with {len(results['failed'])} failed steps")
+        else:
+            ok(f"[{host}] Finished")
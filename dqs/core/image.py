@@ -0,0 +1,289 @@
+import hashlib
+import json
+import os
+import re
+import shlex
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+from dqs.core.catalog import Catalog, load_catalog
+from dqs.core.repositories import repository_command
+from dqs.utils.terminal_utils import ok
+
+# ==================================================================
+'''
+IMAGE BUILDS:
+A profile baked into a container or VM image is split into layers ordered
+from the entries that change least to the ones that change most, so bumping
+one version only rebuilds the layers from that entry on:
+- apt          -> every plain apt package, one transaction
+- repositories -> extra apt sources and the packages that come from them
+- flatpak      -> flathub apps
+- scripts      -> upstream installer scripts (rclone)
+- homebrew     -> the Homebrew installer and the formulas, as BUILD_USER:
+                  Homebrew refuses to install as root
+- downloads    -> .debs and tarballs whose url doesn't name a version
+- <id>         -> one layer per version-pinned download, last
+Each layer is one transaction and cleans up its own caches, so they never
+reach the image. The same layers come out as a Dockerfile or as numbered
+shell stages for other image builders, with a cache key per stage.
+'''
+# ==================================================================
+DEFAULT_BASE = "debian:stable-slim"
+# Every later layer downloads something
+BASE_TOOLS = ("ca-certificates", "curl", "gpg")
+DOWNLOAD_DIR = "/tmp/dqs"
+# System wide counterparts of paths.OPT_DIR and paths.BIN_DIR, images have no user yet
+OPT_DIR = "/opt"
+BIN_DIR = "/usr/local/bin"
+FLATHUB = "https://dl.flathub.org/repo/flathub.flatpakrepo"
+STAGES_MANIFEST = "stages.json"
+# Created in the apt layer, with passwordless sudo, for what refuses to run as root
+BUILD_USER = "linuxbrew"
+# Installer scripts that refuse root -> the layer they go in, which runs as BUILD_USER
+NON_ROOT = {"homebrew": "homebrew"}
+
+APT_INSTALL = "apt-get install -y --no-install-recommends"
+APT_CLEANUP = "apt-get clean && rm -rf /var/lib/apt/lists/*"
+# Least volatile first, pinned downloads get a layer each after these
+LAYERS = ("apt", "repositories", "flatpak", "scripts", "homebrew", "downloads")
+
+# A version in the url path (v1.9.14, 27.0.9...), the query is not looked at
+_VERSION = re.compile(r"\d+\.\d+")
+# Build steps run as root, sudo may not even be there
+_SUDO = re.compile(r"(^|&&\s*|\|\|\s*|\|\s*|;\s*)sudo\s+")
+
+
+@dataclass
+class Layer:
+    name: str
+    packages: list[str] = field(default_factory=list)
+    # Ids of the repository_setup requirements added by this layer
+    repositories: list[str] = field(default_factory=list)
+    # Directories added to PATH for this layer and every later one
+    path: list[str] = field(default_factory=list)
+    steps: list[str] = field(default_factory=list)
+    # Runs as this user instead of root
+    user: Optional[str] = None
+
+    def describe(self) -> str:
+        return f"{self.name}: {', '.join(self.repositories + self.packages)}"
+
+
+def _as_root(command: str) -> str:
+    return _SUDO.sub(r"\1", command.strip())
+
+
+def is_pinned(url: str) -> bool:
+    """True when the url names one version, so every release bump changes it."""
+    return bool(_VERSION.search(url.split("?", 1)[0]))
+
+
+def _fetch(url: str, mirrors: Iterable[str], sha256: Optional[str], path: str) -> list[str]:
+    fetches = [f"curl -fsSL --retry 3 -o {path} {shlex.quote(source)}" for source in (url, *mirrors)]
+    steps = [fetches[0] if len(fetches) == 1 else "{ " + " || ".join(fetches) + "; }"]
+    if sha256:
+        steps.append(f"echo '{sha256}  {path}' | sha256sum -c -")
+    return steps
+
+
+# ==================================================================
+# PLAN
+# ==================================================================
+def plan_layers(catalog: Catalog, targets: list[str]) -> list[Layer]:
+    """Layers installing the targets and what they need, least volatile first."""
+    pkg_ids = catalog.plan(targets)
+    kinds: dict[str, str] = {}
+    repos: list[str] = []
+    for pkg_id in pkg_ids:
+        pkg = catalog.packages[pkg_id]
+        spec = pkg.spec()
+        method = pkg.default_method
+        needed = [req for req in spec.requires if (special := catalog.special_requirements.get(req)) and special.repository]
+        repos += [req for req in needed if req not in repos]
+        if method == "apt":
+            kinds[pkg_id] = "repositories" if needed else "apt"
+        elif method == "script":
+            kinds[pkg_id] = NON_ROOT.get(pkg_id, "scripts")
+        elif method in ("deb", "tarball"):
+            kinds[pkg_id] = pkg_id if spec.sha256 or is_pinned(spec.url or "") else "downloads"
+        else:
+            kinds[pkg_id] = method
+
+    pinned = sorted(kind for kind in set(kinds.values()) if kind not in LAYERS)
+    order = {kind: i for i, kind in enumerate((*LAYERS, *pinned))}
+    # A package never goes before something it requires
+    for pkg_id in pkg_ids:
+        requires = [kinds[req] for req in catalog.packages[pkg_id].spec().requires if req in kinds]
+        kinds[pkg_id] = max([kinds[pkg_id], *requires], key=order.__getitem__)
+
+    layers = {kind: Layer(kind) for kind in order}
+    for pkg_id in pkg_ids:
+        layers[kinds[pkg_id]].packages.append(pkg_id)
+    for name in set(NON_ROOT.values()):
+        if layers[name].packages:
+            layers[name].user = BUILD_USER
+    needs_user = any(layer.user for layer in layers.values())
+    base_tools = (*BASE_TOOLS, "sudo") if needs_user else BASE_TOOLS
+    layers["apt"].packages[:0] = [tool for tool in base_tools if tool not in layers["apt"].packages]
+    # Every source goes in early, also the ones only a download needs
+    layers["repositories"].repositories = repos
+
+    result = []
+    for layer in layers.values():
+        if layer.packages or layer.repositories:
+            _render(catalog, layer)
+            result.append(layer)
+    if needs_user:
+        layers["apt"].steps += [f"useradd -m -s /bin/bash {BUILD_USER}",
+                                f"echo '{BUILD_USER} ALL=(ALL) NOPASSWD:ALL' > /etc/sudoers.d/{BUILD_USER}"]
+    return result
+
+
+def _render(catalog: Catalog, layer: Layer) -> None:
+    apt: list[str] = []
+    debs: list[str] = []
+    refs: list[str] = []
+    formulas: list[str] = []
+    steps: list[str] = []
+    downloads = False
+
+    for pkg_id in layer.packages:
+        pkg = catalog.packages.get(pkg_id)
+        if not pkg:
+            # One of BASE_TOOLS
+            apt.append(pkg_id)
+            continue
+        spec = pkg.spec()
+        for req in spec.requires:
+            special = catalog.special_requirements.get(req)
+            if special and special.binary_path:
+                # Entries naming the user ($USER, ~) mean nothing while building an image
+                layer.path += [path for path in special.binary_path.split(":")
+                               if path not in layer.path and "$" not in path and "~" not in path]
+
+        if pkg.default_method == "apt":
+            apt.append(spec.package or pkg_id)
+        elif pkg.default_method == "flatpak":
+            refs.extend(spec.packages or [spec.package or pkg_id])
+        elif pkg.default_method == "homebrew":
+            formulas.append(spec.package or pkg_id)
+        elif pkg.default_method == "deb":
+            path, downloads = f"{DOWNLOAD_DIR}/{pkg_id}.deb", True
+            steps += _fetch(spec.url, spec.mirrors, spec.sha256, path)
+            debs.append(path)
+        elif pkg.default_method == "tarball":
+            # Like extract_tarball, without the single top directory most archives wrap everything in
+            path, dest, downloads = f"{DOWNLOAD_DIR}/{pkg_id}.tar", f"{OPT_DIR}/{pkg_id}", True
+            steps += _fetch(spec.url, spec.mirrors, spec.sha256, path)
+            steps += [f"mkdir -p {dest}", f"tar -xf {path} --strip-components=1 -C {dest}",
+                      f"{{ find {dest} {dest}/bin -maxdepth 1 -type f -perm -u+x ! -name '*.so*'"
+                      f" -exec ln -sf {{}} {BIN_DIR}/ \\; 2>/dev/null || true; }}"]
+        elif spec.command:
+            steps.append(_as_root(spec.command))
+
+    if downloads:
+        steps.insert(0, f"mkdir -p {DOWNLOAD_DIR}")
+    # Sources first, then everything apt installs in a single transaction
+    steps[:0] = [_as_root(repository_command(catalog.special_requirements[repo_id].repository)) for repo_id in layer.repositories]
+    if apt or debs:
+        steps.append("apt-get update")
+        steps.append(f"{APT_INSTALL} {' '.join(map(shlex.quote, apt + debs))}")
+        steps.append(APT_CLEANUP)
+    if refs:
+        steps.append(f"flatpak remote-add --if-not-exists flathub {FLATHUB}")
+        steps.append(f"flatpak install -y --noninteractive flathub {' '.join(map(shlex.quote, refs))}")
+        steps.append("rm -rf /var/tmp/flatpak-cache-*")
+    if formulas:
+        steps.append(f"brew install {' '.join(map(shlex.quote, formulas))}")
+        steps.append('brew cleanup --prune=all && rm -rf "$(brew --cache)"')
+    if downloads:
+        steps.append(f"rm -rf {DOWNLOAD_DIR}")
+    layer.steps = steps
+
+
+# ==================================================================
+# OUTPUT
+# ==================================================================
+def dockerfile(layers: list[Layer], profile: str, base: str = DEFAULT_BASE) -> str:
+    """One RUN per layer, in order."""
+    lines = [f"# Generated by: dqs export dockerfile {profile}", f"FROM {base}", "ARG DEBIAN_FRONTEND=noninteractive"]
+    path: list[str] = []
+    user = None
+    for i, layer in enumerate(layers, 1):
+        lines.append("")
+        lines.append(f"# {i}/{len(layers)} {layer.describe()}")
+        new = [entry for entry in layer.path if entry not in path]
+        if new:
+            path += new
+            lines.append(f"ENV PATH={':'.join(new)}:$PATH")
+        if layer.user != user:
+            user = layer.user
+            lines.append(f"USER {user or 'root'}")
+        lines.append("RUN " + " \\\n && ".join(layer.steps))
+    if user:
+        lines += ["", "USER root"]
+    return "\n".join(lines) + "\n"
+
+
+def stage_scripts(layers: list[Layer]) -> list[tuple[str, str]]:
+    """(file name, script) per layer, for image builders running shell steps in order."""
+    stages = []
+    path: list[str] = []
+    for i, layer in enumerate(layers, 1):
+        path += [entry for entry in layer.path if entry not in path]
+        lines = ["#!/bin/sh", f"# {layer.describe()}", "set -e", "export DEBIAN_FRONTEND=noninteractive"]
+        if path:
+            lines.append(f'export PATH="{":".join(path)}:$PATH"')
+        if layer.user:
+            # Image builders run every stage as root
+            script = " && ".join(layer.steps)
+            lines.append(f"cd /home/{layer.user}")
+            lines.append(f"runuser -u {layer.user} -- env HOME=/home/{layer.user} USER={layer.user} /bin/sh -ec {shlex.quote(script)}")
+        else:
+            lines += layer.steps
+        stages.append((f"{i:02d}-{re.sub(r'[^A-Za-z0-9_.-]', '_', layer.name)}.sh", "\n".join(lines) + "\n"))
+    return stages
+
+
+def export_dockerfile(profile: str, output: Optional[str] = None, base: str = DEFAULT_BASE,
+                      catalog: Optional[Catalog] = None) -> str:
+    """Writes the Dockerfile of the profile (to stdout when output is None or '-')."""
+    catalog = catalog or load_catalog()
+    text = dockerfile(plan_layers(catalog, catalog.resolve_targets(profile)), profile, base)
+    if output and output != "-":
+        with open(output, "w") as f:
+            f.write(text)
+        ok(f"Dockerfile written to: {output}")
+    else:
+        print(text, end="")
+    return text
+
+
+def export_stages(profile: str, output: str, catalog: Optional[Catalog] = None) -> list[dict]:
+    """
+    Writes one script per layer into output, plus a manifest with the cache
+    key of each stage: the hash of the stage and of every stage before it, as
+    a stage is only reusable when nothing before it changed either.
+    """
+    catalog = catalog or load_catalog()
+    os.makedirs(output, exist_ok=True)
+    for name in os.listdir(output):
+        # Stages of a previous export that are gone now
+        if re.fullmatch(r"\d{2}-.*\.sh", name):
+            os.remove(os.path.join(output, name))
+
+    manifest = []
+    key = hashlib.sha256()
+    layers = plan_layers(catalog, catalog.resolve_targets(profile))
+    for layer, (name, script) in zip(layers, stage_scripts(layers)):
+        key.update(script.encode())
+        path = os.path.join(output, name)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+        manifest.append({"stage": name, "packages": layer.packages, "key": key.hexdigest()})
+    with open(os.path.join(output, STAGES_MANIFEST), "w") as f:
+        json.dump({"profile": profile, "stages": manifest}, f, indent=2)
+    ok(f"{len(manifest)} stages written to: {output}")
+    return manifest
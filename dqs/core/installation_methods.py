@@ -1,9 +1,25 @@
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional
+from enum import Enum
+from typing import TYPE_CHECKING, Callable, Dict, Any, Iterable, Optional
 
-from dqs.core.context import InstallationContext
+from dqs.core import events, retry, timings
+from dqs.core.cache import CHUNK_SIZE, DOWNLOAD_TIMEOUT, ArtifactCache, ChecksumError
+from dqs.core.scheduler import DPKG_LOCK, resource_lock
+from dqs.utils import paths
+from dqs.utils.paths import STATE_DIR
 from dqs.utils.terminal_utils import log, ok, error, run_command
 
+if TYPE_CHECKING:
+    from dqs.core.context import InstallationContext
+
 # ==================================================================
 '''
 CONTEMPLATED INSTALLATION METHODS:
@@ -15,16 +31,34 @@ CONTEMPLATED INSTALLATION METHODS:
 - deb package
 - Flatpak
 - Homebrew
+- Tarball (extracted into ~/.local/opt/<id>)
+- Script (installer scripts of the catalog)
 '''
 # ==================================================================
 
+# Readiness markers of the methods that needed a setup, one file per method
+READY_DIR = os.path.join(STATE_DIR, "ready")
+
+
+class SetupState(Enum):
+    UNKNOWN = "unknown"
+    SETTING_UP = "setting_up"
+    READY = "ready"
+    FAILED = "failed"
+
+
 # ==================================================================
 # Abstract Base Class for Installation Methods
 # ==================================================================
 class InstallationMethod(ABC):
     '''Abstract base class for installation methods.'''
-    def __init__(self, context: InstallationContext):
+    # Methods that can install several packages in a single transaction
+    SUPPORTS_BATCH: bool = False
+
+    def __init__(self, context: "InstallationContext"):
         self.context = context
+        self.setup_state = SetupState.UNKNOWN
+        self._setup_lock = threading.Lock()
     
     @abstractmethod
     def install(self, pkg_data: dict[str, Any]) -> bool:
@@ -39,6 +73,123 @@ class InstallationMethod(ABC):
     def setup(self) -> bool:
         '''Initial configuration or setup required before installation.'''
         return True
+    
+    def ready_binary(self) -> Optional[str]:
+        '''Path of the tool this method relies on once set up, stored in the readiness marker.'''
+        return None
+    
+    def activate(self) -> None:
+        '''Per process adjustments (PATH...) needed to use an already set up method.'''
+        pass
+    
+    def ensure_ready(self) -> bool:
+        '''
+        Runs the setup at most once per process: unknown -> setting up -> ready/failed.
+        Concurrent callers wait for the first one and share its outcome. A
+        readiness marker from a previous run skips the setup probe entirely
+        as long as the tool it recorded is still there.
+        '''
+        with self._setup_lock:
+            if self.setup_state in (SetupState.READY, SetupState.FAILED):
+                return self.setup_state == SetupState.READY
+            
+            if not self.requires_setup() or self._marker_is_valid():
+                self.activate()
+                self.setup_state = SetupState.READY
+                return True
+            
+            name = type(self).__name__
+            log(f"Setting up method: '{name}'...")
+            self.setup_state = SetupState.SETTING_UP
+            if self.setup():
+                self.activate()
+                self._write_marker()
+                self.setup_state = SetupState.READY
+                return True
+            
+            error(f"Setup for method: '{name}' failed.")
+            self.setup_state = SetupState.FAILED
+            return False
+    
+    def _marker_path(self) -> str:
+        return os.path.join(READY_DIR, f"{type(self).__name__}.json")
+    
+    def _marker_is_valid(self) -> bool:
+        try:
+            with open(self._marker_path()) as f:
+                marker = json.load(f)
+        except (OSError, ValueError):
+            return False
+        binary = marker.get("binary")
+        return bool(binary) and os.access(binary, os.X_OK)
+    
+    def _write_marker(self) -> None:
+        binary = self.ready_binary()
+        if not binary:
+            return
+        try:
+            os.makedirs(READY_DIR, exist_ok=True)
+            tmp = f"{self._marker_path()}.{os.getpid()}"
+            with open(tmp, "w") as f:
+                json.dump({"binary": binary, "time": time.time()}, f)
+            os.replace(tmp, self._marker_path())
+        except OSError:
+            pass
+
+    def package_ref(self, pkg_data: dict[str, Any]) -> str:
+        '''Name the backend of this method knows the package by.'''
+        return pkg_data.get("id", "unknown")
+    
+    def package_refs(self, pkg_data: dict[str, Any]) -> list[str]:
+        '''Every backend package behind a catalog entry (usually just package_ref).'''
+        return list(pkg_data.get("packages") or [self.package_ref(pkg_data)])
+    
+    def is_installed(self, pkg_data: dict[str, Any], method_name: str) -> bool:
+        '''Whether every backend package of the entry is on the system, per the state snapshot.'''
+        return all(self.context.state.is_installed(ref, method_name) for ref in self.package_refs(pkg_data))
+
+    def install_batch(self, pkgs: list[dict[str, Any]]) -> bool:
+        '''
+        Installs all the given packages, as one transaction in the methods with
+        SUPPORTS_BATCH. Here, one after the other, like install_many does.
+        '''
+        return all([self.install(pkg_data) for pkg_data in pkgs])
+    
+    def prestage_command(self, pkgs: list[dict[str, Any]]) -> Optional[list[str]]:
+        '''argv downloading the payloads of pkgs without installing them, None if the method can't.'''
+        return None
+    
+    def install_many(self, pkgs: list[dict[str, Any]]) -> Dict[str, list[str]]:
+        '''
+        Installs several packages and returns the ids that completed and failed.
+        Batch capable methods try the whole list at once and bisect on failure
+        so a single broken package doesn't take the rest of the batch with it.
+        '''
+        results = {"completed": [], "failed": []}
+        if self.SUPPORTS_BATCH:
+            self._install_bisect(pkgs, results)
+        else:
+            for pkg_data in pkgs:
+                key = "completed" if self.install(pkg_data) else "failed"
+                results[key].append(pkg_data.get("id", "unknown"))
+        return results
+    
+    def _install_bisect(self, pkgs: list[dict[str, Any]], results: Dict[str, list[str]]) -> None:
+        if not pkgs:
+            return
+        
+        success = self.install(pkgs[0]) if len(pkgs) == 1 else self.install_batch(pkgs)
+        ids = [pkg_data.get("id", "unknown") for pkg_data in pkgs]
+        
+        if success:
+            results["completed"].extend(ids)
+        elif len(pkgs) == 1:
+            results["failed"].extend(ids)
+        else:
+            log(f"Batch of {len(pkgs)} packages failed, splitting it to isolate the culprit...")
+            middle = len(pkgs) // 2
+            self._install_bisect(pkgs[:middle], results)
+            self._install_bisect(pkgs[middle:], results)
 
 # ==================================================================
 # Concrete Implementation: Native Package Manager
@@ -46,11 +197,14 @@ class InstallationMethod(ABC):
 class PKGManager(InstallationMethod):
     '''Class representing the native package manager of the system.'''
     
-    INSTALLATION_COMMANDS: Dict[str, str] = {
-        'debian': 'sudo apt install -y {pkg}',
-        'fedora': 'sudo dnf install -y {pkg}',
-        'arch': 'sudo pacman -S --noconfirm {pkg}',
-        'redhat': 'sudo yum install -y {pkg}',
+    SUPPORTS_BATCH = True
+    
+    # argv the package names are appended to, run without a shell
+    INSTALLATION_COMMANDS: Dict[str, tuple[str, ...]] = {
+        'debian': ('sudo', 'apt', 'install', '-y'),
+        'fedora': ('sudo', 'dnf', 'install', '-y'),
+        'arch': ('sudo', 'pacman', '-S', '--noconfirm'),
+        'redhat': ('sudo', 'yum', 'install', '-y'),
     }
     
     def requires_setup(self) -> bool:
@@ -58,7 +212,14 @@ class PKGManager(InstallationMethod):
         return False
 
     def install(self, pkg_data: dict[str, Any]) -> bool:
-        pkg_name = pkg_data.get('name') if 'name' in pkg_data else pkg_data.get('id')
+        return self.install_batch([pkg_data])
+    
+    def package_ref(self, pkg_data: dict[str, Any]) -> str:
+        # 'name' is the display name in the catalog, the real one is 'package'
+        return pkg_data.get('package') or pkg_data.get('id')
+    
+    def install_batch(self, pkgs: list[dict[str, Any]]) -> bool:
+        pkg_names = [ref for pkg_data in pkgs for ref in self.package_refs(pkg_data)]
         
         command_template = self.INSTALLATION_COMMANDS.get(self.context.distro_based)        
         
@@ -66,7 +227,14 @@ class PKGManager(InstallationMethod):
             error(f"No installation command found for distro: {self.context.distro}")
             return False
         
-        return run_command(command_template.format(pkg=pkg_name))
+        with resource_lock(DPKG_LOCK):
+            # Another package manager (unattended-upgrades...) may be running
+            if self.context.distro_based == "debian" and not retry.wait_for_dpkg_lock():
+                return False
+            if self.context.distro_based == "debian":
+                # -o DPkg::Lock::Timeout goes before the subcommand
+                command_template = (*command_template[:2], *retry.apt_lock_args(), *command_template[2:])
+            return run_command([*command_template, *pkg_names])
     
 # ==================================================================
 # Concrete Implementation: DEB Package Installation
@@ -75,56 +243,284 @@ class DebMethod(InstallationMethod):
     def requires_setup(self) -> bool:
         return False
     
+    def package_ref(self, pkg_data: Dict[str, Any]) -> str:
+        # Name of the package inside the .deb, when it differs from the id
+        return pkg_data.get("package") or pkg_data.get("id", "package")
+    
     def install(self, pkg_data: Dict[str, Any]) -> bool:
         name = pkg_data.get("id", "package")
         url = pkg_data.get("url")
         if not url:
             error(f"Missing 'url' for DEB package '{name}'")
             return False
-        cmd = f"curl -L '{url}' -o {name}.deb && sudo apt install -y ./{name}.deb && rm {name}.deb"
-        return run_command(cmd)
+        # Take the artifact from the prefetch pipeline when there is one
+        prefetcher = self.context.prefetcher
+        with timings.phase("download"):
+            mirrors = pkg_data.get("mirrors", ())
+            if prefetcher:
+                path = prefetcher.get(url, suffix=".deb", mirrors=mirrors, sha256=pkg_data.get("sha256"))
+            else:
+                path = ArtifactCache().fetch(url, ".deb", mirrors, pkg_data.get("sha256"))
+        timings.uses_artifact(url)
+        if not path:
+            return False
+        
+        # Only the apt step needs the dpkg lock, downloads can overlap.
+        # The .deb stays in the artifact cache for the next run.
+        with resource_lock(DPKG_LOCK):
+            if not retry.wait_for_dpkg_lock():
+                return False
+            return run_command(["sudo", "apt", *retry.apt_lock_args(), "install", "-y", path])
 
 # ==================================================================
 # Concrete Implementation: Flatpak Installation
 # ==================================================================
 class FlatpakMethod(InstallationMethod):
+    SUPPORTS_BATCH = True
+    
     def requires_setup(self) -> bool:
         return True
     
     def setup(self) -> bool:
-        if self.context.is_command_available("flatpak"):
-            return True
-        
-        PKGManager(self.context).install({"id": "flatpak"})
+        # flatpak may come from a plain apt step of the plan, without the remote
+        if not self.context.is_command_available("flatpak") and not self.context.get_method("pkg_manager").install({"id": "flatpak"}):
+            error("Could not install flatpak")
+            return False
         
-        cmd = "sudo flatpak remote-add --if-not-exists flathub https://dl.flathub.org/repo/flathub.flatpakrepo"
-        return run_command(cmd)
+        return run_command(["sudo", "flatpak", "remote-add", "--if-not-exists", "flathub", "https://dl.flathub.org/repo/flathub.flatpakrepo"])
+    
+    def ready_binary(self) -> Optional[str]:
+        return shutil.which("flatpak", path=self.context.env.get("PATH"))
     
     def install(self, pkg_data: Dict[str, Any]) -> bool:
-        package_id = pkg_data.get("flatpak_id") or pkg_data.get("id")
-        cmd = f"flatpak install -y flathub {package_id}"
-        return run_command(cmd)
+        return self.install_batch([pkg_data])
+    
+    def package_ref(self, pkg_data: Dict[str, Any]) -> str:
+        return pkg_data.get("flatpak_id") or pkg_data.get("package") or pkg_data.get("id")
+    
+    def install_batch(self, pkgs: list[Dict[str, Any]]) -> bool:
+        package_ids = [ref for pkg_data in pkgs for ref in self.package_refs(pkg_data)]
+        # With the payload pre-staged this only deploys
+        if self.context.prestager:
+            self.context.prestager.wait("flatpak")
+        return run_command(["flatpak", "install", "-y", "flathub", *package_ids])
+    
+    def prestage_command(self, pkgs: list[Dict[str, Any]]) -> Optional[list[str]]:
+        package_ids = [ref for pkg_data in pkgs for ref in self.package_refs(pkg_data)]
+        return ["flatpak", "install", "-y", "--noninteractive", "--no-deploy", "flathub", *package_ids]
 
 # ==================================================================
 # Concrete Implementation: Homebrew Installation
 # ==================================================================
 class HomebrewMethod(InstallationMethod):
+    SUPPORTS_BATCH = True
+    
     def requires_setup(self) -> bool:
         return True
     
+    BREW_PREFIX = "/home/linuxbrew/.linuxbrew/bin"
+    
     def setup(self) -> bool:
+        # The installer may have run already (the homebrew script step), just not in this PATH
+        self.activate()
         if self.context.is_command_available("brew"):
             return True
         
+        # The upstream installer is a script, it needs the shell
         if not run_command('NONINTERACTIVE=1 /bin/bash -c "$(curl -fsSL https://raw.githubusercontent.com/Homebrew/install/HEAD/install.sh)"'):
             return False
         
-        self.context.add_to_path("/home/linuxbrew/.linuxbrew/bin")
+        self.activate()
+        
+        return run_command(["brew", "install", "gcc"], env=self.context.env)
+    
+    def activate(self) -> None:
+        self.context.add_to_path(self.BREW_PREFIX)
+    
+    def ready_binary(self) -> Optional[str]:
+        return shutil.which("brew", path=self.context.env.get("PATH"))
+    
+    def install(self, pkg_data: Dict[str, Any]) -> bool:
+        return self.install_batch([pkg_data])
+    
+    def package_ref(self, pkg_data: Dict[str, Any]) -> str:
+        return pkg_data.get("flatpak_id") or pkg_data.get("id")
+    
+    def install_batch(self, pkgs: list[Dict[str, Any]]) -> bool:
+        packages = [ref for pkg_data in pkgs for ref in self.package_refs(pkg_data)]
+        # brew locks a formula while fetching it, install after the fetch is done
+        if self.context.prestager:
+            self.context.prestager.wait("homebrew")
+        return run_command(["brew", "install", *packages], env=self.context.env)
+    
+    def prestage_command(self, pkgs: list[Dict[str, Any]]) -> Optional[list[str]]:
+        packages = [ref for pkg_data in pkgs for ref in self.package_refs(pkg_data)]
+        return ["brew", "fetch", "--deps", *packages]
         
-        return run_command("brew install gcc")
+
+# ==================================================================
+# Concrete Implementation: Tarball Installation
+# ==================================================================
+class _HashingReader:
+    '''Read-only stream wrapper that hashes (sha256) and counts what goes through it.'''
+    def __init__(self, stream: Any, url: str):
+        self.stream = stream
+        self.url = url
+        length = getattr(stream, "headers", {}).get("Content-Length")
+        self.total = int(length) if length else None
+        self.digest = hashlib.sha256()
+        self.size = 0
+    
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.digest.update(data)
+        self.size += len(data)
+        events.progress(self.url, "download.progress", url=self.url, bytes=self.size, total=self.total)
+        return data
+    
+    def drain(self) -> None:
+        # Whatever follows the end of the tar (padding, compression trailer) is part of the file
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def extract_tarball(stream: Any, dest: str, verify: Optional[Callable[[], None]] = None) -> None:
+    '''
+    Extracts a tar stream (any compression) into dest, replacing what was
+    there. The tree is extracted into a staging directory next to dest and
+    renamed into place only once the whole archive came through (and verify
+    didn't raise), so dest never holds a half extracted tree.
+    '''
+    parent = os.path.dirname(dest)
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=parent, prefix=f".{os.path.basename(dest)}-staging-")
+    try:
+        with tarfile.open(fileobj=stream, mode="r|*") as tar:
+            tar.extractall(staging, filter="data")
+        if verify:
+            verify()
+        # Most archives wrap everything in a single versioned directory (name-1.2.3/)
+        entries = os.listdir(staging)
+        root = staging
+        if len(entries) == 1 and os.path.isdir(os.path.join(staging, entries[0])) and not os.path.islink(os.path.join(staging, entries[0])):
+            root = os.path.join(staging, entries[0])
+        
+        old = None
+        if os.path.lexists(dest):
+            old = os.path.join(parent, f".{os.path.basename(dest)}-old-{os.getpid()}-{time.monotonic_ns()}")
+            os.rename(dest, old)
+        try:
+            os.rename(root, dest)
+        except OSError:
+            if old:
+                os.rename(old, dest)
+            raise
+        if old:
+            shutil.rmtree(old, ignore_errors=True)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def link_executables(dest: str) -> list[str]:
+    '''Links the executables at the top of dest (and of dest/bin) into BIN_DIR, returns their names.'''
+    linked = []
+    os.makedirs(paths.BIN_DIR, exist_ok=True)
+    for directory in (dest, os.path.join(dest, "bin")):
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if not entry.is_file() or not os.access(entry.path, os.X_OK) or ".so" in entry.name:
+                continue
+            link = os.path.join(paths.BIN_DIR, entry.name)
+            # Never replace something the user put there
+            if os.path.lexists(link) and not os.path.islink(link):
+                continue
+            tmp = f"{link}.dqs-{os.getpid()}"
+            os.symlink(entry.path, tmp)
+            os.replace(tmp, link)
+            linked.append(entry.name)
+    return linked
+
+
+def install_tarball(pkg_id: str, url: str, mirrors: Iterable[str] = (), sha256: Optional[str] = None) -> bool:
+    '''
+    Streams the archive at url through decompression straight into
+    OPT_DIR/<pkg_id>: no copy of the archive ever touches the disk. The
+    sha256 is computed on the fly and checked before the tree is moved in
+    place. Transient errors are retried, then the mirrors are tried.
+    '''
+    import http.client
+    import urllib.request
+    
+    dest = os.path.join(paths.OPT_DIR, pkg_id)
+    
+    def attempt(source: str) -> None:
+        start = time.monotonic()
+        request = urllib.request.Request(source, headers={"User-Agent": "dqs"})
+        with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+            events.publish("download.started", url=url)
+            reader = _HashingReader(response, url)
+            
+            def verify() -> None:
+                reader.drain()
+                if sha256 and reader.digest.hexdigest() != sha256:
+                    raise ChecksumError(f"sha256 mismatch: expected {sha256}, got {reader.digest.hexdigest()}")
+            
+            extract_tarball(reader, dest, verify)
+        timings.record_download(url, reader.size, time.monotonic() - start, cached=False)
+        events.publish("download.finished", url=url, bytes=reader.size, seconds=round(time.monotonic() - start, 3), cached=False)
+    
+    failure = None
+    for index, source in enumerate(dict.fromkeys([url, *mirrors])):
+        if index:
+            retry.failover(url, source)
+        try:
+            retry.call(lambda: attempt(source), f"Download of {source}")
+            failure = None
+            break
+        except (OSError, http.client.HTTPException, tarfile.TarError) as e:
+            failure = e
+    if failure:
+        error(f"Could not install {pkg_id} from {url}: {failure}")
+        return False
+    
+    linked = link_executables(dest)
+    ok(f"Extracted {pkg_id} into {dest}" + (f", linked into {paths.BIN_DIR}: {', '.join(linked)}" if linked else ""))
+    return True
+
+
+class TarballMethod(InstallationMethod):
+    '''Archives extracted into ~/.local/opt/<id>, with their executables linked into ~/.local/bin.'''
+    def requires_setup(self) -> bool:
+        return False
+    
+    def install(self, pkg_data: Dict[str, Any]) -> bool:
+        name = pkg_data.get("id", "package")
+        url = pkg_data.get("url")
+        if not url:
+            error(f"Missing 'url' for tarball package '{name}'")
+            return False
+        return install_tarball(name, url, pkg_data.get("mirrors", ()), pkg_data.get("sha256"))
+
+# ==================================================================
+# Concrete Implementation: Script Installation
+# ==================================================================
+class ScriptMethod(InstallationMethod):
+    '''
+    Installer scripts of upstream projects (Homebrew, rclone), run as the
+    catalog gives them. The only method whose commands go through a shell.
+    '''
+    def requires_setup(self) -> bool:
+        return False
+    
+    def is_installed(self, pkg_data: Dict[str, Any], method_name: str) -> bool:
+        # A script doesn't say what it installs, only the file it leaves tells
+        creates = pkg_data.get("creates")
+        return bool(creates) and os.path.exists(os.path.expanduser(creates))
     
     def install(self, pkg_data: Dict[str, Any]) -> bool:
-        package = pkg_data.get("flatpak_id") or pkg_data.get("id")
-        cmd = f"brew install {package}"
-        return run_command(cmd)
-        
\ No newline at end of file
+        command = pkg_data.get("command")
+        if not command:
+            error(f"Missing 'command' for script package '{pkg_data.get('id', 'package')}'")
+            return False
+        return run_command(command, env=self.context.env)
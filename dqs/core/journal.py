@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from types import CodeType
+from typing import Any, Optional
+
+from dqs.utils.paths import STATE_DIR
+
+# ==================================================================
+'''
+CHECKPOINT JOURNAL:
+Append-only log of task outcomes, one JSON line per finished task:
+    {"task": name, "hash": definition hash, "status": "completed"|"failed", "time": ...}
+The last line of a task wins. A restarted run skips the tasks whose last
+outcome is "completed" with the same definition hash, as long as every
+requirement was skipped too, so failed, changed and new tasks run again
+together with everything that depends on them. Tasks whose only effect is
+on the running process (PATH...) are added with rerun=True: they run again
+on every resume, and their dependents may still be skipped. A run that
+finishes without failures clears the journal, the next one starts from
+scratch.
+'''
+# ==================================================================
+JOURNAL_PATH = os.path.join(STATE_DIR, "journal.jsonl")
+
+
+def _code(code: CodeType) -> list[Any]:
+    return [code.co_code.hex(), [_stable(const) for const in code.co_consts], list(code.co_names)]
+
+
+def _stable(value: Any) -> Any:
+    # Functions are hashed by their code, so editing a lambda invalidates its task
+    if isinstance(value, CodeType):
+        return _code(value)
+    if callable(value):
+        code = getattr(value, "__code__", None)
+        if code is None:
+            return getattr(value, "__qualname__", repr(type(value)))
+        return [_code(code), _stable(getattr(value, "__defaults__", None))]
+    if isinstance(value, dict):
+        return {str(key): _stable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_stable(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((_stable(item) for item in value), key=repr)
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+
+def definition_hash(definition: Any) -> str:
+    """Stable hash of a task definition (command, url, method, requires...)."""
+    payload = json.dumps(_stable(definition), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+class Journal:
+    """Outcomes of the tasks of an interrupted run, read once and appended to as tasks finish."""
+
+    def __init__(self, path: str = JOURNAL_PATH):
+        self.path = path
+        self.entries: dict[str, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Power loss in the middle of a write leaves a torn last line
+                        continue
+                    self.entries[entry["task"]] = entry
+        except OSError:
+            pass
+
+    def is_done(self, task: str, digest: Optional[str]) -> bool:
+        entry = self.entries.get(task)
+        return bool(entry) and digest is not None and entry["hash"] == digest and entry["status"] == "completed"
+
+    def record(self, task: str, digest: Optional[str], success: bool) -> None:
+        entry = {"task": task, "hash": digest, "status": "completed" if success else "failed", "time": time.time()}
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self.entries[task] = entry
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a") as f:
+                    f.write(line)
+                    f.flush()
+                    # The whole point is surviving a power loss
+                    os.fsync(f.fileno())
+            except OSError:
+                pass
+
+    def clear(self) -> None:
+        """Forgets every outcome, called once a run finishes cleanly."""
+        with self._lock:
+            self.entries.clear()
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
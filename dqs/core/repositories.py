@@ -0,0 +1,203 @@
+import functools
+import glob
+import os
+import platform
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Callable, Iterable, Optional, Sequence
+
+from dqs.core.catalog import Catalog, Repository
+from dqs.core.downloads import fetch
+from dqs.core.retry import apt_lock_args, wait_for_dpkg_lock
+from dqs.core.scheduler import DPKG_LOCK, resource_lock
+from dqs.utils.terminal_utils import log, ok, error, run_command
+
+# ==================================================================
+'''
+REPOSITORY PHASE:
+Every apt source the plan needs (docker, spotify, extrepo...) is added first,
+and only then the package metadata is refreshed, exactly once. The refresh is
+skipped altogether when /var/lib/apt/lists is newer than every sources file
+and not older than MAX_LISTS_AGE. Everything runs as argv, without a shell:
+keys and source lines are written to temporary files first and put in
+place with `sudo install`.
+'''
+# ==================================================================
+LISTS_DIR = "/var/lib/apt/lists"
+SOURCES = ["/etc/apt/sources.list", "/etc/apt/sources.list.d/*.list", "/etc/apt/sources.list.d/*.sources"]
+MAX_LISTS_AGE = 24 * 3600
+
+MACHINE_TO_DEB_ARCH = {"x86_64": "amd64", "aarch64": "arm64", "armv7l": "armhf", "i686": "i386"}
+
+
+@functools.cache
+def deb_architecture() -> str:
+    try:
+        return subprocess.run(["dpkg", "--print-architecture"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return MACHINE_TO_DEB_ARCH.get(platform.machine(), platform.machine())
+
+
+def refresh_command() -> list[str]:
+    return ["sudo", "apt", *apt_lock_args(), "update"]
+
+
+def repository_command(repository: Repository) -> str:
+    """Self-contained shell command adding the repository, for hosts other than this one."""
+    if repository.extrepo:
+        return f"sudo extrepo enable {shlex.quote(repository.extrepo)}"
+
+    line = repository.line.replace("{arch}", "$(dpkg --print-architecture)").replace(
+        "{codename}", '$(. /etc/os-release && echo "$VERSION_CODENAME")')
+    steps = []
+    if repository.keyring and repository.key_url:
+        keyring = shlex.quote(repository.keyring)
+        steps.append(f"sudo install -m 0755 -d {shlex.quote(os.path.dirname(repository.keyring))}")
+        if repository.dearmor:
+            steps.append(f"curl -fsSL {shlex.quote(repository.key_url)} | sudo gpg --dearmor --yes -o {keyring}")
+        else:
+            steps.append(f"sudo curl -fsSL {shlex.quote(repository.key_url)} -o {keyring} && sudo chmod a+r {keyring}")
+    steps.append(f'echo "{line}" | sudo tee {shlex.quote(repository.list_file)} > /dev/null')
+    return " && ".join(steps)
+
+
+class RepositoryPhase:
+    """Applies every repository of the plan and refreshes apt metadata once."""
+
+    def __init__(self, repositories: dict[str, Repository], runner: Callable[[Sequence[str]], bool] = run_command, root: str = "/"):
+        self.repositories = repositories
+        self.runner = runner
+        self.root = root
+        self.applied: set[str] = set()
+        self.changed = False
+        self.refreshed = False
+        # Number of `apt update` actually run, for benchmarks/bench_repositories.py
+        self.refreshes = 0
+        # ensure() may be called from several tasks at once
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_catalog(cls, catalog: Catalog, ids: Optional[Iterable[str]] = None, **kwargs) -> "RepositoryPhase":
+        """Collects the repositories of the given special requirements (all of them if None)."""
+        wanted = set(ids) if ids is not None else None
+        repositories = {
+            req.id: req.repository
+            for req in catalog.special_requirements.values()
+            if req.repository and (wanted is None or req.id in wanted)
+        }
+        return cls(repositories, **kwargs)
+
+    def _path(self, path: str) -> str:
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def is_applied(self, repo_id: str) -> bool:
+        return repo_id in self.applied
+
+    def ensure(self, repo_id: str) -> bool:
+        """
+        Makes sure one repository is there even if the phase didn't run in
+        this process (a resumed run), refreshing apt only if it was missing.
+        """
+        with self._lock:
+            if repo_id in self.applied:
+                return True
+            repository = self.repositories.get(repo_id)
+            if not repository:
+                error(f"Unknown repository: {repo_id}")
+                return False
+            was_changed, self.changed = self.changed, False
+            applied = self._apply_one(repo_id, repository)
+            changed, self.changed = self.changed, was_changed or self.changed
+            if not applied:
+                return False
+            self.applied.add(repo_id)
+            return self.refresh(force=True) if changed else True
+
+    def apply(self) -> bool:
+        """Adds every missing source list and keyring. Doesn't refresh anything."""
+        success = True
+        for repo_id, repository in self.repositories.items():
+            if self._apply_one(repo_id, repository):
+                self.applied.add(repo_id)
+            else:
+                error(f"Could not add repository: {repo_id}")
+                success = False
+        return success
+
+    def _apply_one(self, repo_id: str, repository: Repository) -> bool:
+        if repository.extrepo:
+            list_file = self._path(f"/etc/apt/sources.list.d/extrepo_{repository.extrepo}.sources")
+            if os.path.exists(list_file):
+                return True
+            log(f"Enabling extrepo repository: {repository.extrepo}")
+            self.changed = True
+            return self.runner(["sudo", "extrepo", "enable", repository.extrepo])
+
+        line = repository.line.format(arch=deb_architecture(), codename=platform.freedesktop_os_release().get("VERSION_CODENAME", ""))
+        list_file = self._path(repository.list_file)
+        keyring = self._path(repository.keyring) if repository.keyring else None
+        try:
+            with open(list_file) as f:
+                current = f.read().strip()
+        except OSError:
+            current = None
+        if current == line and (not keyring or os.path.exists(keyring)):
+            return True
+
+        log(f"Adding repository: {repo_id}")
+        self.changed = True
+        with tempfile.TemporaryDirectory() as tmp:
+            if keyring and repository.key_url:
+                key = os.path.join(tmp, "key")
+                if not fetch(repository.key_url, key):
+                    return False
+                if repository.dearmor:
+                    install_key = ["sudo", "gpg", "--dearmor", "--yes", "-o", keyring, key]
+                else:
+                    install_key = ["sudo", "install", "-D", "-m", "0644", key, keyring]
+                if not (self.runner(["sudo", "install", "-m", "0755", "-d", os.path.dirname(keyring)]) and self.runner(install_key)):
+                    return False
+
+            source = os.path.join(tmp, "source")
+            with open(source, "w") as f:
+                f.write(f"{line}\n")
+            return self.runner(["sudo", "install", "-D", "-m", "0644", source, list_file])
+
+    def lists_are_fresh(self) -> bool:
+        """True when the apt lists are newer than every sources file (and not too old)."""
+        lists_dir = self._path(LISTS_DIR)
+        stamps = [os.path.join(lists_dir, "partial"), lists_dir]
+        try:
+            lists_mtime = max(os.stat(path).st_mtime for path in stamps if os.path.exists(path))
+        except ValueError:
+            return False
+        if time.time() - lists_mtime > MAX_LISTS_AGE:
+            return False
+
+        for pattern in SOURCES:
+            for source in glob.glob(self._path(pattern)):
+                if os.stat(source).st_mtime >= lists_mtime:
+                    return False
+        return True
+
+    def refresh(self, force: bool = False) -> bool:
+        """Refreshes apt metadata once per run, only if something changed or the lists are stale."""
+        if self.refreshed and not force:
+            return True
+        if not force and not self.changed and self.lists_are_fresh():
+            ok("Package lists are up to date, skipping refresh.")
+            self.refreshed = True
+            return True
+
+        with resource_lock(DPKG_LOCK):
+            self.refreshes += 1
+            self.refreshed = wait_for_dpkg_lock() and self.runner(refresh_command())
+        return self.refreshed
+
+    def run(self) -> bool:
+        """Whole phase: apply every repository, then a single refresh."""
+        applied = self.apply()
+        return self.refresh() and applied
@@ -0,0 +1,299 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Iterable, Iterator, Optional
+
+from dqs.core.catalog import Catalog, CatalogError
+from dqs.core.scheduler import Scheduler
+from dqs.utils.terminal_utils import error, ok
+
+if TYPE_CHECKING:
+    from dqs.core.concurrency import ConcurrencyController
+    from dqs.core.context import InstallationContext
+    from dqs.core.repositories import RepositoryPhase
+
+# ==================================================================
+'''
+TARGETED INSTALLS:
+resolve() walks the catalog from a set of target package ids and keeps only
+what they need: every required package, plus the repositories of the
+repository_setup requirements on the way. The walk is an iterative DFS over
+the requirement edges, so it's linear in the size of the closure and it
+reports cycles with their full path instead of recursing forever.
+The resulting Plan is ordered (requirements first) and can be printed
+(--dry-run) or executed on the task scheduler, where a failed step fails its
+dependents without running them. On the scheduler:
+- every repository of the plan is added by a single node, followed by a
+  single apt refresh (dqs.core.repositories), before any step needing one
+- packages of a batch capable method (apt, flatpak, brew) with the same
+  requirements are installed by one node, as one transaction bisected on
+  failure (InstallationContext.install_packages). Each package keeps its
+  own node, reporting its outcome, so a broken one only fails its dependents
+Executing it also pre-stages the methods that
+can download ahead (flatpak, homebrew): as soon as the requirements of their
+setup are done, one background job per method sets it up and fetches every
+pending package of that method (dqs.core.downloads.Prestager).
+'''
+# ==================================================================
+# Catalog method -> installation method of dqs.core.context.METHOD_CLASSES
+METHOD_NAMES = {"apt": "pkg_manager"}
+# Seconds a failed package is remembered by a context, retrying it sooner fails fast
+FAILURE_TTL = 600
+# Scheduler nodes of their own, not steps of the plan
+REPOSITORIES_NODE = "repositories"
+BATCH_NODE = "batch:{method}:{number}"
+
+
+class DependencyCycleError(CatalogError):
+    """Raised when the requirements of the plan loop back on themselves."""
+    def __init__(self, cycle: list[str]):
+        self.cycle = cycle
+        super().__init__(f"Dependency cycle: {' -> '.join(cycle)}")
+
+
+@dataclass(slots=True, frozen=True)
+class PlanStep:
+    id: str
+    # "package" or "requirement" (a special requirement: repository...)
+    kind: str
+    method: Optional[str] = None
+    requires: tuple[str, ...] = ()
+    target: bool = False
+
+
+@dataclass
+class Plan:
+    targets: tuple[str, ...]
+    steps: list[PlanStep] = field(default_factory=list)
+
+    def __iter__(self) -> Iterator[PlanStep]:
+        return iter(self.steps)
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    def package_ids(self) -> list[str]:
+        return [step.id for step in self.steps if step.kind == "package"]
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "targets": list(self.targets),
+            "steps": [
+                {"id": step.id, "kind": step.kind, "method": step.method, "requires": list(step.requires), "target": step.target}
+                for step in self.steps
+            ],
+        }
+
+    def describe(self) -> str:
+        lines = []
+        for number, step in enumerate(self.steps, 1):
+            what = step.method or step.kind
+            requires = f"  <- {', '.join(step.requires)}" if step.requires else ""
+            lines.append(f"{number:3}. {step.id} [{what}]{'  *' if step.target else ''}{requires}")
+        return "\n".join(lines)
+
+
+def resolve(catalog: Catalog, targets: Iterable[str], methods: Optional[dict[str, str]] = None) -> Plan:
+    """
+    Minimal ordered plan installing the targets. methods overrides the
+    default method of some packages ({"neovim": "homebrew"}).
+    """
+    targets = tuple(dict.fromkeys(targets))
+    methods = methods or {}
+    unknown = [pkg_id for pkg_id in targets if pkg_id not in catalog.packages]
+    if unknown:
+        raise CatalogError(f"Unknown packages: {', '.join(unknown)}")
+    for pkg_id, method in methods.items():
+        pkg = catalog.get(pkg_id)
+        if not pkg or method not in pkg.methods:
+            raise CatalogError(f"'{pkg_id}' can't be installed with method '{method}'")
+
+    def requirements(node: str) -> tuple[str, ...]:
+        pkg = catalog.packages.get(node)
+        return pkg.spec(methods.get(node)).requires if pkg else ()
+
+    plan = Plan(targets)
+    # Unvisited nodes are missing, 1: on the current path, 2: done
+    state: dict[str, int] = {}
+    for root in targets:
+        if root in state:
+            continue
+        path = [root]
+        stack = [(root, iter(requirements(root)))]
+        state[root] = 1
+        while stack:
+            node, pending = stack[-1]
+            req = next(pending, None)
+            if req is None:
+                stack.pop()
+                path.pop()
+                state[node] = 2
+                plan.steps.append(_step(catalog, node, requirements(node), methods, node in targets))
+                continue
+            if state.get(req) == 1:
+                raise DependencyCycleError(path[path.index(req):] + [req])
+            if req not in state:
+                state[req] = 1
+                path.append(req)
+                stack.append((req, iter(requirements(req))))
+    return plan
+
+
+def _step(catalog: Catalog, node: str, requires: tuple[str, ...], methods: dict[str, str], target: bool) -> PlanStep:
+    pkg = catalog.packages.get(node)
+    if pkg:
+        # Special requirements sharing a package id (homebrew, flatpak) are the
+        # method setup, InstallationContext.prepare_method takes care of them
+        return PlanStep(node, "package", methods.get(node, pkg.default_method), requires, target)
+    return PlanStep(node, "requirement", None, requires, target)
+
+
+# ==================================================================
+# EXECUTION
+# ==================================================================
+def execute(plan: Plan, catalog: Catalog, context: "InstallationContext", max_workers: int = 4,
+            prestage: bool = True, controller: Optional["ConcurrencyController"] = None,
+            repositories: Optional["RepositoryPhase"] = None) -> dict[str, list[str]]:
+    """
+    Runs the plan on the scheduler and returns the completed and failed step
+    ids. prestage=False leaves every download to its install. With a
+    controller, max_workers is ignored and the host load sets the concurrency.
+    repositories replaces the repository phase of the plan (benchmarks).
+    """
+    from dqs.core.downloads import Prestager
+    from dqs.core.repositories import RepositoryPhase
+
+    if repositories is None:
+        repositories = RepositoryPhase.from_catalog(catalog, [step.id for step in plan if step.kind == "requirement"])
+
+    # Pending packages of the methods that can download ahead, and the
+    # requirements of those packages that aren't of the method itself (its setup)
+    ahead: dict[str, list[dict[str, Any]]] = {}
+    setup_requires: dict[str, set[str]] = {}
+    for step in plan if prestage else ():
+        method_name = METHOD_NAMES.get(step.method, step.method)
+        method = context.get_method(method_name) if step.kind == "package" else None
+        if not method or method.prestage_command([]) is None:
+            continue
+        pkg_data = catalog.packages[step.id].to_pkg_data(step.method)
+        if context.is_satisfied(pkg_data, method_name):
+            continue
+        ahead.setdefault(method_name, []).append(pkg_data)
+        setup_requires.setdefault(method_name, set()).update(step.requires)
+    for method_name, pkgs in ahead.items():
+        setup_requires[method_name] -= {pkg_data["id"] for pkg_data in pkgs}
+    # One per run, it is shut down at the end
+    context.prestager = Prestager() if ahead else None
+    setup_lock = threading.Lock()
+
+    def start_prestage(method_name: str) -> None:
+        # The job sets the method up first, which the first install would do anyway
+        method = context.get_method(method_name)
+        context.prestager.start(method_name, method.prestage_command(ahead[method_name]), context.env, method.ensure_ready)
+
+    def requirement_done(step_id: str) -> None:
+        # Started from the worker of the last setup requirement, not as a node of
+        # its own: that would queue behind the apt steps holding every worker
+        with setup_lock:
+            ready = []
+            for method_name, requires in setup_requires.items():
+                if step_id in requires:
+                    requires.discard(step_id)
+                    if not requires:
+                        ready.append(method_name)
+        for method_name in ready:
+            start_prestage(method_name)
+
+    def recently_failed(step_id: str) -> bool:
+        failed_at = context.failures.get(step_id)
+        if failed_at and time.time() - failed_at < FAILURE_TTL:
+            error(f"'{step_id}' failed {time.time() - failed_at:.0f}s ago, not retrying it yet")
+            return True
+        return False
+
+    def finished(step_id: str, success: bool) -> bool:
+        if success:
+            context.failures.pop(step_id, None)
+            if ahead:
+                requirement_done(step_id)
+        else:
+            context.failures[step_id] = time.time()
+        return success
+
+    def run(step: PlanStep) -> bool:
+        if recently_failed(step.id):
+            return False
+        if step.kind == "requirement":
+            # Added by the repositories node, with the other ones and one refresh
+            success = repositories.is_applied(step.id) if step.id in repositories.repositories else True
+        else:
+            pkg = catalog.packages[step.id]
+            success = context.install_package(pkg.to_pkg_data(step.method), METHOD_NAMES.get(step.method, step.method))
+        return finished(step.id, success)
+
+    # step id -> its batch node, for the package steps installed together
+    batched: dict[str, str] = {}
+    batches: dict[str, tuple[str, list[PlanStep]]] = {}
+    groups: dict[tuple[str, tuple[str, ...]], list[PlanStep]] = {}
+    for step in plan:
+        method = context.get_method(METHOD_NAMES.get(step.method, step.method)) if step.kind == "package" else None
+        if method and method.SUPPORTS_BATCH:
+            groups.setdefault((METHOD_NAMES.get(step.method, step.method), tuple(sorted(step.requires))), []).append(step)
+    for (method_name, _), steps in groups.items():
+        if len(steps) > 1:
+            node = BATCH_NODE.format(method=method_name, number=len(batches))
+            batches[node] = (method_name, steps)
+            batched.update((step.id, node) for step in steps)
+
+    # Steps left out of their batch, they failed moments ago
+    held_back: set[str] = set()
+
+    def run_batch(method_name: str, steps: list[PlanStep]) -> bool:
+        pkgs = []
+        for step in steps:
+            if recently_failed(step.id):
+                held_back.add(step.id)
+            else:
+                pkgs.append(catalog.packages[step.id].to_pkg_data(step.method))
+        context.install_packages(pkgs, method_name)
+        # Each step node reads its own outcome, installed now or before
+        return True
+
+    def run_batched(step: PlanStep) -> bool:
+        if step.id in held_back:
+            return False
+        pkg_data = catalog.packages[step.id].to_pkg_data(step.method)
+        return finished(step.id, context.is_satisfied(pkg_data, METHOD_NAMES.get(step.method, step.method)))
+
+    def add_repositories() -> bool:
+        # A repository that can't be added only fails the steps needing it
+        repositories.apply()
+        return repositories.refresh()
+
+    for method_name, requires in setup_requires.items():
+        if not requires:
+            start_prestage(method_name)
+    scheduler = Scheduler(max_workers=max_workers, controller=controller)
+    repository_steps = [step for step in plan if step.kind == "requirement" and step.id in repositories.repositories]
+    if repository_steps:
+        # Whatever the repositories need (extrepo, curl...) goes before them
+        needs = {req for step in repository_steps for req in step.requires}
+        scheduler.add(REPOSITORIES_NODE, add_repositories, requires=sorted(needs))
+    for node, (method_name, steps) in batches.items():
+        scheduler.add(node, lambda method_name=method_name, steps=steps: run_batch(method_name, steps), requires=steps[0].requires)
+    for step in plan:
+        if step.id in batched:
+            scheduler.add(step.id, lambda step=step: run_batched(step), requires=[batched[step.id]])
+        elif step in repository_steps:
+            scheduler.add(step.id, lambda step=step: run(step), requires=[REPOSITORIES_NODE, *step.requires])
+        else:
+            scheduler.add(step.id, lambda step=step: run(step), requires=step.requires)
+    results = scheduler.run()
+    for key in ("completed", "failed"):
+        results[key] = [name for name in results[key] if name != REPOSITORIES_NODE and name not in batches]
+
+    if ahead:
+        context.prestager.shutdown()
+        ok(f"Pre-staged downloads: {context.prestager.seconds():.1f}s, "
+           f"{context.prestager.hidden():.1f}s of it hidden behind other work")
+    return results
@@ -0,0 +1,191 @@
+import errno
+import fcntl
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional, TypeVar
+
+from dqs.core import events
+from dqs.utils.terminal_utils import log, error
+
+# ==================================================================
+'''
+WAITING AND RETRYING:
+- dpkg lock  -> on a freshly booted machine unattended-upgrades often holds
+                it. Before every apt/dpkg transaction dqs waits for the lock
+                files to be free (fcntl, the same kind of lock dpkg takes),
+                up to dpkg_lock_timeout(), and apt also gets
+                DPkg::Lock::Timeout for the race between the check and its
+                own locking (and for when dqs can't open the lock files).
+- network    -> transient errors (timeouts, resets, 5xx, 429) are retried
+                with full-jitter exponential backoff, then the next mirror
+                of the catalog is tried.
+Every wait and retry is counted, globally in TOTALS and per package through
+tracking() (see InstallationContext.results).
+'''
+# ==================================================================
+DPKG_LOCK_FILES = ["/var/lib/dpkg/lock-frontend", "/var/lib/dpkg/lock"]
+DEFAULT_DPKG_LOCK_TIMEOUT = 600
+
+RETRY_ATTEMPTS = 4
+RETRY_BASE = 1.0
+RETRY_CAP = 30.0
+TRANSIENT_HTTP_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+T = TypeVar("T")
+
+
+@dataclass
+class Counters:
+    lock_waits: int = 0
+    lock_wait_seconds: float = 0.0
+    retries: int = 0
+    failovers: int = 0
+
+    def add(self, other: "Counters") -> None:
+        self.lock_waits += other.lock_waits
+        self.lock_wait_seconds += other.lock_wait_seconds
+        self.retries += other.retries
+        self.failovers += other.failovers
+
+
+# Whole process
+TOTALS = Counters()
+_totals_lock = threading.Lock()
+_local = threading.local()
+
+
+def _count(**deltas: float) -> None:
+    delta = Counters(**deltas)
+    with _totals_lock:
+        TOTALS.add(delta)
+    for counters in getattr(_local, "stack", []):
+        counters.add(delta)
+
+
+@contextmanager
+def tracking() -> Iterator[Counters]:
+    """Counts the waits and retries done by this thread inside the block."""
+    counters = Counters()
+    stack = _local.__dict__.setdefault("stack", [])
+    stack.append(counters)
+    try:
+        yield counters
+    finally:
+        stack.remove(counters)
+
+
+# ==================================================================
+# DPKG LOCK
+# ==================================================================
+def _lock_is_free(fd: int) -> bool:
+    try:
+        # A shared lock can't be taken while dpkg/apt hold their write lock
+        fcntl.lockf(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except OSError as e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        raise
+    fcntl.lockf(fd, fcntl.LOCK_UN)
+    return True
+
+
+def dpkg_lock_timeout() -> int:
+    """Seconds to wait for the dpkg lock, DQS_DPKG_LOCK_TIMEOUT or DEFAULT_DPKG_LOCK_TIMEOUT when it isn't a number."""
+    value = os.environ.get("DQS_DPKG_LOCK_TIMEOUT")
+    if value is not None:
+        try:
+            return int(value)
+        except ValueError:
+            error(f"DQS_DPKG_LOCK_TIMEOUT is not a number of seconds: {value!r}, using {DEFAULT_DPKG_LOCK_TIMEOUT}")
+    return DEFAULT_DPKG_LOCK_TIMEOUT
+
+
+def apt_lock_args() -> tuple[str, ...]:
+    """For apt and apt-get, before the subcommand."""
+    return ("-o", f"DPkg::Lock::Timeout={dpkg_lock_timeout()}")
+
+
+def apt_lock_option() -> str:
+    """apt_lock_args() for shell command lines."""
+    return " ".join(apt_lock_args())
+
+
+def wait_for_dpkg_lock(timeout: Optional[float] = None) -> bool:
+    """
+    Blocks until no other process holds the dpkg lock files. False on
+    timeout. Lock files that can't be opened (not root) are left to apt's
+    own DPkg::Lock::Timeout.
+    """
+    timeout = dpkg_lock_timeout() if timeout is None else timeout
+    start = time.monotonic()
+    delay = 0.1
+    # Path of the first busy lock file, if any
+    waited = None
+    for path in DPKG_LOCK_FILES:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            while not _lock_is_free(fd):
+                if not waited:
+                    log(f"Waiting for the dpkg lock ({path}), another process is using it...")
+                    events.publish("lock.waiting", path=path)
+                    waited = path
+                if time.monotonic() - start > timeout:
+                    error(f"Gave up waiting for the dpkg lock after {timeout:.0f}s")
+                    _count(lock_waits=1, lock_wait_seconds=time.monotonic() - start)
+                    events.publish("lock.acquired", path=waited, seconds=round(time.monotonic() - start, 3), timed_out=True)
+                    return False
+                time.sleep(delay)
+                delay = min(delay * 2, 2.0)
+        finally:
+            os.close(fd)
+    if waited:
+        _count(lock_waits=1, lock_wait_seconds=time.monotonic() - start)
+        events.publish("lock.acquired", path=waited, seconds=round(time.monotonic() - start, 3), timed_out=False)
+    return True
+
+
+# ==================================================================
+# BACKOFF
+# ==================================================================
+def backoff_delays(attempts: int = RETRY_ATTEMPTS, base: float = RETRY_BASE, cap: float = RETRY_CAP) -> Iterator[float]:
+    """Full jitter: uniform in [0, min(cap, base * 2^n)], one delay between each pair of attempts."""
+    for attempt in range(attempts - 1):
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_transient(e: BaseException) -> bool:
+    """Network errors worth retrying against the same server."""
+    import http.client
+    import urllib.error
+
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code in TRANSIENT_HTTP_CODES
+    return isinstance(e, (urllib.error.URLError, TimeoutError, ConnectionError, http.client.HTTPException))
+
+
+def call(func: Callable[[], T], describe: str, attempts: int = RETRY_ATTEMPTS, transient: Callable[[BaseException], bool] = is_transient) -> T:
+    """Calls func, retrying transient errors with backoff. The last error is raised."""
+    delays = backoff_delays(attempts)
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            delay = next(delays, None) if transient(e) else None
+            if delay is None:
+                raise
+            log(f"{describe} failed ({e}), retrying in {delay:.1f}s...")
+            events.publish("download.retry", what=describe, error=str(e), delay=round(delay, 3))
+            _count(retries=1)
+            time.sleep(delay)
+
+
+def failover(describe: str, source: str) -> None:
+    log(f"{describe}: trying mirror {source}")
+    _count(failovers=1)
@@ -0,0 +1,202 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager, nullcontext, ExitStack
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional
+
+from dqs.core import events, timings
+from dqs.utils.terminal_utils import log, ok, error
+
+if TYPE_CHECKING:
+    from dqs.core.concurrency import ConcurrencyController
+    from dqs.core.journal import Journal
+
+# ==================================================================
+'''
+RESOURCE CLASSES:
+- dpkg      -> exclusive, anything that takes the system package database lock
+               (apt/dpkg, and the equivalent rpm/pacman lock on other distros)
+- network   -> shared, plain downloads
+- flatpak   -> shared
+- homebrew  -> shared
+Only exclusive resources are actually locked, the rest are informative and
+run freely inside the worker pool.
+'''
+# ==================================================================
+DPKG_LOCK = "dpkg"
+EXCLUSIVE_RESOURCES = {DPKG_LOCK}
+
+_RESOURCE_LOCKS: dict[str, threading.RLock] = {name: threading.RLock() for name in EXCLUSIVE_RESOURCES}
+
+
+@contextmanager
+def resource_lock(*resources: str) -> Iterator[None]:
+    """Holds the locks of the exclusive resources given (re-entrant per thread)."""
+    with ExitStack() as stack:
+        # Sorted so two nodes asking for the same locks can't deadlock
+        for name in sorted(set(resources) & EXCLUSIVE_RESOURCES):
+            stack.enter_context(_RESOURCE_LOCKS[name])
+        yield
+
+
+# ==================================================================
+# TASK GRAPH
+# ==================================================================
+@dataclass
+class Node:
+    name: str
+    run: Callable[[], bool]
+    requires: list[str] = field(default_factory=list)
+    resources: set[str] = field(default_factory=set)
+    # Definition hash checked against the journal, None never resumes
+    key: Optional[str] = None
+    # Its only effect is on this process (environment variables...): runs
+    # again on resume, and once it succeeds its dependents may still be skipped
+    rerun: bool = False
+
+
+class Scheduler:
+    """
+    Runs a dependency graph of tasks in a worker pool, starting every node as
+    soon as all its requirements are done. With a journal, nodes completed by
+    an interrupted run are skipped (see dqs.core.journal). With a
+    controller, the number of nodes running at once follows the load of the
+    host instead of max_workers (see dqs.core.concurrency).
+    """
+    def __init__(self, max_workers: int = 4, journal: Optional["Journal"] = None,
+                 controller: Optional["ConcurrencyController"] = None):
+        self.max_workers = controller.maximum if controller else max_workers
+        self.journal = journal
+        self.controller = controller
+        self.nodes: dict[str, Node] = {}
+
+    def add(self, name: str, run: Callable[[], bool], requires: Iterable[str] = (), resources: Iterable[str] = (),
+            key: Optional[str] = None, rerun: bool = False) -> None:
+        """Adds a task to the graph."""
+        self.nodes[name] = Node(name, run, list(requires), set(resources), key, rerun)
+
+    def run(self) -> dict[str, list[str]]:
+        """
+        Runs the whole graph and returns the names of completed and failed
+        tasks. Nodes skipped thanks to the journal count as completed and are
+        also listed under "resumed".
+        """
+        results = {"completed": [], "failed": [], "resumed": []}
+        events.publish("run.started", total=len(self.nodes), workers=self.controller.limit if self.controller else self.max_workers)
+
+        dependents: dict[str, list[str]] = {name: [] for name in self.nodes}
+        pending: dict[str, int] = {}
+        for node in self.nodes.values():
+            missing = [req for req in node.requires if req not in self.nodes]
+            if missing:
+                error(f"Task '{node.name}' requires unknown tasks: {', '.join(missing)}")
+                pending[node.name] = -1
+                continue
+            pending[node.name] = len(node.requires)
+            for req in node.requires:
+                dependents[req].append(node.name)
+
+        failed: set[str] = set()
+
+        def fail(name: str, ran: bool = True) -> None:
+            # A failed node takes all its dependents with it
+            stack = [name]
+            while stack:
+                current = stack.pop()
+                if current in failed:
+                    continue
+                failed.add(current)
+                results["failed"].append(current)
+                pending.pop(current, None)
+                stack.extend(dependents.get(current, []))
+                if current != name:
+                    events.publish("task.finished", task=current, status="cancelled", seconds=0.0)
+                elif not ran:
+                    events.publish("task.finished", task=current, status="failed", seconds=0.0)
+
+        for name, count in list(pending.items()):
+            if count == -1:
+                fail(name, ran=False)
+
+        with self.controller or nullcontext(), ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            running = {}
+
+            resumed: set[str] = set()
+            # Resumable nodes run again because they only change this process
+            replaying: set[str] = set()
+
+            def complete(name: str) -> None:
+                results["completed"].append(name)
+                for dependent in dependents[name]:
+                    if dependent in pending:
+                        pending[dependent] -= 1
+
+            def submit_ready() -> None:
+                ready = [name for name, count in pending.items() if count == 0]
+                while ready:
+                    name = ready.pop(0)
+                    del pending[name]
+                    node = self.nodes[name]
+                    # Only if every requirement was skipped too: anything
+                    # downstream of a re-run node runs again
+                    skippable = self.journal and self.journal.is_done(name, node.key) and all(req in resumed for req in node.requires)
+                    if skippable and node.rerun:
+                        replaying.add(name)
+                    elif skippable:
+                        log(f"Already done in the previous run: {name}")
+                        resumed.add(name)
+                        results["resumed"].append(name)
+                        events.publish("task.finished", task=name, status="resumed", seconds=0.0)
+                        complete(name)
+                        ready.extend(dep for dep in dependents[name] if pending.get(dep) == 0 and dep not in ready)
+                        continue
+                    events.publish("task.queued", task=name)
+                    running[pool.submit(self._run_node, node)] = name
+
+            submit_ready()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    success = future.result()
+                    if self.journal:
+                        self.journal.record(name, self.nodes[name].key, success)
+                    if success:
+                        if name in replaying:
+                            resumed.add(name)
+                        complete(name)
+                    else:
+                        fail(name)
+                submit_ready()
+
+        # Whatever is still pending never got its requirements done: a cycle
+        if pending:
+            error(f"Dependency cycle between tasks: {', '.join(sorted(pending))}")
+            for name in list(pending):
+                fail(name, ran=False)
+
+        events.publish("run.finished", completed=len(results["completed"]), failed=len(results["failed"]))
+        return results
+
+    def _run_node(self, node: Node) -> bool:
+        start = time.monotonic()
+        events.publish("task.started", task=node.name)
+        with events.running(node.name), timings.task(node.name, node.requires, node.resources & EXCLUSIVE_RESOURCES) as record:
+            try:
+                # The slot after the locks: waiting on dpkg doesn't take one
+                with resource_lock(*node.resources), self.controller.slot() if self.controller else nullcontext():
+                    success = node.run()
+            except Exception as e:
+                error(f"Task '{node.name}' raised: {e}")
+                success = False
+            if record and not success:
+                record.status = "failed"
+
+            if success:
+                ok(f"Task completed: {node.name}")
+            else:
+                error(f"Task failed: {node.name}")
+        events.publish("task.finished", task=node.name, status="completed" if success else "failed",
+                       seconds=round(time.monotonic() - start, 3))
+        return bool(success)
@@ -0,0 +1,478 @@
+import bisect
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import subprocess
+from array import array
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Optional
+
+from dqs.utils.paths import CACHE_DIR
+
+# ==================================================================
+'''
+PACKAGE SEARCH:
+Everything the system could install, not only the catalog: the apt lists,
+the apps of the flatpak remotes and the Homebrew formulas. Each source gets
+an index file of its own under SEARCH_DIR, built again only when the mtime
+or the size of what it was built from changes (an `apt update` rewrites only
+the lists that changed):
+- apt      -> /var/lib/apt/lists/*_Packages, read through an mmap: only the
+              Package, Version and Description lines of each stanza are
+              sliced out, nothing else is decoded
+- flatpak  -> `flatpak remote-ls --cached --app`, streamed line by line
+- homebrew -> the formula API cache brew keeps (formula.jws.json)
+
+Index file, native byte order (it never leaves the machine):
+  header     magic, format, records, then trigrams and postings per table
+  offsets    uint32 per record + 1, where its line starts
+  2 tables   trigrams of the names, then of the names and summaries:
+             3 bytes per trigram (sorted), uint32 start and count per
+             trigram, uint32 record numbers
+  records    "name\\tversion\\tsummary\\n" per package, sorted by lowercase name
+Searches mmap the files and bisect them, nothing is loaded up front:
+- prefix   -> bisect over the sorted names
+- trigram  -> intersection of the postings of every trigram of the query,
+              then the candidates are checked
+Results come by tier (exact name, name prefix, name, summary), and each tier
+is walked in name order until there are enough of them.
+'''
+# ==================================================================
+SEARCH_DIR = os.path.join(CACHE_DIR, "search")
+APT_LISTS = "/var/lib/apt/lists"
+FLATPAK_APPSTREAM = ["/var/lib/flatpak/appstream/*/*/active", os.path.expanduser("~/.local/share/flatpak/appstream/*/*/active")]
+HOMEBREW_API = os.path.join(os.environ.get("HOMEBREW_CACHE") or os.path.expanduser("~/.cache/Homebrew"), "api", "formula.jws.json")
+
+MAGIC = b"DQSI"
+# Bump when the layout changes, every index is built again
+INDEX_FORMAT = 1
+MANIFEST = "sources.json"
+_HEADER = struct.Struct("=4sIIIIII")
+# Results ranked by how the query matched
+EXACT, PREFIX, NAME, SUMMARY = range(4)
+
+
+@dataclass(slots=True, frozen=True)
+class Result:
+    name: str
+    version: str
+    summary: str
+    # Installation method of the catalog: apt, flatpak or homebrew
+    method: str
+    rank: int = SUMMARY
+
+
+def catalog_entry(result: Result) -> tuple[str, dict[str, Any]]:
+    """Id and catalog entry (see dqs/data/packages.json) installing the result."""
+    name = result.name
+    pkg_id = name.rsplit(".", 1)[-1].lower() if result.method == "flatpak" else name
+    install: dict[str, Any]
+    if result.method == "flatpak":
+        install = {"command": f"flatpak install -y flathub {name}", "packages": [name], "requires": ["flatpak"]}
+    elif result.method == "homebrew":
+        install = {"command": f"brew install {name}", "requires": ["homebrew"]}
+    else:
+        install = {"command": f"sudo apt install -y {name}", "requires": []}
+    return pkg_id, {
+        "id": pkg_id,
+        "name": name.rsplit(".", 1)[-1] if result.method == "flatpak" else name,
+        "description": result.summary,
+        "category": "added",
+        "methods": [result.method],
+        "default_method": result.method,
+        "install": {result.method: install},
+    }
+
+
+# ==================================================================
+# SOURCES
+# ==================================================================
+def parse_packages(path: str) -> Iterator[tuple[bytes, bytes, bytes]]:
+    """(name, version, summary) of every stanza of an apt Packages file."""
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return
+    with mm:
+        size = len(mm)
+        start = 0
+        while start < size:
+            if mm[start] == 0x0A:
+                start += 1
+                continue
+            end = mm.find(b"\n\n", start)
+            end = size if end == -1 else end
+            if mm[start:start + 9] == b"Package: ":
+                line_end = mm.find(b"\n", start, end)
+                name = mm[start + 9:end if line_end == -1 else line_end].strip()
+                yield name, _field(mm, b"\nVersion: ", start, end), _field(mm, b"\nDescription: ", start, end)
+            start = end + 2
+
+
+def _field(mm: mmap.mmap, tag: bytes, start: int, end: int) -> bytes:
+    at = mm.find(tag, start, end)
+    if at == -1:
+        return b""
+    at += len(tag)
+    line_end = mm.find(b"\n", at, end)
+    return mm[at:end if line_end == -1 else line_end].strip()
+
+
+def _clean(text: str) -> bytes:
+    return text.replace("\t", " ").replace("\n", " ").strip().encode()
+
+
+def parse_flatpak() -> Iterator[tuple[bytes, bytes, bytes]]:
+    """Apps of every flatpak remote, from the metadata flatpak already has."""
+    try:
+        process = subprocess.Popen(["flatpak", "remote-ls", "--cached", "--app", "--columns=application,version,description"],
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, close_fds=True)
+    except OSError:
+        return
+    with process:
+        for line in process.stdout:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0]:
+                yield _clean(fields[0]), _clean(fields[1] if len(fields) > 1 else ""), _clean(fields[2] if len(fields) > 2 else "")
+
+
+def parse_homebrew(path: str) -> Iterator[tuple[bytes, bytes, bytes]]:
+    """Formulas of the Homebrew API cache, decoded one at a time."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    # The signed file wraps the list in a string, an older cache is the list itself
+    if isinstance(data, dict):
+        text = data.get("payload", "[]")
+    else:
+        text = json.dumps(data)
+    decoder = json.JSONDecoder()
+    position = text.index("[") + 1
+    while True:
+        while position < len(text) and text[position] in " \t\r\n,":
+            position += 1
+        if position >= len(text) or text[position] == "]":
+            return
+        formula, position = decoder.raw_decode(text, position)
+        versions = formula.get("versions") or {}
+        yield _clean(formula.get("name", "")), _clean(versions.get("stable") or ""), _clean(formula.get("desc") or "")
+
+
+def _stamp(paths: list[str]) -> Optional[list[int]]:
+    stamps = []
+    for path in paths:
+        try:
+            stat = os.lstat(path)
+        except OSError:
+            continue
+        stamps += [stat.st_mtime_ns, stat.st_size]
+    return stamps or None
+
+
+def sources() -> dict[str, tuple[str, list[int], Callable[[], Iterator]]]:
+    """source key -> (method, stamp, lazy record iterator) of what is on this system."""
+    found: dict[str, tuple[str, list[int], Callable[[], Iterator]]] = {}
+    for path in sorted(glob.glob(os.path.join(APT_LISTS, "*_Packages"))):
+        found[path] = ("apt", _stamp([path]), lambda path=path: parse_packages(path))
+    appstream = sorted(path for pattern in FLATPAK_APPSTREAM for path in glob.glob(pattern))
+    if appstream:
+        found["flatpak"] = ("flatpak", _stamp(appstream), parse_flatpak)
+    if os.path.exists(HOMEBREW_API):
+        found["homebrew"] = ("homebrew", _stamp([HOMEBREW_API]), lambda: parse_homebrew(HOMEBREW_API))
+    return found
+
+
+# ==================================================================
+# INDEX FILES
+# ==================================================================
+def trigrams(text: bytes) -> set[bytes]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _table(postings: dict[bytes, array]) -> list[bytes]:
+    keys = sorted(postings)
+    table = array("I")
+    numbers = array("I")
+    for key in keys:
+        table += array("I", [len(numbers), len(postings[key])])
+        numbers += postings[key]
+    return [b"".join(keys), table.tobytes(), numbers.tobytes()]
+
+
+def write_index(path: str, records: Iterator[tuple[bytes, bytes, bytes]]) -> int:
+    """Writes the index of the records into path, returns how many it holds."""
+    rows = sorted(set(records), key=lambda row: (row[0].lower(), row[0]))
+    lines = [b"%s\t%s\t%s\n" % row for row in rows]
+    names: dict[bytes, array] = {}
+    texts: dict[bytes, array] = {}
+    for number, (name, _, summary) in enumerate(rows):
+        in_name = trigrams(name.lower())
+        for postings, grams in ((names, in_name), (texts, in_name | trigrams(summary.lower()))):
+            for trigram in grams:
+                entry = postings.get(trigram)
+                if entry is None:
+                    entry = postings[trigram] = array("I")
+                entry.append(number)
+
+    offsets = array("I", [0])
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    part = f"{path}.part"
+    with open(part, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, INDEX_FORMAT, len(rows), len(names), sum(map(len, names.values())),
+                             len(texts), sum(map(len, texts.values()))))
+        f.write(offsets.tobytes())
+        f.writelines(_table(names))
+        f.writelines(_table(texts))
+        f.writelines(lines)
+    os.replace(part, path)
+    return len(rows)
+
+
+class _Sorted:
+    """Items of a sorted on-disk array as a sequence, for bisect."""
+    def __init__(self, size: int, item: Callable[[int], bytes]):
+        self.size = size
+        self.item = item
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, number: int) -> bytes:
+        return self.item(number)
+
+
+class _Trigrams:
+    """One trigram table of an index file: sorted keys, then (start, count) and the postings."""
+    def __init__(self, view: memoryview, position: int, count: int, postings: int):
+        self._keys = view[position:position + 3 * count]
+        position += 3 * count
+        self._table = view[position:position + 8 * count].cast("I")
+        position += 8 * count
+        self._postings = view[position:position + 4 * postings].cast("I")
+        self.end = position + 4 * postings
+        self._sorted = _Sorted(count, lambda number: bytes(self._keys[3 * number:3 * number + 3]))
+
+    def release(self) -> None:
+        for view in (self._keys, self._table, self._postings):
+            view.release()
+
+    def postings(self, trigram: bytes) -> memoryview:
+        at = bisect.bisect_left(self._sorted, trigram)
+        if at == len(self._sorted) or self._sorted[at] != trigram:
+            return self._postings[0:0]
+        start, count = self._table[2 * at], self._table[2 * at + 1]
+        return self._postings[start:start + count]
+
+    def candidates(self, words: list[bytes]) -> Optional[set[int]]:
+        """
+        Records holding the rarest trigrams of every word, a superset of the
+        matches. None if no word is long enough to have a trigram.
+        """
+        grams: set[bytes] = set()
+        for word in words:
+            # The rarest two of each word narrow it down enough, the candidates are checked anyway
+            grams.update(sorted(trigrams(word), key=lambda gram: len(self.postings(gram)))[:2])
+        if not grams:
+            return None
+        # Rarest first, the set only shrinks from there
+        grams = sorted(grams, key=lambda gram: len(self.postings(gram)))
+        found = set(self.postings(grams[0]))
+        for gram in grams[1:]:
+            if not found:
+                break
+            found.intersection_update(self.postings(gram))
+        return found
+
+
+class IndexFile:
+    """One mmapped index file."""
+    def __init__(self, path: str, method: str):
+        self.method = method
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, *tables = _HEADER.unpack_from(self._mm)
+        if magic != MAGIC or version != INDEX_FORMAT:
+            self._mm.close()
+            raise ValueError(f"Not a search index: {path}")
+        view = memoryview(self._mm)
+        position = _HEADER.size
+        self._offsets = view[position:position + 4 * (self.count + 1)].cast("I")
+        position += 4 * (self.count + 1)
+        # Trigrams of the names, and of the names and summaries
+        self.names = _Trigrams(view, position, tables[0], tables[1])
+        self.texts = _Trigrams(view, self.names.end, tables[2], tables[3])
+        self._records = self.texts.end
+        view.release()
+        self._names = _Sorted(self.count, lambda number: self.line(number).split(b"\t", 1)[0].lower())
+
+    def close(self) -> None:
+        self._offsets.release()
+        self.names.release()
+        self.texts.release()
+        self._mm.close()
+
+    def line(self, number: int) -> bytes:
+        return self._mm[self._records + self._offsets[number]:self._records + self._offsets[number + 1] - 1]
+
+    def prefix(self, prefix: bytes) -> range:
+        """Record numbers whose lowercase name starts with prefix."""
+        start = bisect.bisect_left(self._names, prefix)
+        end = bisect.bisect_left(self._names, prefix + b"\xff", start)
+        return range(start, end)
+
+    def search(self, words: list[bytes], limit: int) -> list[tuple[int, bytes]]:
+        """
+        (rank, line) of the first limit records holding every word, by rank
+        and then name. Each tier is walked in name order and the walk stops
+        as soon as limit records are found.
+        """
+        first = words[0]
+        found: list[tuple[int, bytes]] = []
+
+        def matches(line: bytes) -> bool:
+            lower = line.lower()
+            return all(word in lower for word in words)
+
+        prefixed = self.prefix(first)
+        for number in prefixed:
+            line = self.line(number)
+            if len(words) == 1 or matches(line):
+                found.append((EXACT if line.split(b"\t", 1)[0].lower() == first else PREFIX, line))
+                if len(found) == limit:
+                    return found
+
+        candidates = self.texts.candidates(words)
+        if not candidates:
+            return found
+        named = self.names.candidates([first]) if len(first) >= 3 else set()
+        named = (named or set()) & candidates
+        summary: list[int] = []
+        for number in sorted(named):
+            if number in prefixed:
+                continue
+            line = self.line(number)
+            if not matches(line):
+                continue
+            if first not in line.split(b"\t", 1)[0].lower():
+                # The trigrams are in the name but not the word, it matched elsewhere
+                summary.append(number)
+                continue
+            found.append((NAME, line))
+            if len(found) == limit:
+                return found
+
+        for number in sorted(summary + sorted(candidates - named)):
+            if number in prefixed:
+                continue
+            line = self.line(number)
+            if matches(line):
+                found.append((SUMMARY, line))
+                if len(found) == limit:
+                    break
+        return found
+
+
+# ==================================================================
+# SEARCH
+# ==================================================================
+class PackageIndex:
+    """The index files of every source, updated on demand and searched together."""
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or SEARCH_DIR
+        self._files: dict[str, IndexFile] = {}
+        # source key -> method of the sources indexed, None until update()
+        self._methods: Optional[dict[str, str]] = None
+        # Source keys built again by the last update()
+        self.rebuilt: list[str] = []
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{hashlib.sha1(key.encode()).hexdigest()[:16]}.idx")
+
+    def update(self) -> list[str]:
+        """Builds the index of every new or changed source, drops the ones gone. Returns the rebuilt keys."""
+        os.makedirs(self.directory, exist_ok=True)
+        manifest_path = os.path.join(self.directory, MANIFEST)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get("format") != INDEX_FORMAT:
+                manifest = {}
+        except (OSError, ValueError):
+            manifest = {}
+        known = dict(manifest.get("sources", {}))
+
+        current = sources()
+        self.rebuilt = []
+        for key, (method, stamp, records) in current.items():
+            path = self._path(key)
+            if known.get(key, {}).get("stamp") == stamp and os.path.exists(path):
+                continue
+            self._close(key)
+            count = write_index(path, records())
+            known[key] = {"method": method, "stamp": stamp, "packages": count}
+            self.rebuilt.append(key)
+        for key in set(known) - set(current):
+            self._close(key)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            del known[key]
+
+        if known != manifest.get("sources") or not manifest:
+            with open(f"{manifest_path}.part", "w") as f:
+                json.dump({"format": INDEX_FORMAT, "sources": known}, f, indent=2)
+            os.replace(f"{manifest_path}.part", manifest_path)
+        self._methods = {key: entry["method"] for key, entry in known.items()}
+        return self.rebuilt
+
+    def _close(self, key: str) -> None:
+        index = self._files.pop(key, None)
+        if index:
+            index.close()
+
+    def files(self) -> list[IndexFile]:
+        if self._methods is None:
+            self.update()
+        for key, method in self._methods.items():
+            if key not in self._files:
+                try:
+                    self._files[key] = IndexFile(self._path(key), method)
+                except (OSError, ValueError):
+                    continue
+        return list(self._files.values())
+
+    def close(self) -> None:
+        for key in list(self._files):
+            self._close(key)
+
+    def search(self, query: str, limit: int = 20, method: Optional[str] = None) -> list[Result]:
+        """
+        Packages whose name or summary holds every word of the query: exact
+        names first, then names starting with the first word, names holding
+        it and last the summaries, by name within each group.
+        """
+        words = [word.encode() for word in query.lower().split()]
+        if not words:
+            return []
+        found: dict[tuple[str, bytes], tuple[int, bytes]] = {}
+        for index in self.files():
+            if method and index.method != method:
+                continue
+            for rank, line in index.search(words, limit):
+                key = (index.method, line.split(b"\t", 1)[0])
+                # The same package in several lists (main, updates...) is listed once
+                if key not in found or rank < found[key][0]:
+                    found[key] = (rank, line)
+
+        best = sorted(found.items(), key=lambda item: (item[1][0], item[0][1].lower()))[:limit]
+        results = []
+        for (method_name, _), (rank, line) in best:
+            name, version, summary = line.decode(errors="replace").split("\t", 2)
+            results.append(Result(name, version, summary, method_name, rank))
+        return results
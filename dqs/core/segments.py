@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Optional
+
+from dqs.core import events, retry
+from dqs.utils.terminal_utils import log
+
+# ==================================================================
+'''
+SEGMENTED DOWNLOADS:
+Artifacts of at least SEGMENT_THRESHOLD bytes, from servers that accept byte
+ranges, are split into SEGMENT_SIZE segments. SEGMENT_WORKERS connections
+fetch them in parallel and write them in place (pwrite) into a preallocated
+file.
+The sha256 is computed while the bytes arrive. The segment at the hashing
+frontier is hashed straight from the network buffers. When the frontier
+moves into a segment that is already (partly) written, the bytes it skipped
+are read back once, from the page cache. There is no second pass over the
+finished file.
+Completed segments are recorded next to the partial file (<partial>.json),
+together with the size and validator of the remote file. An interrupted
+download resumes from them, as long as the remote file didn't change.
+'''
+# ==================================================================
+SEGMENT_THRESHOLD = 16 * 1024 * 1024
+SEGMENT_SIZE = 8 * 1024 * 1024
+SEGMENT_WORKERS = 4
+CHUNK_SIZE = 1024 * 256
+
+
+def segmented_size(response: Any) -> Optional[int]:
+    """Size of the body of response when it's worth fetching in segments, None otherwise."""
+    if response.status != 200 or response.headers.get("Accept-Ranges", "").lower() != "bytes":
+        return None
+    # Ranges of a compressed transfer don't map to offsets of the file
+    if response.headers.get("Content-Encoding"):
+        return None
+    try:
+        size = int(response.headers.get("Content-Length", ""))
+    except ValueError:
+        return None
+    return size if size >= SEGMENT_THRESHOLD else None
+
+
+def validator(response: Any) -> Optional[str]:
+    """Value for If-Range: a strong ETag or else Last-Modified (weak ETags aren't allowed)."""
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+class _Progress:
+    """Bytes written of every segment and the in order sha256 of the file."""
+
+    def __init__(self, fd: int, size: int, segment_size: int, done: set[int]):
+        self.fd = fd
+        self.size = size
+        self.segment_size = segment_size
+        count = -(-size // segment_size)
+        self.written = [self.length(index) if index in done else 0 for index in range(count)]
+        self.digest = hashlib.sha256()
+        self.hashed = 0
+        self._lock = threading.Lock()
+        with self._lock:
+            self._advance()
+
+    def length(self, index: int) -> int:
+        return min(self.segment_size, self.size - index * self.segment_size)
+
+    def wrote(self, index: int, offset: int, chunk: bytes) -> None:
+        """Called after chunk was written at offset (absolute) by the worker of segment index."""
+        with self._lock:
+            self.written[index] = offset + len(chunk) - index * self.segment_size
+            if offset == self.hashed:
+                self.digest.update(chunk)
+                self.hashed += len(chunk)
+            self._advance()
+
+    def _advance(self) -> None:
+        # Catches up with the bytes past the frontier that are already on disk
+        while self.hashed < self.size:
+            index = self.hashed // self.segment_size
+            available = index * self.segment_size + self.written[index]
+            if self.hashed >= available:
+                return
+            data = os.pread(self.fd, min(available - self.hashed, CHUNK_SIZE * 16), self.hashed)
+            if not data:
+                raise OSError(f"Short read hashing at offset {self.hashed}")
+            self.digest.update(data)
+            self.hashed += len(data)
+
+
+def _load_state(path: str) -> dict[str, Any]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(path: str, state: dict[str, Any]) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def discard(partial: str) -> None:
+    """Removes a partial download and its segment state."""
+    for path in (partial, f"{partial}.json"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def download(url: str, size: int, remote_validator: Optional[str], partial: str,
+             headers: dict[str, str], timeout: float, label: Optional[str] = None) -> str:
+    """
+    Downloads the size bytes of url into partial in parallel segments and
+    returns their sha256. The completed segments of a previous attempt on
+    the same remote file are reused. partial is left in place (with its
+    state) if the download fails, so the next attempt resumes it. Progress
+    events are published under label (url by default).
+    """
+    label = label or url
+    import urllib.request
+
+    state_path = f"{partial}.json"
+    state = _load_state(state_path)
+    resumable = (
+        remote_validator is not None
+        and state.get("size") == size
+        and state.get("validator") == remote_validator
+        and state.get("segment_size") == SEGMENT_SIZE
+        and os.path.exists(partial)
+        and os.path.getsize(partial) == size
+    )
+    if not resumable:
+        state = {"size": size, "validator": remote_validator, "segment_size": SEGMENT_SIZE, "done": []}
+    done = set(state["done"])
+
+    fd = os.open(partial, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if not resumable:
+            os.ftruncate(fd, 0)
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                # Filesystems without fallocate (tmpfs on old kernels, some FUSE)
+                os.ftruncate(fd, size)
+            _save_state(state_path, state)
+        progress = _Progress(fd, size, SEGMENT_SIZE, done)
+        pending = [index for index in range(len(progress.written)) if index not in done]
+        if done:
+            log(f"Resuming {url}: {len(done)}/{len(progress.written)} segments already downloaded")
+
+        stop = threading.Event()
+        state_lock = threading.Lock()
+
+        def fetch_range(index: int) -> None:
+            start = index * SEGMENT_SIZE + progress.written[index]
+            end = index * SEGMENT_SIZE + progress.length(index) - 1
+            range_headers = {**headers, "Range": f"bytes={start}-{end}"}
+            if remote_validator:
+                range_headers["If-Range"] = remote_validator
+            request = urllib.request.Request(url, headers=range_headers)
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                if response.status != 206 or not response.headers.get("Content-Range", "").startswith(f"bytes {start}-"):
+                    # 200: the file changed under us (If-Range) or the range was ignored
+                    raise OSError(f"{url} did not return the requested range, it may have changed")
+                offset = start
+                while offset <= end:
+                    if stop.is_set():
+                        raise InterruptedError("Download cancelled")
+                    chunk = response.read(min(CHUNK_SIZE, end + 1 - offset))
+                    if not chunk:
+                        raise ConnectionError(f"Connection closed at byte {offset} of {url}")
+                    os.pwrite(fd, chunk, offset)
+                    progress.wrote(index, offset, chunk)
+                    offset += len(chunk)
+                    events.progress(label, "download.progress", url=label, bytes=sum(progress.written), total=size)
+
+        def segment(index: int) -> None:
+            # A retry resumes the segment where the failed attempt stopped
+            retry.call(lambda: fetch_range(index), f"Segment {index} of {url}")
+            with state_lock:
+                done.add(index)
+                state["done"] = sorted(done)
+                _save_state(state_path, state)
+
+        failure = None
+        with ThreadPoolExecutor(max_workers=SEGMENT_WORKERS, thread_name_prefix="segment") as pool:
+            futures = [pool.submit(segment, index) for index in pending]
+            try:
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # The other segments still finish, the next attempt resumes from them
+                        failure = failure or e
+            finally:
+                # Ctrl+C stops every segment
+                stop.set()
+        if failure:
+            raise failure
+
+        if progress.hashed != size:
+            raise OSError(f"Only {progress.hashed} of {size} bytes of {url} could be verified")
+        return progress.digest.hexdigest()
+    finally:
+        os.close(fd)
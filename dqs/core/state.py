@@ -0,0 +1,108 @@
+import os
+import shutil
+import subprocess
+from typing import Optional
+
+from dqs.utils import paths
+
+# ==================================================================
+'''
+Snapshot of what is already installed on the system, collected in a single
+pass per backend so reruns can skip satisfied packages without forking a
+package manager (or a shell) per package:
+- dpkg     -> /var/lib/dpkg/status parsed directly
+- rpm      -> one `rpm -qa`
+- pacman   -> one `pacman -Qq`
+- flatpak  -> one `flatpak list --app --columns=application`
+- homebrew -> one `brew list --versions`
+- tarball  -> one listing of OPT_DIR
+'''
+# ==================================================================
+DPKG_STATUS = "/var/lib/dpkg/status"
+
+# Installation methods whose packages end up in the system package database
+SYSTEM_METHODS = {"pkg_manager", "deb"}
+
+
+def parse_dpkg_status(path: Optional[str] = None) -> set[str]:
+    """Returns the names of the packages dpkg has fully installed."""
+    # Looked up at call time so a simulated system (benchmarks/harness.py) can point it elsewhere
+    path = path or DPKG_STATUS
+    installed = set()
+    package = None
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if line.startswith("Package: "):
+                    package = line[9:].strip()
+                elif line.startswith("Status: ") and package and line.rstrip().endswith(" installed"):
+                    installed.add(package)
+    except OSError:
+        pass
+    return installed
+
+
+def _command_lines(argv: list[str], env: Optional[dict[str, str]] = None) -> list[str]:
+    executable = shutil.which(argv[0], path=(env or os.environ).get("PATH"))
+    if not executable:
+        return []
+    try:
+        result = subprocess.run([executable, *argv[1:]], capture_output=True, text=True, env=env, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return []
+    if result.returncode != 0:
+        return []
+    return [line.strip() for line in result.stdout.splitlines() if line.strip()]
+
+
+class SystemState:
+    """Installed packages per backend, with O(1) lookups."""
+
+    def __init__(self, distro_based: str = "debian", env: Optional[dict[str, str]] = None):
+        self.distro_based = distro_based
+        self.env = env
+        self.system: set[str] = set()
+        self.flatpak: set[str] = set()
+        self.homebrew: set[str] = set()
+        self.tarball: set[str] = set()
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Collects the whole system state again."""
+        if self.distro_based == "debian":
+            self.system = parse_dpkg_status()
+        elif self.distro_based == "fedora":
+            self.system = set(_command_lines(["rpm", "-qa", "--qf", "%{NAME}\\n"], self.env))
+        elif self.distro_based == "arch":
+            self.system = set(_command_lines(["pacman", "-Qq"], self.env))
+
+        self.flatpak = set(_command_lines(["flatpak", "list", "--app", "--columns=application"], self.env))
+        # `brew list --versions` prints "<formula> <version> [<version>...]"
+        self.homebrew = {line.split()[0] for line in _command_lines(["brew", "list", "--versions"], self.env)}
+        try:
+            # Hidden entries are staging directories of installs in progress
+            self.tarball = {name for name in os.listdir(paths.OPT_DIR) if not name.startswith(".")}
+        except OSError:
+            self.tarball = set()
+
+    def _backend(self, method: str) -> Optional[set[str]]:
+        if method in SYSTEM_METHODS:
+            return self.system
+        if method == "flatpak":
+            return self.flatpak
+        if method == "homebrew":
+            return self.homebrew
+        if method == "tarball":
+            return self.tarball
+        return None
+
+    def is_installed(self, pkg: str, method: str) -> bool:
+        """Checks if pkg is already installed through the backend of method."""
+        backend = self._backend(method)
+        return backend is not None and pkg in backend
+
+    def mark_installed(self, pkg: str, method: str) -> None:
+        """Records a package installed during this run."""
+        backend = self._backend(method)
+        if backend is not None:
+            backend.add(pkg)
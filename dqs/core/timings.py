@@ -0,0 +1,305 @@
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Iterator, Optional
+
+from dqs.utils.paths import STATE_DIR
+from dqs.utils import terminal_utils
+
+# ==================================================================
+'''
+TIMINGS:
+Every run records one JSONL file under ~/.local/state/dqs/timings, one line
+per event:
+- run       -> start/end of the whole run
+- task      -> a node of the task graph: start/end, requirements, exclusive
+               resources, status, phase spans, bytes downloaded and the
+               commands it ran
+- download  -> an artifact fetched into the cache (prefetch workers included)
+Phases: setup, download, install, post_install. Time of a task outside any
+phase is reported as "other".
+Recording is a no-op until start_run() is called, so the instrumentation
+points cost nothing for library users.
+'''
+# ==================================================================
+TIMINGS_DIR = os.path.join(STATE_DIR, "timings")
+# Runs kept on disk, the oldest ones are removed by start_run()
+MAX_RUNS = 20
+PHASES = ("setup", "download", "install", "post_install")
+
+
+@dataclass
+class TaskRecord:
+    name: str
+    requires: list[str] = field(default_factory=list)
+    resources: list[str] = field(default_factory=list)
+    start: float = 0.0
+    end: float = 0.0
+    status: str = "running"
+    # [phase, start, end, time spent in nested phases]
+    phases: list[list[Any]] = field(default_factory=list)
+    artifacts: list[str] = field(default_factory=list)
+    bytes: int = 0
+    commands: list[dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Recorder:
+    """Appends the events of one run to its JSONL file."""
+    def __init__(self, path: str, info: dict[str, Any]):
+        self.path = path
+        self.run_id = os.path.splitext(os.path.basename(path))[0]
+        self.start = time.time()
+        self.info = info
+        self.downloads: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+
+    def write(self, kind: str, **event: Any) -> None:
+        with self._lock:
+            self._file.write(json.dumps({"kind": kind, **event}) + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+_recorder: Optional[Recorder] = None
+_current = threading.local()
+
+
+def _on_command(result: terminal_utils.CommandResult) -> None:
+    task = getattr(_current, "task", None)
+    if task is not None:
+        task.commands.append({
+            "command": result.command,
+            "start": result.started,
+            "duration": round(result.duration, 3),
+            "returncode": result.returncode,
+            "output_bytes": result.output_bytes,
+        })
+
+
+def start_run(directory: str = TIMINGS_DIR, **info: Any) -> Recorder:
+    """Starts recording into a new file, every instrumentation point reports to it from now on."""
+    global _recorder
+    os.makedirs(directory, exist_ok=True)
+    runs = list_runs(directory)
+    for old in runs[:max(0, len(runs) - MAX_RUNS + 1)]:
+        os.remove(old)
+
+    _recorder = Recorder(os.path.join(directory, time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}.jsonl"), info)
+    if _on_command not in terminal_utils.COMMAND_LISTENERS:
+        terminal_utils.COMMAND_LISTENERS.append(_on_command)
+    return _recorder
+
+
+def end_run(**info: Any) -> None:
+    """Writes the run event and stops recording."""
+    global _recorder
+    if _recorder is None:
+        return
+    _recorder.write("run", start=_recorder.start, end=time.time(), **{**_recorder.info, **info})
+    _recorder.close()
+    _recorder = None
+
+
+@contextmanager
+def task(name: str, requires: Any = (), resources: Any = ()) -> Iterator[Optional[TaskRecord]]:
+    """Records the task run by this thread. Set .status on the yielded record to 'failed' on failure."""
+    if _recorder is None:
+        yield None
+        return
+    recorder = _recorder
+    record = TaskRecord(name, list(requires), sorted(resources), start=time.time())
+    previous, _current.task = getattr(_current, "task", None), record
+    try:
+        yield record
+        if record.status == "running":
+            record.status = "completed"
+    except BaseException:
+        record.status = "failed"
+        raise
+    finally:
+        _current.task = previous
+        record.end = time.time()
+        record.bytes = sum(recorder.downloads.get(url, 0) for url in record.artifacts)
+        recorder.write("task", **asdict(record))
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """
+    Marks the time spent in the given phase by the current task. Phases can
+    nest (a download inside an install), the inner time only counts once.
+    """
+    record = getattr(_current, "task", None)
+    if record is None:
+        yield
+        return
+    span = [name, time.time(), 0.0, 0.0]
+    stack = _current.__dict__.setdefault("phases", [])
+    stack.append(span)
+    try:
+        yield
+    finally:
+        stack.pop()
+        span[2] = time.time()
+        if stack:
+            stack[-1][3] += span[2] - span[1]
+        record.phases.append(span)
+
+
+def record_download(url: str, size: int, duration: float, cached: bool) -> None:
+    """Called by the artifact cache for every fetch, from whatever thread ran it."""
+    if _recorder is None:
+        return
+    _recorder.downloads[url] = _recorder.downloads.get(url, 0) + size
+    _recorder.write("download", url=url, start=time.time() - duration, duration=round(duration, 3), bytes=size, cached=cached)
+    uses_artifact(url)
+
+
+def uses_artifact(url: str) -> None:
+    """Attributes the bytes of the artifact to the current task (it may have been prefetched)."""
+    record = getattr(_current, "task", None)
+    if record is not None and url not in record.artifacts:
+        record.artifacts.append(url)
+
+
+# ==================================================================
+# REPORT
+# ==================================================================
+def list_runs(directory: str = TIMINGS_DIR) -> list[str]:
+    """Recorded runs, oldest first."""
+    return sorted(glob.glob(os.path.join(directory, "*.jsonl")))
+
+
+def load_run(path: str) -> dict[str, Any]:
+    run: dict[str, Any] = {"run": None, "tasks": {}, "downloads": []}
+    with open(path) as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # A run killed mid write leaves a truncated last line
+                continue
+            kind = event.pop("kind", None)
+            if kind == "task":
+                run["tasks"][event["name"]] = TaskRecord(**event)
+            elif kind == "download":
+                run["downloads"].append(event)
+            elif kind == "run":
+                run["run"] = event
+    return run
+
+
+def _longest_path(tasks: dict[str, TaskRecord], weights: dict[str, float]) -> tuple[float, list[str]]:
+    finish: dict[str, float] = {}
+    previous: dict[str, Optional[str]] = {}
+
+    def visit(name: str, visiting: set[str]) -> float:
+        if name in finish:
+            return finish[name]
+        visiting.add(name)
+        best, best_req = 0.0, None
+        for req in tasks[name].requires:
+            if req in tasks and req not in visiting:
+                value = visit(req, visiting)
+                if value > best:
+                    best, best_req = value, req
+        visiting.discard(name)
+        finish[name] = best + weights[name]
+        previous[name] = best_req
+        return finish[name]
+
+    for name in tasks:
+        visit(name, set())
+    if not finish:
+        return 0.0, []
+    end = max(finish, key=finish.get)
+    path = []
+    node: Optional[str] = end
+    while node:
+        path.append(node)
+        node = previous[node]
+    return finish[end], path[::-1]
+
+
+def critical_path(tasks: dict[str, TaskRecord]) -> dict[str, Any]:
+    """
+    Longest chain of dependent tasks by measured duration, plus how much the
+    chain would shrink if each task took no time at all. With unlimited
+    workers and no locks that chain is the wall clock floor of the run.
+    """
+    weights = {name: record.duration for name, record in tasks.items()}
+    length, path = _longest_path(tasks, weights)
+    savings = {}
+    for name in tasks:
+        without, _ = _longest_path(tasks, {**weights, name: 0.0})
+        if length - without > 0.001:
+            savings[name] = length - without
+    return {"length": length, "path": path, "savings": dict(sorted(savings.items(), key=lambda item: -item[1]))}
+
+
+def phase_totals(record: TaskRecord) -> dict[str, float]:
+    totals = {name: 0.0 for name in PHASES}
+    for name, start, end, nested in record.phases:
+        totals[name] = totals.get(name, 0.0) + (end - start - nested)
+    totals["other"] = max(0.0, record.duration - sum(totals.values()))
+    return totals
+
+
+def format_report(run: dict[str, Any], top: int = 10) -> str:
+    tasks: dict[str, TaskRecord] = run["tasks"]
+    lines = []
+    if run["run"]:
+        lines.append(f"Wall clock: {run['run']['end'] - run['run']['start']:.1f}s")
+    if not tasks:
+        lines.append("No tasks recorded.")
+        return "\n".join(lines)
+
+    analysis = critical_path(tasks)
+    lines.append(f"Critical path: {analysis['length']:.1f}s ({len(analysis['path'])} tasks)")
+    for name in analysis["path"]:
+        lines.append(f"  {tasks[name].duration:8.1f}s  {name}")
+
+    # Exclusive resources serialize their holders, their busy time is another floor
+    locked: dict[str, float] = {}
+    for record in tasks.values():
+        for resource in record.resources:
+            locked[resource] = locked.get(resource, 0.0) + record.duration
+    for resource, busy in sorted(locked.items()):
+        lines.append(f"'{resource}' lock held: {busy:.1f}s (serialized)")
+
+    lines.append("")
+    lines.append("Biggest wall clock savings if sped up:")
+    for name, saving in list(analysis["savings"].items())[:top]:
+        lines.append(f"  {saving:8.1f}s  {name}")
+
+    lines.append("")
+    header = "".join(f"{name:>13}" for name in (*PHASES, "other"))
+    lines.append(f"{'task':<32}{'total':>9}{header}{'bytes':>12}  status")
+    for record in sorted(tasks.values(), key=lambda record: -record.duration)[:top]:
+        totals = phase_totals(record)
+        columns = "".join(f"{totals[name]:12.1f}s" for name in (*PHASES, "other"))
+        lines.append(f"{record.name[:31]:<32}{record.duration:8.1f}s{columns}{record.bytes:>12}  {record.status}")
+
+    commands = sorted((command for record in tasks.values() for command in record.commands), key=lambda command: -command["duration"])
+    if commands:
+        lines.append("")
+        lines.append("Slowest commands:")
+        for command in commands[:top]:
+            lines.append(f"  {command['duration']:8.1f}s  [{command['returncode']}]  {command['command'][:80]}")
+
+    downloaded = sum(download["bytes"] for download in run["downloads"])
+    lines.append("")
+    lines.append(f"Downloaded: {downloaded / 1e6:.1f} MB in {len(run['downloads'])} artifacts")
+    return "\n".join(lines)
@@ -1,24 +1,52 @@
 
+import argparse
 import os
-import subprocess
 import platform
+import threading
+
+from dqs.core import retry, timings
+from dqs.core.cache import ArtifactCache
+from dqs.core.commands import ShellRequired, compile_command
+from dqs.core.downloads import Prefetcher, Prestager
+from dqs.core.scheduler import Scheduler, resource_lock, DPKG_LOCK
+from dqs.core.state import SystemState
+from dqs.utils import terminal_utils
+from dqs.utils.terminal_utils import display, emit, execute
 
 # --------------------------------
 # -------- Helpers ---------------
 # --------------------------------
-def log(msg): print(f"\n👉 {msg}")
-def ok(msg): print(f"✅ {msg}")
-def fail(msg): print(f"❌ {msg}")
+def log(msg): emit("log", msg, f"\n👉 {msg}")
+def ok(msg): emit("ok", msg, f"✅ {msg}")
+def fail(msg): emit("error", msg, f"❌ {msg}")
+
+
+def run_cmd(cmd, shell: bool = False) -> bool:
+    """
+    Sin shell: un argv se ejecuta tal cual y una línea se compila en pasos
+    argv (dqs.core.commands). Solo las tareas "script" pasan por /bin/sh.
+    """
+    if shell or not isinstance(cmd, str):
+        return _run(cmd)
+    try:
+        steps = compile_command(cmd)
+    except ShellRequired as e:
+        fail(f"{e} (lo que necesita una shell va en una tarea de tipo 'script')")
+        return False
+    # all() para en el primer paso que falla, como &&
+    return all(_run(list(step.argv), dict(os.environ, **dict(step.env)) if step.env else None) for step in steps)
 
 
-def run_cmd(cmd: str) -> bool:
-    log(f"Ejecutando: {cmd}")
-    result = subprocess.run(cmd, shell=True)
-    if result.returncode == 0:
-        ok("Comando exitoso")
+def _run(cmd, env: dict = None) -> bool:
+    log(f"Ejecutando: {display(cmd)}")
+    result = execute(cmd, env=env)
+    if result.success:
+        ok(f"Comando exitoso ({result.duration:.1f}s)")
         return True
     else:
-        fail(f"Error ejecutando: {cmd}")
+        fail(f"Error ejecutando: {result.command} (código {result.returncode})")
+        for line in result.tail:
+            emit("error", line, f"  {line}")
         return False
 
 # ---------------------------------------------
@@ -42,8 +70,9 @@ def set_distro_based():
 
 PKG_MANAGERS = {
     "debian": {
-        "install": "sudo apt install -y {pkg}",
-        "update": "sudo apt update && sudo apt upgrade -y",
+        "install": "sudo apt {lock} install -y {pkg}",
+        # el apt update lo hace una sola vez la fase de repositorios
+        "update": "sudo apt {lock} upgrade -y",
     },
     "fedora": {
         "install": "sudo dnf install -y {pkg}",
@@ -55,22 +84,149 @@ PKG_MANAGERS = {
     },
 }
 
+# Paquetes ya instalados, se carga una sola vez en setup()
+STATE = None
+
+def wait_dpkg() -> bool:
+    if DISTRO != "debian":
+        return True
+    if not retry.wait_for_dpkg_lock():
+        fail("El lock de dpkg sigue ocupado por otro proceso")
+        return False
+    return True
+
+# Paquetes esperando el lock de dpkg -> resultado (None mientras esperan). Quien
+# consigue el lock instala todos los que esperan en una sola transacción
+APT_PENDING = {}
+APT_PENDING_LOCK = threading.Lock()
+
 def install_pkg(pkg: str) -> bool:
-    if DISTRO in PKG_MANAGERS:
-        cmd = PKG_MANAGERS[DISTRO]["install"].format(pkg=pkg)
-        return run_cmd(cmd)
-    else:
+    if STATE and STATE.is_installed(pkg, "pkg_manager"):
+        ok(f"Ya instalado: {pkg}")
+        return True
+    if DISTRO not in PKG_MANAGERS:
         fail(f"No hay soporte aún para esta distro: {DISTRO}")
         return False
+    with APT_PENDING_LOCK:
+        APT_PENDING.setdefault(pkg, None)
+    with resource_lock(DPKG_LOCK), timings.phase("install"):
+        with APT_PENDING_LOCK:
+            if APT_PENDING.get(pkg) is not None:
+                # Ya lo instaló otra tarea en su transacción
+                return APT_PENDING.pop(pkg)
+            batch = [name for name, result in APT_PENDING.items() if result is None]
+        # unattended-upgrades suele tener el lock recién arrancada la máquina
+        results = install_group(batch) if wait_dpkg() else dict.fromkeys(batch, False)
+        with APT_PENDING_LOCK:
+            APT_PENDING.update(results)
+            return APT_PENDING.pop(pkg)
+
+def install_group(names: list) -> dict:
+    """Instala los paquetes en una transacción, partiéndola en dos si falla para aislar al culpable."""
+    if len(names) > 1:
+        log(f"Instalando juntos: {', '.join(names)}")
+    if run_cmd(PKG_MANAGERS[DISTRO]["install"].format(pkg=" ".join(names), lock=retry.apt_lock_option())):
+        for name in names:
+            if STATE:
+                STATE.mark_installed(name, "pkg_manager")
+        return dict.fromkeys(names, True)
+    if len(names) == 1:
+        return {names[0]: False}
+    middle = len(names) // 2
+    return {**install_group(names[:middle]), **install_group(names[middle:])}
+
+# Repositorios extra (docker, spotify...), se aplican todos antes del único apt update
+REPOSITORIES = None
 
 def update_system():
+    if DISTRO == "debian" and REPOSITORIES:
+        # Un repositorio que falla solo afecta a las tareas que lo necesitan
+        with timings.phase("setup"):
+            REPOSITORIES.apply()
+            if not REPOSITORIES.refresh():
+                return False
     if DISTRO in PKG_MANAGERS:
-        return run_cmd(PKG_MANAGERS[DISTRO]["update"])
+        with timings.phase("install"):
+            return wait_dpkg() and run_cmd(PKG_MANAGERS[DISTRO]["update"].format(lock=retry.apt_lock_option()))
+
+PREFETCHER = None
+
+# Nodo del grafo que actualiza el sistema antes de cualquier otra tarea
+UPDATE_TASK = "update_system"
+
+def install_deb(url: str, mirrors: list = (), sha256: str = None) -> bool:
+    # El .deb viene del prefetch si está activo, si no se descarga aquí.
+    # En ambos casos queda en la caché de artefactos (~/.cache/dqs)
+    with timings.phase("download"):
+        if PREFETCHER:
+            path = PREFETCHER.get(url, suffix=".deb", mirrors=mirrors, sha256=sha256)
+        else:
+            path = ArtifactCache().fetch(url, ".deb", mirrors, sha256)
+    timings.uses_artifact(url)
+    if not path:
+        fail(f"No se pudo descargar: {url}")
+        return False
+    # La descarga no necesita el lock de dpkg, solo la instalación
+    with resource_lock(DPKG_LOCK), timings.phase("install"):
+        return wait_dpkg() and run_cmd(["sudo", "apt", *retry.apt_lock_args(), "install", "-y", path])
 
 # ------------------------------------------
 # -------- Setup Dictionary ----------------
 # ------------------------------------------
 
+# Descargas de flatpak/brew adelantadas mientras apt trabaja (dqs.core.downloads.Prestager)
+PRESTAGER = None
+PRESTAGE_ARGV = {
+    "flatpak": ["flatpak", "install", "-y", "--noninteractive", "--no-deploy", "flathub"],
+    "brew": ["brew", "fetch", "--deps"],
+}
+# herramienta -> [argv de la descarga, tareas que faltan para poder lanzarla]
+PRESTAGE = {}
+PRESTAGE_LOCK = threading.Lock()
+
+def plan_prestage(pending: set) -> None:
+    """Junta por herramienta lo que instalarán las tareas pendientes de flatpak y brew."""
+    PRESTAGE.clear()
+    for name, task in TASKS_DICT.items():
+        if name not in pending or task.get("type") != "command":
+            continue
+        try:
+            steps = compile_command(task["cmd"])
+        except ShellRequired:
+            continue
+        for step in steps:
+            tool = step.argv[0]
+            if tool not in PRESTAGE_ARGV or step.argv[1:2] != ("install",):
+                continue
+            refs = [arg for arg in step.argv[2:] if not arg.startswith("-")]
+            # el primero de flatpak es el remoto
+            refs = refs[1:] if tool == "flatpak" else refs
+            argv, waiting = PRESTAGE.setdefault(tool, [list(PRESTAGE_ARGV[tool]), set()])
+            argv.extend(ref for ref in refs if ref not in argv)
+            waiting.update(req for req in task.get("req", []) or [UPDATE_TASK] if req in pending)
+
+def prestage_after(task_name: str) -> None:
+    """Lanza las descargas que ya solo esperaban a task_name."""
+    for tool, (argv, waiting) in PRESTAGE.items():
+        with PRESTAGE_LOCK:
+            if task_name not in waiting:
+                continue
+            waiting.discard(task_name)
+            ready = not waiting
+        if ready:
+            PRESTAGER.start(tool, argv)
+
+def run_setup_task(task_name: str, run) -> bool:
+    success = run()
+    if success and PRESTAGER:
+        prestage_after(task_name)
+    return success
+
+BREW_BIN = "/home/linuxbrew/.linuxbrew/bin"
+
+# Tipos: "command" (sin shell, ver run_cmd), "script" (por /bin/sh), "deb", "tarball" y "python".
+# "package" (deb) y "creates" (script): con qué se sabe que ya está instalado, ver already_installed.
+# "rerun": la tarea solo cambia este proceso y se repite aunque el journal la dé por hecha
 TASKS_DICT = {
     #------------------------
     # Install utilities tasks
@@ -93,7 +249,7 @@ TASKS_DICT = {
     "install_fastfetch":{
         "req":[],
         "type":"python",
-        "func":install_pkg("fastfetch")
+        "func":lambda:install_pkg("fastfetch")
     },
     "install_btop":{
         "req":[],
@@ -131,17 +287,20 @@ TASKS_DICT = {
             "install_curl",
             "install_git"
         ],
-        "type":"command",
-        "cmd":'NONINTERACTIVE=1 /bin/bash -c "$(curl -fsSL https://raw.githubusercontent.com/Homebrew/install/HEAD/install.sh)"'
+        "type":"script",
+        "cmd":'NONINTERACTIVE=1 /bin/bash -c "$(curl -fsSL https://raw.githubusercontent.com/Homebrew/install/HEAD/install.sh)"',
+        "creates":"/home/linuxbrew/.linuxbrew/bin/brew"
     },
     "add_homebrew_to_path":{
         "req":[
             "install_homebrew"
         ],
         "type":"python",
+        # solo cambia el PATH de este proceso: se repite siempre al retomar
+        "rerun":True,
         "func":lambda: os.environ.__setitem__(
             "PATH",
-            os.environ["PATH"] + ":/home/linuxbrew/.linuxbrew/bin:" + os.path.expanduser("~/.linuxbrew/bin")
+            os.environ["PATH"] + f":{BREW_BIN}:" + os.path.expanduser("~/.linuxbrew/bin")
         )
     },
     "brew_install_gcc":{
@@ -179,32 +338,31 @@ TASKS_DICT = {
     # Rclone
     "install_rclone":{
         "req":["install_curl"],
-        "type":"command",
-        "cmd":"curl -O https://rclone.org/install.sh | sudo bash && rm install.sh"
+        "type":"script",
+        "cmd":"curl -fsSL https://rclone.org/install.sh | sudo bash",
+        "creates":"/usr/bin/rclone"
     },
     # Obsidian
     "install_obsidian":{
-        "req":["install_curl"],
+        "req":["install_&_configure_flatpak"],
         "type":"command",
-        "cmd":"""curl -L https://github.com/obsidianmd/obsidian-releases/releases/download/v1.9.14/obsidian_1.9.14_amd64.deb \\
-                -o obsidian.deb \\
-                && sudo apt install -y ./obsidian.deb \\
-                && rm obsidian.deb"""
+        "cmd":"flatpak install -y flathub md.obsidian.Obsidian"
     },
     # VS Code
     "install_vscode":{
         "req":["install_curl"],
-        "type":"command",
-        "cmd":"curl -L 'https://code.visualstudio.com/sha/download?build=stable&os=linux-deb-x64' -o vscode.deb && sudo apt install -y ./vscode.deb && rm vscode.deb"
+        "type":"deb",
+        "url":"https://code.visualstudio.com/sha/download?build=stable&os=linux-deb-x64",
+        "mirrors":["https://update.code.visualstudio.com/latest/linux-deb-x64/stable"],
+        "package":"code"
     },
-    # JetBrains Tool Box TODO execute the binary after extraction
+    # JetBrains Tool Box, se extrae en ~/.local/opt/jetbrains-toolbox y
+    # el ejecutable queda enlazado en ~/.local/bin
     "install_jb_tool_box":{
         "req":["install_curl"],
-        "type":"command",
-        "cmd":"""curl -L 'https://download.jetbrains.com/toolbox/jetbrains-toolbox-2.4.2.32922.tar.gz' \\
-                -o jb-toolbox.tar.gz \\
-                && tar -xvzf jb-toolbox.tar.gz \\
-                && rm ../jb-toolbox.tar.gz \\"""
+        "type":"tarball",
+        "id":"jetbrains-toolbox",
+        "url":"https://data.services.jetbrains.com/products/download?code=TBA&platform=linux"
     },
     # Qt Creator & Qt Designer
     "install_qtcreator_qtdesigner":{
@@ -221,24 +379,15 @@ TASKS_DICT = {
     },
     # Docker
     "setup_apt_for_docker":{
-        "req":["install_curl"],
-        "type":"command",
-        "cmd":"""sudo apt install -y ca-certificates \\
-                && sudo install -m 0755 -d /etc/apt/keyrings \\
-                && sudo curl -fsSL https://download.docker.com/linux/debian/gpg -o /etc/apt/keyrings/docker.asc \\
-                && sudo chmod a+r /etc/apt/keyrings/docker.asc \\
-                && echo "deb [arch=$(dpkg --print-architecture) signed-by=/etc/apt/keyrings/docker.asc] https://download.docker.com/linux/debian $(. /etc/os-release && echo "$VERSION_CODENAME") stable" \\
-                | sudo tee /etc/apt/sources.list.d/docker.list > /dev/null \\
-                && sudo apt update
-        """
+        "req":[],
+        "type":"python",
+        "func":lambda:REPOSITORIES.ensure("docker_repo")
     },
     "install_docker":{
         "req":["setup_apt_for_docker"],
-        "type":"command",
-        "cmd":"""curl -L 'https://desktop.docker.com/linux/main/amd64/docker-desktop-amd64.deb?utm_source=docker&utm_medium=webreferral&utm_campaign=docs-driven-download-linux-amd64' \\
-                -o docker.deb \\
-                && sudo apt install -y ./docker.deb \\
-                && rm docker.deb"""
+        "type":"deb",
+        "url":"https://desktop.docker.com/linux/main/amd64/docker-desktop-amd64.deb?utm_source=docker&utm_medium=webreferral&utm_campaign=docs-driven-download-linux-amd64",
+        "package":"docker-desktop"
     },
 
     #------------------------
@@ -252,34 +401,31 @@ TASKS_DICT = {
     #},
     # Draw.io
     "install-drawio":{
-        "req":["install_curl"],
+        "req":["install_&_configure_flatpak"],
         "type":"command",
-        "cmd":"""curl -L https://github.com/jgraph/drawio-desktop/releases/download/v27.0.9/drawio-amd64-27.0.9.deb \\
-                -o drawio.deb \\
-                && sudo apt install -y ./drawio.deb \\
-                && rm drawio.deb"""
+        "cmd":"flatpak install -y flathub com.jgraph.drawio.desktop"
     },
     # ONLYOFFICE
     "install_onlyoffice":{
         "req":["install_curl"],
-        "type":"command",
-        "cmd":"""curl -L https://github.com/ONLYOFFICE/DesktopEditors/releases/latest/download/onlyoffice-desktopeditors_amd64.deb \\
-                -o onlyoffice.deb \\
-                && sudo apt install -y ./onlyoffice.deb \\
-                && rm onlyoffice.deb"""
+        "type":"deb",
+        "url":"https://github.com/ONLYOFFICE/DesktopEditors/releases/latest/download/onlyoffice-desktopeditors_amd64.deb",
+        "package":"onlyoffice-desktopeditors"
     },
 
     #------------------------
     # Others
     #------------------------
     # Spotify
+    "setup_spotify_repo":{
+        "req":[],
+        "type":"python",
+        "func":lambda:REPOSITORIES.ensure("spotify_repo")
+    },
     "install_spotify":{
-        "req":["install_curl"],
-        "type":"command",
-        "cmd":"""curl -sS https://download.spotify.com/debian/pubkey_C85668DF69375001.gpg | sudo gpg --dearmor --yes -o /etc/apt/trusted.gpg.d/spotify.gpg \\
-                && echo "deb https://repository.spotify.com stable non-free" | sudo tee /etc/apt/sources.list.d/spotify.list \\
-                && sudo apt update \\
-                && sudo apt install -y spotify-client"""
+        "req":["setup_spotify_repo"],
+        "type":"python",
+        "func":lambda:install_pkg("spotify-client")
     },
 }
 
@@ -287,93 +433,189 @@ TASKS_DICT = {
 # -------- Setup ----------------
 # -------------------------------
 
-def run_task(task_name: str, executed: set, results: dict) -> bool:
-    
-    # Avoid loops
-    if task_name in executed:
-        return True
-    
+def task_resources(task: dict) -> set:
+    """Clase de recurso de una tarea: todo lo que toca apt/dpkg va con lock exclusivo."""
+    if task.get("type") in ("command", "script"):
+        cmd = task.get("cmd", "")
+        if "apt " in cmd or "dpkg" in cmd:
+            return {DPKG_LOCK}
+        return {"network"} if "curl" in cmd else set()
+    if task.get("type") in ("deb", "tarball"):
+        # install_deb toma el lock solo durante la instalación
+        return {"network"}
+    return set()
+
+# Herramienta de un paso de instalación -> método con el que STATE lo comprueba
+INSTALLERS = {"apt": "pkg_manager", "brew": "homebrew", "flatpak": "flatpak"}
+
+def already_installed(task: dict) -> bool:
+    """True si todo lo que instala la tarea ya está en el sistema, según STATE."""
+    if not STATE:
+        return False
+    task_type = task.get("type")
+    if task_type == "deb":
+        return bool(task.get("package")) and STATE.is_installed(task["package"], "deb")
+    if task_type == "tarball":
+        return STATE.is_installed(task["id"], "tarball")
+    if task_type == "script":
+        # Un script no dice qué instala, solo se sabe por el archivo que deja
+        return bool(task.get("creates")) and os.path.exists(task["creates"])
+    if task_type != "command":
+        return False
+    try:
+        steps = compile_command(task.get("cmd", ""))
+    except ShellRequired:
+        return False
+    refs = []
+    for step in steps:
+        argv = step.argv[1:] if step.argv[0] == "sudo" else step.argv
+        # Cualquier otro paso (remote-add...) no se puede dar por hecho
+        if argv[0] not in INSTALLERS or argv[1:2] != ("install",):
+            return False
+        names = [arg for arg in argv[2:] if not arg.startswith("-")]
+        # el primero de flatpak es el remoto
+        names = names[1:] if argv[0] == "flatpak" else names
+        refs += [(name, INSTALLERS[argv[0]]) for name in names]
+    return bool(refs) and all(STATE.is_installed(name, method) for name, method in refs)
+
+def run_task(task_name: str) -> bool:
     task = TASKS_DICT.get(task_name)
     if not task:
         log(f"⚠️ Tarea '{task_name}' no encontrada en TASKS_DICT.")
-        results["Errores"].append(task_name)
-        fail(f"Falló la tarea: {task_name}")
         return False
 
-    # Run requirements first
-    log(f"Ejecutando rquisitos para la tarea: {task_name}")
-    for req in task.get("req", []):
-        if not run_task(req, executed, results):
-            fail(f"Falló la tarea requerida: {req} para la tarea: {task_name}")
-            results["Errores"].append(task_name)
-            return False
-        
-    # execute the main task
+    if already_installed(task):
+        ok(f"Ya instalado: {task_name}")
+        return True
+
+    # execute the task, the scheduler already ran its requirements
     log(f"Ejecutando tarea: {task_name}")
     task_type = task.get("type")
 
     try:
-        if task_type == "command":
-            ok_ = run_cmd(task.get("cmd", ""))
+        if task_type in ("command", "script"):
+            if DPKG_LOCK in task_resources(task) and not wait_dpkg():
+                return False
+            if PRESTAGER and task_type == "command":
+                # con lo descargado de antemano solo queda instalar
+                for tool in {step.argv[0] for step in compile_command(task.get("cmd", ""))}:
+                    PRESTAGER.wait(tool)
+            with timings.phase("install"):
+                return run_cmd(task.get("cmd", ""), shell=task_type == "script")
+        elif task_type == "deb":
+            return install_deb(task["url"], task.get("mirrors", []), task.get("sha256"))
+        elif task_type == "tarball":
+            # Se importa aquí, solo hace falta si hay tarballs que instalar
+            from dqs.core.installation_methods import install_tarball
+            with timings.phase("install"):
+                return install_tarball(task["id"], task["url"], task.get("mirrors", []), task.get("sha256"))
         elif task_type == "python":
             func = task.get("func")
             if callable(func):
-                func()
-                ok_ = True
-            else:
-                fail(f"La función para la tarea {task_name} no es valida.")
-                ok_ = False
+                # None cuenta como éxito, solo un False explícito es un fallo
+                return func() is not False
+            fail(f"La función para la tarea {task_name} no es valida.")
+            return False
         else:
             fail(f"Tipo de tarea desconocida para {task_name}: {task_type}")
-            ok_ = False
+            return False
             
     except Exception as e:
         fail(f"Error al ejecutar: {task_name} : {str(e)}")
-        ok_ = False
-
-    if ok_:
-        executed.add(task_name)
-        results["Completado"].append(task_name)
-        ok(f"Tarea completada: {task_name}")
-        return True
-    else:
-        results["Errores"].append(task_name)
-        fail(f"Falló la tarea: {task_name}")
         return False
 
-def setup():
-    results_dict = {
-        "Errores": [],
-        "Completado": []
-    }
-    executed = set()
+def setup(max_workers: int = 4, fresh: bool = False, controller=None):
+    global PREFETCHER, PRESTAGER, STATE, REPOSITORIES
 
     log(f"Distribución detectada: {DISTRO}")
     set_distro_based()
+    # brew aún no está en el PATH de este proceso (add_homebrew_to_path), pero puede estar instalado
+    STATE = SystemState(DISTRO, dict(os.environ, PATH=f"{os.environ.get('PATH', '')}:{BREW_BIN}"))
+    from dqs.core.catalog import load_catalog
+    from dqs.core.journal import Journal, definition_hash
+    from dqs.core.repositories import RepositoryPhase
+    REPOSITORIES = RepositoryPhase.from_catalog(load_catalog())
+
+    # Si la ejecución anterior se cortó, solo se repite lo que falló, cambió o es nuevo
+    journal = Journal()
+    if fresh:
+        journal.clear()
+    keys = {name: definition_hash(task) for name, task in TASKS_DICT.items()}
+    keys[UPDATE_TASK] = definition_hash({"cmd": PKG_MANAGERS.get(DISTRO, {}).get("update"), "repositories": REPOSITORIES.repositories})
+    if journal.entries:
+        log("Retomando la ejecución anterior (usa --fresh para empezar de cero)")
     
     log("Iniciando Setup...")
-    # updating system
+    timings.start_run(command="setup", workers="auto" if controller else max_workers, distro=DISTRO)
+    # Los .deb empiezan a descargarse ya, mientras se actualiza el sistema
+    PREFETCHER = Prefetcher()
+    # Lo que ya está instalado ni se descarga ni se adelanta
+    installed = {name for name, task in TASKS_DICT.items() if already_installed(task)}
+    PREFETCHER.start((task["url"] for name, task in TASKS_DICT.items()
+                      if task.get("type") == "deb" and name not in installed and not journal.is_done(name, keys[name])), suffix=".deb",
+                     mirrors={task["url"]: task["mirrors"] for task in TASKS_DICT.values() if task.get("mirrors")},
+                     checksums={task["url"]: task["sha256"] for task in TASKS_DICT.values() if task.get("sha256")})
+
+    # Flatpak y brew descargan en segundo plano en cuanto están listos
+    PRESTAGER = Prestager()
+    # Las tareas que se repiten siempre (el PATH de brew) también se esperan
+    plan_prestage({name for name in [UPDATE_TASK, *TASKS_DICT] if name not in installed
+                   and (TASKS_DICT.get(name, {}).get("rerun") or not journal.is_done(name, keys[name]))})
+    for tool, (argv, waiting) in PRESTAGE.items():
+        if not waiting:
+            PRESTAGER.start(tool, argv)
+
+    # running tasks, independent ones in parallel. La actualización del sistema
+    # es el primer nodo del grafo, así aparece en los tiempos (dqs profile)
+    scheduler = Scheduler(max_workers=max_workers, journal=journal, controller=controller)
+    scheduler.add(UPDATE_TASK, lambda: run_setup_task(UPDATE_TASK, update_system), resources=[DPKG_LOCK], key=keys[UPDATE_TASK])
+    for task_name, task in TASKS_DICT.items():
+        scheduler.add(
+            task_name,
+            lambda task_name=task_name: run_setup_task(task_name, lambda: run_task(task_name)),
+            requires=task.get("req", []) or [UPDATE_TASK],
+            resources=task_resources(task),
+            key=keys[task_name],
+            rerun=task.get("rerun", False),
+        )
     log("Actualizando sistema...")
-    if not update_system():
+    results = scheduler.run()
+    PREFETCHER.shutdown()
+    PRESTAGER.shutdown()
+    timings.end_run(completed=len(results["completed"]), failed=len(results["failed"]))
+    if not results["failed"]:
+        journal.clear()
+
+    if UPDATE_TASK in results["failed"]:
         fail("Algo inesperado sucedio durante la actualización del sistema")
         log("Saliendo del setup")
         return
-
-    # running tasks
-    for task_name in TASKS_DICT.keys():
-        run_task(task_name=task_name, executed=executed, results=results_dict)
+    results["completed"].remove(UPDATE_TASK)
+    resumed = [name for name in results["resumed"] if name != UPDATE_TASK]
+    results_dict = {
+        "Errores": results["failed"],
+        "Completado": results["completed"]
+    }
 
 
     # final summary
     log("\n📋 --- Resumen de ejecución ---")
     log(f"✅ Completadas: {len(results_dict['Completado'])}")
+    if resumed:
+        log(f"⏭  Ya hechas en la ejecución anterior: {len(resumed)}")
     log(f"❌ Con errores: {len(results_dict['Errores'])}")
+    if PRESTAGER.stats:
+        log(f"📦 Descargas adelantadas de flatpak/brew: {PRESTAGER.seconds():.0f}s, "
+            f"{PRESTAGER.hidden():.0f}s ocultos tras otras tareas")
+    if retry.TOTALS.lock_waits or retry.TOTALS.retries or retry.TOTALS.failovers:
+        log(f"⏳ Esperas por el lock de dpkg: {retry.TOTALS.lock_waits} ({retry.TOTALS.lock_wait_seconds:.0f}s), "
+            f"reintentos de descarga: {retry.TOTALS.retries}, mirrors usados: {retry.TOTALS.failovers}")
 
     # Printing errors
     if results_dict["Errores"]:
         log("Tareas con error:")
         for t in results_dict["Errores"]:
-            print(f"  - {t}")
+            emit("error", t, f"  - {t}")
 
     log("\n✨ Setup finalizado.")
 
@@ -381,5 +623,250 @@ def setup():
 # ----------------------
 # -------- Main --------
 # ----------------------
+def workers_argument(value: str):
+    """Un número fijo de tareas en paralelo, o 'auto'."""
+    if value == "auto":
+        return value
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    raise argparse.ArgumentTypeError(f"se esperaba un número o 'auto': {value}")
+
+
+def add_concurrency_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--workers", type=workers_argument, default="auto",
+                        help="Tareas en paralelo, 'auto' (por defecto) las ajusta a la carga del equipo y de la red")
+    parser.add_argument("--nice", action="store_true", help="Baja la prioridad de CPU y disco de las instalaciones")
+
+
+def concurrency(args):
+    """El controlador de concurrencia que piden los argumentos, None con un número fijo."""
+    from dqs.core.concurrency import ConcurrencyController, lower_priority
+    if getattr(args, "nice", False):
+        # Antes de crear ningún hilo: la prioridad se hereda al crearlos
+        lower_priority()
+    if getattr(args, "workers", "auto") != "auto":
+        return None
+    return ConcurrencyController()
+
+
+def add_progress_arguments(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--dashboard", action="store_true", help="Muestra el progreso en un panel de Textual")
+    group.add_argument("--log", metavar="ARCHIVO", help="Escribe los eventos de la ejecución en JSON, una línea por evento ('-' para stdout)")
+
+
+def observed(args, work):
+    """Ejecuta work con el panel o el log JSON que pidan los argumentos."""
+    if not getattr(args, "dashboard", False) and not getattr(args, "log", None):
+        return work()
+    from dqs.core import events
+    if args.dashboard:
+        # textual solo se importa si se pide el panel
+        from dqs.tui import run_dashboard
+        return run_dashboard(work)
+
+    sink = events.JsonLog(args.log)
+    events.subscribe(sink)
+    if args.log == "-":
+        # stdout queda solo para el log
+        terminal_utils.ECHO = False
+    try:
+        return work()
+    finally:
+        events.unsubscribe(sink)
+        sink.close()
+        terminal_utils.ECHO = True
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(prog="dqs", description="Configuración rápida de sistemas basados en Debian")
+    parser.add_argument("--tui", action="store_true", help="Abre la interfaz de Textual")
+    parser.add_argument("--tui-profile", metavar="PERFIL", help="Perfil al que la interfaz añade los paquetes buscados")
+    commands = parser.add_subparsers(dest="command")
+
+    setup_parser = commands.add_parser("setup", help="Ejecuta todas las tareas (por defecto)")
+    add_concurrency_arguments(setup_parser)
+    setup_parser.add_argument("--fresh", action="store_true", help="Ignora la ejecución anterior y repite todo")
+    add_progress_arguments(setup_parser)
+
+    bundle_parser = commands.add_parser("bundle", help="Paquetes offline para aprovisionar sin red")
+    bundle_commands = bundle_parser.add_subparsers(dest="bundle_command", required=True)
+    export_parser = bundle_commands.add_parser("export", help="Descarga todo lo que necesita un perfil en un archivo")
+    export_parser.add_argument("profile", help="Perfil, 'all' o lista de ids separada por comas")
+    export_parser.add_argument("-o", "--output", help="Archivo de salida (<perfil>.dqsbundle por defecto)")
+    install_parser = bundle_commands.add_parser("install", help="Instala desde un archivo, sin red")
+    install_parser.add_argument("bundle")
+
+    image_parser = commands.add_parser("export", help="Imágenes de contenedor o de VM con un perfil instalado")
+    image_commands = image_parser.add_subparsers(dest="export_command", required=True)
+    dockerfile_parser = image_commands.add_parser("dockerfile", help="Dockerfile con una capa por grupo de paquetes, de más a menos estable")
+    dockerfile_parser.add_argument("profile", help="Perfil, 'all' o lista de ids separada por comas")
+    dockerfile_parser.add_argument("-o", "--output", help="Archivo de salida (stdout por defecto)")
+    dockerfile_parser.add_argument("--base", help="Imagen base (la Debian estable slim por defecto)")
+    stages_parser = image_commands.add_parser("stages", help="Las mismas capas como scripts numerados, para otros constructores de imágenes")
+    stages_parser.add_argument("profile", help="Perfil, 'all' o lista de ids separada por comas")
+    stages_parser.add_argument("-o", "--output", help="Directorio de salida (<perfil>-stages por defecto)")
+
+    install_parser = commands.add_parser("install", help="Instala solo los paquetes indicados y lo que necesitan")
+    install_parser.add_argument("targets", nargs="+", help="Ids de paquetes, un perfil o 'all'")
+    install_parser.add_argument("--method", action="append", default=[], metavar="ID=METODO", help="Método para un paquete, p. ej. neovim=homebrew")
+    install_parser.add_argument("--dry-run", action="store_true", help="Muestra el plan sin instalar nada")
+    install_parser.add_argument("--json", action="store_true", help="Con --dry-run, el plan en JSON")
+    add_concurrency_arguments(install_parser)
+    add_progress_arguments(install_parser)
+
+    fleet_parser = commands.add_parser("fleet", help="Aprovisiona varias máquinas a la vez")
+    fleet_parser.add_argument("inventory", help="Archivo con una máquina por línea (user@host, local, chroot:/ruta)")
+    fleet_parser.add_argument("profile", help="Perfil, 'all' o lista de ids separada por comas")
+    fleet_parser.add_argument("--max-hosts", type=int, default=8, help="Máquinas en paralelo")
+    fleet_parser.add_argument("--timeout", type=float, default=None, help="Tiempo máximo por paso, en segundos")
+
+    search_parser = commands.add_parser("search", help="Busca entre todos los paquetes disponibles (apt, flatpak, brew)")
+    search_parser.add_argument("query", nargs="+", help="Palabras que deben aparecer en el nombre o la descripción")
+    search_parser.add_argument("--method", choices=["apt", "flatpak", "homebrew"], help="Solo los paquetes de un método")
+    search_parser.add_argument("--limit", type=int, default=20, help="Resultados como máximo")
+
+    add_parser = commands.add_parser("add", help="Añade un paquete disponible al catálogo y, si se indica, a un perfil")
+    add_parser.add_argument("name", help="Nombre exacto del paquete, como lo muestra dqs search")
+    add_parser.add_argument("--method", choices=["apt", "flatpak", "homebrew"], help="Método, si el nombre está en varios")
+    add_parser.add_argument("--profile", help="Perfil al que se añade")
+
+    profile_parser = commands.add_parser("profile", help="Tiempos de la última ejecución y su camino crítico")
+    profile_parser.add_argument("run", nargs="?", help="Archivo de la ejecución (la última por defecto)")
+    profile_parser.add_argument("--top", type=int, default=10, help="Filas por tabla")
+
+    args = parser.parse_args(argv)
+
+    if args.tui:
+        # textual solo se importa si se pide la interfaz
+        from dqs.tui import run_tui
+        return run_tui(args.tui_profile)
+
+    if args.command == "bundle":
+        from dqs.core.bundle import export_bundle, install_bundle
+        if args.bundle_command == "export":
+            if not export_bundle(args.profile, args.output or f"{args.profile}.dqsbundle"):
+                fail("Algunos artefactos no se pudieron exportar")
+                return 1
+            return 0
+        results = install_bundle(args.bundle)
+        log(f"✅ Completadas: {len(results['completed'])}")
+        log(f"❌ Con errores: {len(results['failed'])}")
+        if results["skipped"]:
+            log(f"Necesitan red: {', '.join(results['skipped'])}")
+        return 1 if results["failed"] else 0
+
+    if args.command == "export":
+        from dqs.core.catalog import CatalogError
+        from dqs.core.image import DEFAULT_BASE, export_dockerfile, export_stages
+        try:
+            if args.export_command == "dockerfile":
+                export_dockerfile(args.profile, args.output, args.base or DEFAULT_BASE)
+            else:
+                export_stages(args.profile, args.output or f"{args.profile}-stages")
+        except CatalogError as e:
+            fail(str(e))
+            return 2
+        return 0
+
+    if args.command == "install":
+        from dqs.core.catalog import CatalogError, load_catalog
+        from dqs.core.resolver import execute, resolve
+        catalog = load_catalog()
+        bad = [method for method in args.method if "=" not in method]
+        if bad:
+            fail(f"Formato esperado ID=METODO: {', '.join(bad)}")
+            return 2
+        try:
+            targets = [pkg_id for spec in args.targets for pkg_id in catalog.resolve_targets(spec)]
+            plan = resolve(catalog, targets, dict(method.split("=", 1) for method in args.method))
+        except CatalogError as e:
+            fail(str(e))
+            return 2
+        if args.dry_run:
+            if args.json:
+                import json
+                print(json.dumps(plan.to_dict(), indent=2))
+            else:
+                print(plan.describe())
+            return 0
+        from dqs.core.context import InstallationContext
+        controller = concurrency(args)
+
+        def run_plan():
+            results = execute(plan, catalog, InstallationContext(), max_workers=args.workers, controller=controller)
+            log(f"✅ Completadas: {len(results['completed'])}")
+            log(f"❌ Con errores: {len(results['failed'])}")
+            for t in results["failed"]:
+                emit("error", t, f"  - {t}")
+            return results
+
+        results = observed(args, run_plan)
+        return 1 if results["failed"] else 0
+
+    if args.command in ("search", "add"):
+        from dqs.core.search import EXACT, PackageIndex, catalog_entry
+        index = PackageIndex()
+        rebuilt = index.update()
+        if rebuilt:
+            log(f"Índice de paquetes actualizado: {len(rebuilt)} fuentes")
+        if args.command == "search":
+            results = index.search(" ".join(args.query), limit=args.limit, method=args.method)
+            for result in results:
+                print(f"{result.name:<32} {result.version:<20} {result.method:<9} {result.summary}")
+            if not results:
+                fail("Sin resultados (¿hace falta un apt update?)")
+            return 0 if results else 1
+
+        from dqs.core.catalog import CatalogError, add_package, load_catalog
+        matches = [result for result in index.search(args.name, limit=10, method=args.method)
+                   if result.rank == EXACT and result.name.lower() == args.name.lower()]
+        if len({result.method for result in matches}) > 1:
+            fail(f"'{args.name}' está en varios métodos, elige uno con --method: {', '.join(r.method for r in matches)}")
+            return 2
+        catalog = load_catalog()
+        pkg_id, entry = catalog_entry(matches[0]) if matches else (args.name, None)
+        if pkg_id in catalog.packages:
+            # Ya está en el catálogo: solo falta el perfil
+            entry = None
+        elif entry is None:
+            fail(f"No se encontró el paquete: {args.name}")
+            return 1
+        try:
+            add_package(pkg_id, entry, args.profile)
+        except CatalogError as e:
+            fail(str(e))
+            return 2
+        if entry:
+            ok(f"Añadido al catálogo: {pkg_id} ({entry['default_method']})")
+        if args.profile:
+            ok(f"Añadido al perfil {args.profile}: {pkg_id}")
+        return 0
+
+    if args.command == "profile":
+        runs = timings.list_runs()
+        path = args.run or (runs[-1] if runs else None)
+        if not path:
+            fail("No hay ejecuciones registradas, ejecuta primero: dqs setup")
+            return 1
+        log(f"Ejecución: {path}")
+        print(timings.format_report(timings.load_run(path), top=args.top))
+        return 0
+
+    if args.command == "fleet":
+        from dqs.core.catalog import load_catalog
+        from dqs.core.fleet import FleetRunner, build_steps, read_inventory
+        catalog = load_catalog()
+        runner = FleetRunner(read_inventory(args.inventory), max_hosts=args.max_hosts, timeout=args.timeout)
+        results = runner.run(build_steps(catalog, catalog.resolve_targets(args.profile)))
+        for host, host_results in results["hosts"].items():
+            log(f"{host}: ✅ {len(host_results['completed'])}  ❌ {len(host_results['failed'])}  ⏭ {len(host_results['skipped'])}")
+        for pkg_id, hosts in runner.by_package().items():
+            if hosts["failed"]:
+                fail(f"{pkg_id} falló en: {', '.join(hosts['failed'])}")
+        return 1 if results["failed"] else 0
+
+    controller = concurrency(args)
+    observed(args, lambda: setup(max_workers=getattr(args, "workers", "auto"), fresh=getattr(args, "fresh", False), controller=controller))
+
 if __name__ == "__main__":
-    setup()
+    raise SystemExit(main())
@@ -0,0 +1,172 @@
+# ==================================================================
+'''
+Textual UI. Only imported when the TUI is requested, textual is expensive
+to import and the headless CLI never needs it.
+'''
+# ==================================================================
+import threading
+from typing import Any, Callable, Optional
+
+from textual.app import App, ComposeResult
+from textual.widgets import DataTable, Footer, Header, Input, Log, Static
+
+from dqs.core import events
+from dqs.core.catalog import CatalogError, add_package, load_catalog
+from dqs.core.search import PackageIndex, Result, catalog_entry
+from dqs.utils import terminal_utils
+
+# Dashboard refreshes per second, it reads a snapshot of the tracker each time
+REFRESH_RATE = 4
+
+
+class DQSApp(App):
+    """
+    Browser for the packages of the catalog. Typing in the search box looks
+    through every package apt, flatpak and brew offer instead, and "a" adds
+    the highlighted result to the catalog (and to the profile, if given).
+    """
+    TITLE = "Debian Quick Setup"
+    BINDINGS = [("q", "quit", "Quit"), ("a", "add", "Add")]
+
+    def __init__(self, profile: Optional[str] = None):
+        super().__init__()
+        self.profile = profile
+        self.index = PackageIndex()
+        self.results: list[Result] = []
+
+    def compose(self) -> ComposeResult:
+        yield Header()
+        yield Input(placeholder="Search apt, flatpak and brew packages", id="search")
+        yield DataTable(id="packages")
+        yield DataTable(id="results", cursor_type="row")
+        yield Footer()
+
+    def on_mount(self) -> None:
+        table = self.query_one("#packages", DataTable)
+        table.add_columns("id", "name", "category", "method", "description")
+        for pkg in load_catalog().packages.values():
+            table.add_row(pkg.id, pkg.name, pkg.category, pkg.default_method, pkg.description)
+        self.query_one("#results", DataTable).add_columns("name", "version", "method", "summary")
+        self.query_one("#results", DataTable).display = False
+        # The first build reads every package list, the catalog is usable meanwhile
+        self.run_worker(self.index.update, thread=True, exclusive=True)
+
+    def on_input_changed(self, event: Input.Changed) -> None:
+        query = event.value.strip()
+        results = self.query_one("#results", DataTable)
+        self.query_one("#packages", DataTable).display = not query
+        results.display = bool(query)
+        results.clear()
+        self.results = self.index.search(query, limit=100) if query else []
+        for result in self.results:
+            results.add_row(result.name, result.version, result.method, result.summary)
+
+    def action_add(self) -> None:
+        results = self.query_one("#results", DataTable)
+        if not results.display or not self.results:
+            return
+        pkg_id, entry = catalog_entry(self.results[results.cursor_row])
+        try:
+            add_package(pkg_id, None if pkg_id in load_catalog().packages else entry, self.profile)
+        except CatalogError as e:
+            self.notify(str(e), severity="error")
+            return
+        self.notify(f"{pkg_id} added" + (f" to {self.profile}" if self.profile else ""))
+
+
+def run_tui(profile: Optional[str] = None) -> None:
+    DQSApp(profile).run()
+
+
+# ==================================================================
+# PROGRESS DASHBOARD
+# ==================================================================
+def _duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m{seconds:02d}s" if minutes else f"{seconds}s"
+
+
+def _size(size: Optional[float]) -> str:
+    if size is None:
+        return "?"
+    return f"{size / (1024 * 1024):.1f}MB"
+
+
+class DashboardApp(App):
+    """Live progress of a run, drawn from the event bus (dqs.core.events)."""
+    TITLE = "Debian Quick Setup"
+    BINDINGS = [("q", "quit", "Quit")]
+
+    def __init__(self, tracker: events.Tracker, worker: threading.Thread):
+        super().__init__()
+        self.tracker = tracker
+        self.worker = worker
+        self._seen = 0
+
+    def compose(self) -> ComposeResult:
+        yield Header()
+        yield Static(id="summary")
+        yield DataTable(id="tasks")
+        yield DataTable(id="downloads")
+        yield Log(id="messages", max_lines=500)
+        yield Footer()
+
+    def on_mount(self) -> None:
+        self.query_one("#tasks", DataTable).add_columns("task", "time", "output")
+        self.query_one("#downloads", DataTable).add_columns("download", "received", "speed", "eta")
+        self.set_interval(1 / REFRESH_RATE, self.refresh_view)
+
+    def refresh_view(self) -> None:
+        state = self.tracker.snapshot(self._seen)
+        finished = not self.worker.is_alive()
+        waiting = "".join(f"  ·  waiting for the dpkg lock: {who} ({_duration(seconds)})" for who, seconds in state["lock_waiting"])
+        self.query_one("#summary", Static).update(
+            f"{state['done']}/{state['total']} tasks  ·  running: {len(state['running'])}  ·  queued: {state['queued']}"
+            f"  ·  failed: {state['failed']}  ·  {_duration(state['elapsed'])}"
+            + ("  ·  finished, q to quit" if finished else f"  ·  ETA {_duration(state['eta'])}")
+            + waiting
+        )
+
+        tasks = self.query_one("#tasks", DataTable)
+        tasks.clear()
+        for task, seconds, line in state["running"]:
+            tasks.add_row(task, _duration(seconds), line[-80:])
+
+        downloads = self.query_one("#downloads", DataTable)
+        downloads.clear()
+        for url, received, total, throughput, eta in state["downloads"]:
+            name = url.split("?", 1)[0].rsplit("/", 1)[-1] or url
+            downloads.add_row(name, f"{_size(received)} / {_size(total)}", f"{_size(throughput)}/s", _duration(eta))
+
+        messages = self.query_one("#messages", Log)
+        for sequence, level, text in state["messages"]:
+            messages.write_line(f"{'✗ ' if level == 'error' else ''}{text}")
+            self._seen = sequence
+
+
+def run_dashboard(work: Callable[[], Any]) -> Any:
+    """
+    Runs work in a background thread while the dashboard shows its progress.
+    Quitting the dashboard doesn't stop the work, it carries on printing to
+    the terminal as usual until it finishes.
+    """
+    tracker = events.Tracker()
+    events.subscribe(tracker)
+    outcome: dict[str, Any] = {}
+
+    def target() -> None:
+        outcome["result"] = work()
+
+    worker = threading.Thread(target=target, name="dqs-run")
+    # Everything goes to the dashboard while it owns the terminal
+    terminal_utils.ECHO = False
+    try:
+        worker.start()
+        DashboardApp(tracker, worker).run()
+    finally:
+        terminal_utils.ECHO = True
+        events.unsubscribe(tracker)
+    worker.join()
+    return outcome.get("result")
@@ -0,0 +1,11 @@
+import os
+
+# Downloads and compiled data, safe to delete at any time
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "dqs")
+# What the user adds to dqs (packages added with `dqs add`...)
+CONFIG_DIR = os.path.join(os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"), "dqs")
+# Things dqs remembers between runs (readiness markers, journals...)
+STATE_DIR = os.path.join(os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state"), "dqs")
+# Tarball installs, one directory per package, and links to their executables
+OPT_DIR = os.path.expanduser("~/.local/opt")
+BIN_DIR = os.path.expanduser("~/.local/bin")
@@ -1,28 +1,218 @@
-import subprocess
+import os
+import shlex
+import shutil
+import signal
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Sequence, Union
 
 RED = "\033[91m"
 GREEN = "\033[92m"
 YELLOW = "\033[93m"
+DIM = "\033[2m"
 RESET = "\033[0m"
 
+# Lines of output kept per command for error reporting
+TAIL_LINES = 40
+# Longest line kept, anything after that is dropped
+MAX_LINE = 4096
+READ_SIZE = 64 * 1024
+# Seconds a cancelled argv command gets to exit after SIGTERM before it is killed
+KILL_GRACE = 5.0
+
+# A string runs through /bin/sh, a sequence is an argv run without a shell
+Command = Union[str, Sequence[str]]
+
+# Called with (level, text) for every message below, in the thread that logs it (dqs.core.events)
+MESSAGE_LISTENERS: list[Callable[[str, str], None]] = []
+# Off while something else owns the terminal (the dashboard, a JSON log on stdout)
+ECHO = True
+
+def emit(level: str, text: str, formatted: str) -> None:
+    """Shows formatted on the terminal and hands (level, text) to the listeners."""
+    for listener in MESSAGE_LISTENERS:
+        listener(level, text)
+    if ECHO:
+        print(formatted)
+
 def log(message: str) -> None:
     """Logs a message to the terminal."""
-    print(f"\n{YELLOW}{message}{RESET}")
-    
+    emit("log", message, f"\n{YELLOW}{message}{RESET}")
+
 def ok(message: str) -> None:
     """Logs a success message to the terminal."""
-    print(f"{GREEN}{message}{RESET}")
+    emit("ok", message, f"{GREEN}{message}{RESET}")
 
 def error(message: str) -> None:
     """Logs an error message to the terminal."""
-    print(f"{RED}{message}{RESET}")
-    
-def run_command(command: str) -> bool:
-    """Runs a shell command and returns True if it succeeds, False otherwise."""
+    emit("error", message, f"{RED}{message}{RESET}")
+
+def output(line: str) -> None:
+    """Logs a line of output of a running command."""
+    emit("output", line, f"{DIM}  {line}{RESET}")
+
+# ==================================================================
+# COMMAND RUNNER
+# ==================================================================
+@dataclass
+class CommandResult:
+    command: str
+    returncode: Optional[int] = None
+    # Wall clock time the command started at
+    started: float = 0.0
+    duration: float = 0.0
+    output_bytes: int = 0
+    timed_out: bool = False
+    tail: deque = field(default_factory=lambda: deque(maxlen=TAIL_LINES))
+
+    @property
+    def success(self) -> bool:
+        return self.returncode == 0
+
+# Stats of every command run by this process
+COMMAND_HISTORY: list[CommandResult] = []
+_history_lock = threading.Lock()
+# Called with every finished command, in the thread that ran it (dqs.core.timings, dqs.core.events)
+COMMAND_LISTENERS: list[Callable[[CommandResult], None]] = []
+
+
+async def _pump(stream: "asyncio.StreamReader", result: CommandResult, echo: bool) -> None:
+    # Reads fixed size chunks instead of readline() so a huge line can't blow
+    # the buffer, only the current (truncated) line is kept in memory
+    partial = b""
+    while chunk := await stream.read(READ_SIZE):
+        result.output_bytes += len(chunk)
+        *lines, rest = (partial + chunk).split(b"\n")
+        partial = rest[:MAX_LINE]
+        for raw in lines:
+            line = raw[:MAX_LINE].decode(errors="replace").rstrip("\r")
+            result.tail.append(line)
+            if echo:
+                output(line)
+    if partial:
+        line = partial.decode(errors="replace")
+        result.tail.append(line)
+        if echo:
+            output(line)
+
+
+def display(command: Command) -> str:
+    """Command as a line of shell, for logs."""
+    return command if isinstance(command, str) else shlex.join(command)
+
+
+def _executable(name: str, env: Optional[dict[str, str]]) -> Optional[str]:
+    # An absolute path lets subprocess use posix_spawn instead of fork + exec
+    if os.sep in name:
+        return name
+    return shutil.which(name, path=(env if env is not None else os.environ).get("PATH"))
+
+
+async def stream_command(command: Command, timeout: Optional[float] = None, env: Optional[dict[str, str]] = None,
+                         echo: bool = True, cwd: Optional[str] = None) -> CommandResult:
+    """
+    Runs a command streaming its stdout/stderr line by line as it is
+    produced. Only the last TAIL_LINES lines are kept, so memory stays flat
+    however chatty the command is.
+    A string goes through /bin/sh in its own session and a sequence is exec'd
+    directly, without a shell. With a timeout either one gets its own process
+    group, killed whole on timeout or cancellation. An argv without a timeout
+    stays in ours so CPython can posix_spawn it, when cancelled it gets
+    SIGTERM (sudo relays it) and SIGKILL after KILL_GRACE.
+    """
+    import asyncio
+
+    result = CommandResult(display(command), started=time.time())
+    start = time.monotonic()
+    shell = isinstance(command, str)
+    own_group = shell or timeout is not None
+    if shell:
+        process = await asyncio.create_subprocess_shell(
+            command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.DEVNULL,
+            env=env,
+            cwd=cwd,
+            start_new_session=True,
+        )
+    else:
+        executable = _executable(command[0], env)
+        if executable is None:
+            # What the shell would have answered
+            result.returncode = 127
+            result.tail.append(f"{command[0]}: command not found")
+            _finish(result, start)
+            return result
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            executable=executable,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.DEVNULL,
+            env=env,
+            cwd=cwd,
+            close_fds=True,
+            process_group=0 if own_group else None,
+        )
     try:
-        log(f"Running: {command}")
-        result = subprocess.run(command, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return result.returncode == 0
-    except subprocess.CalledProcessError as e:
-        error(f"Command failed: {e.stderr.decode().strip()}")
-        return False
\ No newline at end of file
+        await asyncio.wait_for(
+            asyncio.gather(_pump(process.stdout, result, echo), _pump(process.stderr, result, echo), process.wait()),
+            timeout,
+        )
+    except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+        result.timed_out = isinstance(e, asyncio.TimeoutError)
+        try:
+            if own_group:
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), KILL_GRACE)
+                except asyncio.TimeoutError:
+                    process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+        if not result.timed_out:
+            raise
+    finally:
+        result.returncode = process.returncode
+        _finish(result, start)
+    return result
+
+
+def _finish(result: CommandResult, start: float) -> None:
+    result.duration = time.monotonic() - start
+    with _history_lock:
+        COMMAND_HISTORY.append(result)
+    for listener in COMMAND_LISTENERS:
+        listener(result)
+
+
+def execute(command: Command, timeout: Optional[float] = None, env: Optional[dict[str, str]] = None,
+            echo: bool = True, cwd: Optional[str] = None) -> CommandResult:
+    """Synchronous wrapper around stream_command, safe to call from worker threads."""
+    # asyncio is imported on first use, it's a big part of the CLI startup time
+    import asyncio
+
+    return asyncio.run(stream_command(command, timeout=timeout, env=env, echo=echo, cwd=cwd))
+
+
+def run_command(command: Command, timeout: Optional[float] = None, env: Optional[dict[str, str]] = None,
+                cwd: Optional[str] = None) -> bool:
+    """Runs a command (shell string or argv) and returns True if it succeeds, False otherwise."""
+    log(f"Running: {display(command)}")
+    result = execute(command, timeout=timeout, env=env, cwd=cwd)
+    if result.success:
+        return True
+
+    if result.timed_out:
+        error(f"Command timed out after {timeout}s: {result.command}")
+    else:
+        error(f"Command failed with exit code {result.returncode}: {result.command}")
+    for line in result.tail:
+        error(f"  {line}")
+    return False